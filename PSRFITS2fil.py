@@ -10,14 +10,19 @@
 import os
 import sys
 import time
-import struct
 import argparse
+import multiprocessing
 import warnings
 import numpy as np
 np.set_printoptions(threshold=np.nan)
 from astropy.time import Time
-import astropy.io.fits as pyfits
 import matplotlib.pyplot as plt
+import filterbank
+import psrfits
+import perfMetrics
+import requantise
+import checkpoint
+from numba import jit
 
 
 __version__ = 1.2
@@ -76,49 +81,42 @@ machineIDs = {
 "kat": 64}
 
 
-headerParameters = {
-"HEADER_START": "flag",
-"telescope_id": "i",
-"machine_id": "i",
-"data_type": "i",
-"rawdatafile": "str",
-"source_name": "str",
-"src_raj": "d",
-"src_dej": "d",
-"tstart": "d",
-"tsamp": "d",
-"nbits": "i",
-"fch1": "d",
-"foff": "d",
-"nchans": "i",
-"nifs": "i",
-"HEADER_END": "flag"}
-
-
-def prepareString(string):
-  return struct.pack("i", len(string)) + string
-
-
-def prepareDouble(key, value):
-  return prepareString(key) + struct.pack("d", float(value))
+def unpackTable(nBits):
+  """
+  Return the lookup table unpacking a byte of nBits-bit data.
+    Input:
+      nBits: bits per value (1, 2 or 4).
+    Output:
+      table: array of shape (256, 8 / nBits), the values packed into each
+             byte, the one in the most significant bits first.
+  """
+  valuesPerByte = 8 // nBits
+  shifts = np.arange(8 - nBits, -1, -nBits)
+  return ((np.arange(256)[:, np.newaxis] >> shifts) & (2**nBits - 1)).astype(np.uint8).reshape((256, valuesPerByte))
 
 
-def prepareInt(key, value):
-  return prepareString(key) + struct.pack("i", int(value))
+unpackTables = dict((nBits, unpackTable(nBits)) for nBits in (1, 2, 4))
 
 
-def addToHeader(parameterName, parameterValue):
-  if headerParameters[parameterName] == "d":
-    return prepareDouble(parameterName, parameterValue)
-  elif headerParameters[parameterName] == "i":
-    return prepareInt(parameterName, parameterValue)
-  elif headerParameters[parameterName] == "str":
-    return prepareString(parameterName) + prepareString(parameterValue)
-  elif headerParameters[parameterName] == "flag":
-    return prepareString(parameterName)
-  else:
-    print "Unknown key: %s" % parameterName
-  return packedStructHeader
+def unpackBits(data, nBits, out = None):
+  """
+  Unpack nBits-bit data that has been read in as bytes, with a lookup
+  table.
+    Inputs:
+      data: array of unsigned nBits-bit ints packed into an array of
+            bytes (8 bit).
+      nBits: bits per value (1, 2 or 4).
+      out: uint8 buffer for the unpacked values (default: allocate one).
+    Output:
+      outdata: unpacked array with the shape of data and a last axis
+               8 / nBits times longer.
+  """
+  table = unpackTables[nBits]
+  shape = data.shape[:-1] + (data.shape[-1] * table.shape[1],)
+  if out is None:
+    out = np.empty(shape, np.uint8)
+  np.take(table, data, axis = 0, out = out.reshape(data.shape + (table.shape[1],)))
+  return out.reshape(shape)
 
 
 def unpack2Bit(data):
@@ -131,11 +129,7 @@ def unpack2Bit(data):
       outdata: unpacked array. The size of this array will
                be four times the size of the input data.
   """
-  piece0 = np.bitwise_and(data >> 0x06, 0x03)
-  piece1 = np.bitwise_and(data >> 0x04, 0x03)
-  piece2 = np.bitwise_and(data >> 0x02, 0x03)
-  piece3 = np.bitwise_and(data, 0x03)
-  return np.dstack([piece0, piece1, piece2, piece3]).flatten()
+  return unpackBits(np.ravel(data), 2)
 
 
 def unpack4Bit(data):
@@ -148,57 +142,66 @@ def unpack4Bit(data):
       outdata: unpacked array. The size of this array will
                be twice the size of the input data.
   """
-  piece0 = np.bitwise_and(data >> 0x04, 0x0F)
-  piece1 = np.bitwise_and(data, 0x0F)
-  return np.dstack([piece0, piece1]).flatten()
-
-
-def getWeights(data, iSub):
-  """
-  Return weights for a particular subint.
-    Inputs:
-      data: PyFITS object.
-      iSub: index of subint (first subint is 0).
-    Output:
-       weights: subint weights (there is one value for each channel).
-  """
-  return data["SUBINT"].data[iSub]["DAT_WTS"]
-
-
-def getScales(data, iSub):
-  """
-  Return scales for a particular subint.
-    Inputs:
-      data: PyFITS object.
-      iSub: index of subint (first subint is 0).
-    Output:
-      scales: subint scales (there is one value for each channel).
-  """
-  return data["SUBINT"].data[iSub]["DAT_SCL"]
-
-
-def getOffsets(data, iSub):
-  """
-  Return offsets for a particular subint.
-    Inputs:
-      data: PyFITS object.
-      iSub: index of subint (first subint is 0).
-    Output:
-      offsets: subint offsets (there is one value for each channel).
-  """
-  return data["SUBINT"].data[iSub]["DAT_OFFS"]
+  return unpackBits(np.ravel(data), 4)
+
+
+@jit(nopython=True, nogil=True)
+def _unpackScaled(packed, table, scales, offsets, weights, sumIFs, out):
+  # Unpack each byte of every subint row through the lookup table and
+  # apply scales, offsets and weights in the same pass, in the order
+  # readSubints() applies them to 8-bit data.
+  nSamp = out.shape[1]
+  nPol = scales.shape[1]
+  valuesPerByte = table.shape[1]
+  rowBytes = out.shape[3] // valuesPerByte
+  for s in range(out.shape[0]):
+    for t in range(nSamp):
+      for q in range(out.shape[2]):
+        row = (t * nPol + q) * rowBytes
+        if sumIFs:
+          for i in range(rowBytes):
+            byte0 = packed[s, row + i]
+            byte1 = packed[s, row + rowBytes + i]
+            for k in range(valuesPerByte):
+              c = i * valuesPerByte + k
+              value = table[byte0, k] * scales[s, 0, c] + table[byte1, k] * scales[s, 1, c]
+              out[s, t, 0, c] = (value + (offsets[s, 0, c] + offsets[s, 1, c])) * weights[s, c]
+        else:
+          for i in range(rowBytes):
+            byte = packed[s, row + i]
+            for k in range(valuesPerByte):
+              c = i * valuesPerByte + k
+              out[s, t, q, c] = (table[byte, k] * scales[s, q, c] + offsets[s, q, c]) * weights[s, c]
+
+
+@jit(nopython=True, nogil=True)
+def _quantiseSubints(values, scale, offset, maxValue, out, clipCounts):
+  # requantise.quantise() with a scale and offset per subint, in one pass.
+  # NaN samples are clipped low.
+  for s in range(values.shape[0]):
+    for t in range(values.shape[1]):
+      for q in range(values.shape[2]):
+        for c in range(values.shape[3]):
+          level = np.floor(values[s, t, q, c] * scale[s, q, c] + offset[s, q, c] + np.float32(0.5))
+          if not level >= 0:
+            clipCounts[0] += 1
+            level = np.float32(0)
+          elif level > maxValue:
+            clipCounts[1] += 1
+            level = maxValue
+          out[s, t, q, c] = level
 
 
 def translateHeader(fitsObject):
   """
   Return SIGPROC filterbank header.
     Inputs:
-      data: PyFITS object.
+      fitsObject: psrfits.SearchModeReader object.
     Output:
       header: dictionary with filterbank header keys and values.
   """
-  psrfitsHeader = fitsObject[0].header
-  subintHeader = fitsObject["SUBINT"].header
+  psrfitsHeader = fitsObject.primaryHeader
+  subintHeader = fitsObject.subintHeader
   filterbankHeader = {}
   if psrfitsHeader["TELESCOP"] in telescopeIDs:
     filterbankHeader["telescope_id"] = telescopeIDs[psrfitsHeader["TELESCOP"]]
@@ -209,7 +212,7 @@ def translateHeader(fitsObject):
   else:
     filterbankHeader["machine_id"] = -1
   filterbankHeader["data_type"] = 1
-  filterbankHeader["rawdatafile"] = fitsObject.filename()
+  filterbankHeader["rawdatafile"] = fitsObject.fileName
   filterbankHeader["source_name"] = psrfitsHeader["SRC_NAME"]
   filterbankHeader["src_raj"] = float(psrfitsHeader["RA"].replace(":",""))
   filterbankHeader["src_dej"] = float(psrfitsHeader["DEC"].replace(":",""))
@@ -223,12 +226,16 @@ def translateHeader(fitsObject):
   return filterbankHeader
 
 
-def readSubint(fitsObject, iSub, applyWeights = True, applyScales = True, applyOffsets = True, sumIFs = False):
+def readSubints(fitsObject, first, end, applyWeights = True, applyScales = True, applyOffsets = True, sumIFs = False, out = None):
   """
-  Read a PSRFITS subint from a open pyfits file object.
-  Applies scales, weights, and offsets to the data.
+  Read PSRFITS subints first..end at once from a psrfits.SearchModeReader
+  object, straight from the memory-mapped columns. Scales, offsets and
+  weights of every subint are applied by broadcasting over the whole
+  block, in float32 and in place. 1, 2 and 4-bit data are unpacked through
+  a lookup table with the scales, offsets and weights applied in the same
+  pass.
     Inputs:
-      iSub: index of subint (first subint is 0)
+      first, end: index range of the subints (first subint is 0).
       applyWeights: if True, apply weights.
                      (Default: apply weights)
       applyScales: if True, apply scales.
@@ -237,46 +244,147 @@ def readSubint(fitsObject, iSub, applyWeights = True, applyScales = True, applyO
                      (Default: apply offsets)
       sumIFs: sum AA and BB to form total-power data.
                      (Default: do not sum)
+      out: float32 buffer with room for the block, reused between calls
+           (default: allocate one).
     Output:
-      data: Subint data with scales, weights, and offsets
-            applied in float32 dtype with shape (nsamps,npol,nchan).
+      data: block with shape (nsamps, npol, nchan), npol 1 when the
+            polarisations are summed, a view of out.
   """
-  subintData = fitsObject["SUBINT"].data[iSub]["DATA"]
-  nBits = fitsObject["SUBINT"].header["NBITS"]
-  nSampPerSubint = fitsObject["SUBINT"].header["NSBLK"]
-  nChan = fitsObject["SUBINT"].header["NCHAN"]
-  nPol = fitsObject["SUBINT"].header["NPOL"]
-  #subintDataShape = subintData.shape
-  #if ((nBits < 8) and (subintDataShape[0] != nSampPerSubint) and (subintDataShape[2] != nChan * (nBits / 8.0))):
-  #  #subintData = subintData.reshape(nSampPerSubint, nPol, nChan * (nBits / 8.0))
-  #  subintData = subintData.reshape(int((nSampPerSubint) * (nBits / 8.0)), nPol, nChan)
-  #if nBits == 4:
-  #  data = unpack4Bit(subintData)
-  #elif nBits == 2:
-  #  data = unpack2Bit(subintData)
-  #else:
-  #  data = np.array(subintData)
-  data = np.array(subintData)
-  if applyOffsets:
-    offsets = getOffsets(fitsObject, iSub)
-    offsets = offsets.reshape((nPol, nChan))
-  else:
-    offsets = 0
+  nSampPerSubint = fitsObject.samplesPerSubint
+  nChan = fitsObject.numberChannels
+  nPol = fitsObject.numberPolarisations
+  nSub = end - first
+  nIFs = 1 if sumIFs and (nPol == 2 or nPol == 4) else nPol
+  if out is None:
+    out = np.empty(nSub * nSampPerSubint * nIFs * nChan, np.float32)
+  data = out[:nSub * nSampPerSubint * nIFs * nChan].reshape((nSub, nSampPerSubint, nIFs, nChan))
+  subintData = fitsObject.data(first, end)
+  if fitsObject.nbits < 8:
+    if nChan * fitsObject.nbits % 8:
+      raise ValueError("%d channels of %d-bit data do not fill whole bytes." % (nChan, fitsObject.nbits))
+    # The kernel takes native float32, the columns are big-endian.
+    scales = fitsObject.scales(first, end).reshape((nSub, nPol, nChan)).astype(np.float32) if applyScales else np.ones((nSub, nPol, nChan), np.float32)
+    offsets = fitsObject.offsets(first, end).reshape((nSub, nPol, nChan)).astype(np.float32) if applyOffsets else np.zeros((nSub, nPol, nChan), np.float32)
+    weights = fitsObject.weights(first, end).astype(np.float32) if applyWeights else np.ones((nSub, nChan), np.float32)
+    _unpackScaled(subintData, unpackTables[fitsObject.nbits].astype(np.float32), scales, offsets, weights, nIFs != nPol, data)
+    return data.reshape((nSub * nSampPerSubint, nIFs, nChan))
   if applyScales:
-    scales = getScales(fitsObject, iSub)
-    scales = scales.reshape((nPol, nChan))
+    scales = fitsObject.scales(first, end).reshape((nSub, 1, nPol, nChan))
   else:
-    scales = 1
+    scales = np.ones((nSub, 1, nPol, nChan), np.float32)
+  np.multiply(subintData[:, :, :nIFs], scales[:, :, :nIFs], out = data)
+  if nIFs != nPol:
+    data += subintData[:, :, 1:2] * scales[:, :, 1:2] # AA + BB
+  if applyOffsets:
+    offsets = fitsObject.offsets(first, end).reshape((nSub, 1, nPol, nChan))
+    data += offsets[:, :, :nIFs] if nIFs == nPol else offsets[:, :, 0:1] + offsets[:, :, 1:2]
   if applyWeights:
-    weights = getWeights(fitsObject, iSub)
-  else:
-    weights = 1
-  #data = data.reshape(nSampPerSubint, nPol, nChan)
-  dataWSO = ((data * scales) + offsets) * weights
-  if nPol == 2 or nPol == 4:
-    if sumIFs == True:
-      dataWSO = dataWSO[:, 0, :] + dataWSO[:, 1, :]
-  return dataWSO
+    data *= fitsObject.weights(first, end).reshape((nSub, 1, 1, nChan))
+  return data.reshape((nSub * nSampPerSubint, nIFs, nChan))
+
+
+def convertSubints(task):
+  """
+  Convert subints spanStart..spanEnd a block at a time and write them at
+  their sample offset in the preallocated filterbank file. Each call opens
+  its own memory maps of the input and output, so it can run in a separate
+  process. 8 and 16-bit output is requantised subint by subint with the
+  per-channel statistics of the sliding window of subints ending with it;
+  the window before the span is read first, so the output does not depend
+  on where the span starts.
+    Inputs:
+      task: dictionary with the input and output file names, the output
+            header and shape, the conversion settings and the span.
+    Output:
+      span: the subints converted.
+      metrics: perfMetrics.Metrics of the conversion.
+      clipCounts: values clipped low and high by the requantisation.
+  """
+  spanStart, spanEnd = task["span"]
+  psrfitsFile = psrfits.SearchModeReader(task["psrfitsFileName"])
+  nSampPerSubint = psrfitsFile.samplesPerSubint
+  nIFs = task["nifs"]
+  nChan = task["nchans"]
+  nBitsOut = task["nBitsOut"]
+  sink = filterbank.FilterbankSink(task["outFileName"], task["header"], task["nSubProcess"] * nSampPerSubint, nIFs, nChan, nBitsOut, create = False)
+  metrics = perfMetrics.Metrics()
+  nBlock = task["blockSubints"]
+  windowStart = spanStart
+  if nBitsOut != 32:
+    statistics = requantise.SlidingStatistics(task["windowSubints"])
+    windowStart = max(0, spanStart - task["windowSubints"] + 1)
+  blockBuffer = np.empty(min(nBlock, spanEnd - windowStart) * nSampPerSubint * nIFs * nChan, np.float32)
+  quantiseBuffer = np.empty(blockBuffer.size, sink.dtype) if nBitsOut != 32 else None
+  clipCounts = np.zeros(2, np.int64)
+  checkpointer = task.get("checkpointer")
+  for firstBlockSub in range(windowStart, spanStart, nBlock) + range(spanStart, spanEnd, nBlock):
+    endBlockSub = min(spanEnd if firstBlockSub >= spanStart else spanStart, firstBlockSub + nBlock)
+    readStart = time.time()
+    block = readSubints(psrfitsFile, firstBlockSub, endBlockSub, task["applyWeights"], task["applyScales"], task["applyOffsets"], task["sumIFs"], blockBuffer)
+    computeStart = time.time()
+    metrics.add("read", busy = computeStart - readStart)
+    if task["flipBand"]:
+      block = block[:, :, ::-1]
+    quantiseStart = time.time()
+    metrics.add("compute", busy = quantiseStart - computeStart)
+    if nBitsOut != 32:
+      subints = block.reshape((endBlockSub - firstBlockSub, nSampPerSubint) + block.shape[1:])
+      scale, offset = statistics.scaling(subints, nBitsOut)
+      if firstBlockSub < spanStart:
+        metrics.add("quantise", busy = time.time() - quantiseStart)
+        continue # only fills the window
+      quantised = quantiseBuffer[:block.size].reshape(subints.shape)
+      _quantiseSubints(subints, scale, offset, np.float32(2**nBitsOut - 1), quantised, clipCounts)
+      block = quantised.reshape(block.shape)
+    writeStart = time.time()
+    metrics.add("quantise", busy = writeStart - quantiseStart)
+    sink.write(firstBlockSub * nSampPerSubint, block)
+    metrics.add("write", busy = time.time() - writeStart)
+    blockSamples = (endBlockSub - firstBlockSub) * nSampPerSubint
+    metrics.count("spectra", blockSamples)
+    metrics.count("bytesIn", blockSamples * psrfitsFile.numberPolarisations * nChan * psrfitsFile.nbits / 8)
+    metrics.count("samples", blockSamples)
+    metrics.count("bytesOut", blockSamples * sink.bytesPerSample)
+    if task.get("exporter") is not None:
+      task["exporter"].update(metrics)
+    if checkpointer is not None and checkpointer.due():
+      sink.flush() # on disk before the sub-integrations are recorded as converted
+      checkpointer.record(spanStart, endBlockSub, {"clip": clipCounts.tolist()})
+      checkpointer.save()
+  writeStart = time.time()
+  if task.get("checkpoint"):
+    sink.flush() # on disk before the span is recorded as converted
+  sink.close()
+  metrics.add("write", busy = time.time() - writeStart)
+  return task["span"], metrics, clipCounts
+
+
+def compileKernels(task, nBits, nPol):
+  """
+  Compile the numba kernels used by convertSubints() on a few dummy
+  values of the types and layouts of the real blocks, so that workers
+  forked afterwards share them instead of each compiling its own.
+    Inputs:
+      task: dictionary of convertSubints() settings.
+      nBits: bits per input value.
+      nPol: number of polarisations of the input.
+  """
+  nSub, nChan, nIFs = 2, 8, task["nifs"]
+  values = np.zeros(nSub * nIFs * nChan, np.float32).reshape((nSub, 1, nIFs, nChan))
+  if nBits < 8:
+    # Packed rows of the SUBINT table are read-only, strided for a block
+    # and contiguous for a single subint.
+    rowBytes = nPol * nChan * nBits // 8
+    packed = np.zeros((nSub, 2 * rowBytes), np.uint8)[:, :rowBytes]
+    packed.flags.writeable = False
+    for rows in (packed, packed[:1]):
+      _unpackScaled(rows, unpackTables[nBits].astype(np.float32), np.ones((nSub, nPol, nChan), np.float32), np.zeros((nSub, nPol, nChan), np.float32),
+                    np.ones((nSub, nChan), np.float32), nIFs != nPol, values[:rows.shape[0]])
+  if task["nBitsOut"] != 32:
+    if task["flipBand"]:
+      values = values.reshape((nSub, nIFs, nChan))[:, :, ::-1].reshape(values.shape)
+    scale, offset = requantise.SlidingStatistics(task["windowSubints"]).scaling(values, task["nBitsOut"])
+    _quantiseSubints(values, scale, offset, np.float32(2**task["nBitsOut"] - 1), np.empty(values.shape, filterbank.nbitsTypes[task["nBitsOut"]]), np.zeros(2, np.int64))
 
 
 # Main body of the script.
@@ -291,13 +399,20 @@ if __name__=="__main__":
   parser.add_argument("--out", dest = "outFileName", action = "store", metavar = "<outFileName>", default = "", help = "specify output filterbank file name (default: replace input extension with .fil)")
   parser.add_argument("--nSub", dest = "nSubProcess", action = "store", metavar = "<nSubs>", default = "", help = "specify number of sub-integrations to process (default: process all)")
   parser.add_argument("--sumIFs", dest = "sumIFs", action = "store_true", help = "form total-power data")
+  parser.add_argument("--block", dest = "blockSubints", action = "store", metavar = "<nSubs>", type = int, default = 0, help = "specify number of sub-integrations converted at once (default: about 64 MB of data)")
+  parser.add_argument("--window", dest = "windowSubints", action = "store", metavar = "<nSubs>", type = int, default = 16, help = "specify number of sub-integrations in the sliding window of the 8/16-bit requantisation statistics (default: 16)")
+  parser.add_argument("--workers", dest = "numberWorkers", action = "store", metavar = "<nWorkers>", type = int, default = 1, help = "specify number of processes converting sub-integrations in parallel (default: 1)")
   parser.add_argument("--noweights", dest = "applyWeights", action = "store_false", help = "do not apply weights when converting data")
   parser.add_argument("--noscales",  dest = "applyScales",  action = "store_false", help = "do not apply scales when converting data")
   parser.add_argument("--nooffsets", dest = "applyOffsets", action = "store_false", help = "do not apply offsets when converting data")
+  parser.add_argument("--checkpoint", dest = "checkpointInterval", action = "store", metavar = "<seconds>", type = float, help = "record the converted sub-integrations in <outFileName>.checkpoint every <seconds>")
+  parser.add_argument("--resume", dest = "resume", action = "store_true", help = "continue an interrupted conversion from <outFileName>.checkpoint (checkpointing every 60 s unless --checkpoint is given)")
+  perfMetrics.addOptions(parser)
   args = parser.parse_args()
 
   # Start script timing.
   scriptStartTime = time.time()
+  metrics = perfMetrics.Metrics()
 
   # Check for psrfitsFileName presence.
   if not args.psrfitsFileName:
@@ -314,6 +429,8 @@ if __name__=="__main__":
     pass
   else:
     raise ValueError("Converting to %d-bit data not supported." % nBitsOut)
+  if args.windowSubints < 1:
+    raise ValueError("The requantisation window needs at least one sub-integration.")
 
   # Check for outFileName presence.
   if args.outFileName:
@@ -322,13 +439,13 @@ if __name__=="__main__":
     outFileName = '.'.join(psrfitsFileName.split('.')[:-1]) + ".fil"
 
   # Opening PSRFITS file.
-  psrfitsFile = pyfits.open(psrfitsFileName, mode = "readonly", memmap = True)
-  nBits = psrfitsFile["SUBINT"].header["NBITS"]
-  if nBits != 8:
+  psrfitsFile = psrfits.SearchModeReader(psrfitsFileName)
+  nBits = psrfitsFile.nbits
+  if nBits not in (1, 2, 4, 8):
     raise ValueError("Reading %d-bit data not supported." % nBits)
 
   # Checking number of available sub-integrations.
-  nSubint = psrfitsFile["SUBINT"].header["NAXIS2"]
+  nSubint = psrfitsFile.numberSubints
   if args.nSubProcess:
     nSubProcess = int(args.nSubProcess)
   else:
@@ -345,8 +462,8 @@ if __name__=="__main__":
 
   # Check for sumIFs presence.
   sumIFs = args.sumIFs
-  nPol = psrfitsFile["SUBINT"].header["NPOL"]
-  polType = psrfitsFile["SUBINT"].header["POL_TYPE"]
+  nPol = psrfitsFile.numberPolarisations
+  polType = psrfitsFile.subintHeader["POL_TYPE"]
   if nPol == 4 and (polType == "AABBCRCI" or polType == "XXYYCRCI" or polType == "LLRRCRCI"):
     if sumIFs:
       sigprocHeader["nifs"] = 1
@@ -370,61 +487,104 @@ if __name__=="__main__":
     raise ValueError("Unknown polarisation type: %s" % polType)
 
   # Create SIGPROC header. Only add recognized parameters.
-  fileOut = open(outFileName, "wb")
-  fileOut.write(addToHeader("HEADER_START", None))
+  headerItems = []
   for parameterName in sigprocHeader.keys():
-    if parameterName not in headerParameters:
+    if parameterName not in filterbank.headerParameters:
       continue
     parameterValue = sigprocHeader[parameterName]
     #print "Writing SIGPROC header parameter: %s[\"%s\"]" % (parameterName, parameterValue)
-    fileOut.write(addToHeader(parameterName, parameterValue))
-  fileOut.write(addToHeader("HEADER_END", None))
+    headerItems.append((parameterName, parameterValue))
+  nSampPerSubint = psrfitsFile.samplesPerSubint
+  header = filterbank.makeHeader(headerItems)
+
+  # Resuming after the sub-integrations recorded in the checkpoint.
+  checkpointer = None
+  resumed = False
+  clipCounts = np.zeros(2, np.int64)
+  remaining = [(0, nSubProcess)]
+  if args.checkpointInterval or args.resume:
+    settings = {"input": [os.path.abspath(psrfitsFileName), os.path.getsize(psrfitsFileName)], "nSub": nSubProcess, "nBits": nBitsOut, "sumIFs": sumIFs,
+                "weights": args.applyWeights, "scales": args.applyScales, "offsets": args.applyOffsets, "window": args.windowSubints}
+    checkpointer = checkpoint.Checkpoint(checkpoint.checkpointFileName(outFileName), settings, args.checkpointInterval or 60.0)
+  if args.resume:
+    try:
+      resumed = checkpointer.load()
+    except ValueError as error:
+      print "Cannot resume: %s" % error
+      sys.exit(0)
+    if resumed:
+      problem = checkpoint.outputMatches(outFileName, header, len(header) + nSubProcess * nSampPerSubint * sigprocHeader["nifs"] * sigprocHeader["nchans"] * nBitsOut / 8)
+      if problem:
+        print "Cannot resume: %s" % problem
+        sys.exit(0)
+      remaining = checkpointer.remaining(nSubProcess)
+      for start, end, results in checkpointer.done():
+        clipCounts += results["clip"]
+      print "Resuming: %d of %d sub-integrations already converted." % (nSubProcess - sum(end - start for (start, end) in remaining), nSubProcess)
+    else:
+      print "No checkpoint for %s, converting from the start." % outFileName
+  if not resumed:
+    filterbank.FilterbankSink(outFileName, header, nSubProcess * nSampPerSubint, sigprocHeader["nifs"], sigprocHeader["nchans"], nBitsOut).close()
 
   # Flip the band if frequency channels are in ascending order.
-  if psrfitsFile["SUBINT"].header["CHAN_BW"] > 0:
+  if psrfitsFile.subintHeader["CHAN_BW"] > 0:
     flipBand = True
     print "Fits file frequencies in ascending order. Flipping the frequency band."
   else:
     flipBand = False
 
-  # Calculate scaling factor if output data is not 32 bits.
+  # Requantising with running statistics if output data is not 32 bits.
   if nBitsOut != 32:
-    print "Calculating statistics on first sub-integration."
-    subint0 = readSubint(psrfitsFile, 0, args.applyWeights, args.applyScales, args.applyOffsets, sumIFs)
-    #newMax = np.mean(subint0) + 3 * np.std(subint0)
-    newMax = 3 * np.median(subint0)
-    #print "3 * median = %f" % newMax
-    if newMax > 2.0**nBitsOut:
-      scaleFlag = True
-      scaleFactor = newMax / (2.0**nBitsOut)
-      print "Scaling data by %f" % (1.0 / scaleFactor)
-      print "Values larger than %f (pre-scaling) will be set to %f." % (newMax, (2.0**nBitsOut) - 1)
-    else:
-      scaleFlag = False
-      scaleFactor = 1.0
-      print "No scaling necessary."
+    print "Requantising with per-channel statistics of the last %d sub-integrations." % args.windowSubints
   else:
-      scaleFactor = 1.0
-      print "No scaling necessary for 32-bit float output file."
+    print "No scaling necessary for 32-bit float output file."
 
   print "Writing data..."
-
-  # Converting the data to SIGPROC filterbank.
-  for iSub in range(nSubProcess):
-    subint = readSubint(psrfitsFile, iSub, args.applyWeights, args.applyScales, args.applyOffsets, sumIFs)
-    if flipBand:
-      subint = np.fliplr(subint)
-    subint /= scaleFactor
-    if nBitsOut == 32:
-      subint = subint.astype(dtype = np.float32)
-    elif nBitsOut == 16:
-      subint = subint.astype(dtype = np.uint16)
-    elif nBitsOut == 8:
-      subint = subint.astype(dtype = np.uint8)
-    subint = subint.tobytes(order = "C")
-    fileOut.write(subint)
+  metricsExporter = perfMetrics.exporterFromOptions(args, metrics, "PSRFITS2fil", outFileName)
+
+  # Converting the data to SIGPROC filterbank, a block of sub-integrations at a
+  # time, each block written at its own offset in the output.
+  task = {"psrfitsFileName": psrfitsFileName, "outFileName": outFileName, "header": header, "nSubProcess": nSubProcess, "nifs": sigprocHeader["nifs"],
+          "nchans": sigprocHeader["nchans"], "nBitsOut": nBitsOut, "applyWeights": args.applyWeights, "applyScales": args.applyScales,
+          "applyOffsets": args.applyOffsets, "sumIFs": sumIFs, "flipBand": flipBand, "windowSubints": args.windowSubints,
+          "blockSubints": args.blockSubints or max(1, 64 * 1024**2 // (nSampPerSubint * sigprocHeader["nifs"] * sigprocHeader["nchans"] * 4)),
+          "checkpoint": checkpointer is not None}
+  if args.numberWorkers <= 1:
+    for span in remaining:
+      spanTask = dict(task, span = span, checkpointer = checkpointer, exporter = metricsExporter)
+      span, spanMetrics, spanClipCounts = convertSubints(spanTask)
+      metrics.merge(spanMetrics)
+      clipCounts += spanClipCounts
+      if checkpointer is not None:
+        checkpointer.record(span[0], span[1], {"clip": spanClipCounts.tolist()})
+  else:
+    # Spans of one block each, handed out to the workers as they finish.
+    tasks = []
+    for start, end in remaining:
+      for first in range(start, end, task["blockSubints"]):
+        tasks.append(dict(task, span = (first, min(end, first + task["blockSubints"]))))
+    if (nBits < 8 or nBitsOut != 32) and tasks:
+      compileKernels(task, nBits, nPol) # once, before the workers are forked
+    workerPool = multiprocessing.Pool(args.numberWorkers)
+    for span, spanMetrics, spanClipCounts in workerPool.imap_unordered(convertSubints, tasks):
+      metrics.merge(spanMetrics)
+      clipCounts += spanClipCounts
+      if checkpointer is not None:
+        checkpointer.record(span[0], span[1], {"clip": spanClipCounts.tolist()})
+        if checkpointer.due():
+          checkpointer.save()
+      metricsExporter.update()
+    workerPool.close()
+    workerPool.join()
   print "Done."
-  fileOut.close()
+  if checkpointer is not None:
+    checkpointer.remove()
+  if nBitsOut != 32:
+    metrics.count("clippedValues", clipCounts.sum())
+  metrics.report()
+  if nBitsOut != 32:
+    requantise.reportClipping(clipCounts, nSubProcess * nSampPerSubint * sigprocHeader["nifs"] * sigprocHeader["nchans"])
+  metricsExporter.close()
 
   # End timing script and produce result.
   scriptEndTime = time.time()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 by Maciej Serylak
+# Licensed under the Academic Free License version 3.0
+# This program comes with ABSOLUTELY NO WARRANTY.
+# You are free to modify and redistribute this code as long
+# as you do not remove the above attribution and reasonably
+# inform recipients that you have modified the original work.
+
+# Calibration of the read span and number of workers of the converters,
+# with the measurements cached per host, dataset layout and settings.
+
+import os
+import json
+import socket
+
+# Measurements of earlier calibrations.
+cacheFileName = os.path.join(os.path.expanduser("~"), ".cache", "scripts_autotune.json")
+
+
+def cacheKey(layout, decimationFactor, settings = ""):
+  """
+  Return the cache key of a calibration on this host.
+    Inputs:
+      layout: dictionary from beamformerH5.datasetLayout().
+      decimationFactor: number of spectra averaged into one output sample.
+      settings: other settings changing the cost of a conversion.
+  """
+  return "%s shape=%s chunks=%s compression=%s ndec=%d %s" % (socket.gethostname(), tuple(layout["shape"]), layout["chunks"] and tuple(layout["chunks"]), layout["compression"], decimationFactor, settings)
+
+
+def loadTuning(key, maxMemory = None, fileName = cacheFileName):
+  """
+  Return the cached measurements for key, None if there are none or they
+  were made with a smaller memory budget than maxMemory.
+  """
+  try:
+    cache = json.load(open(fileName))
+  except (IOError, ValueError):
+    return None
+  entry = cache.get(key)
+  if entry is None:
+    return None
+  if entry["maxMemory"] is not None and (maxMemory is None or maxMemory > entry["maxMemory"]):
+    return None
+  return entry["measurements"]
+
+
+def saveTuning(key, measurements, maxMemory = None, fileName = cacheFileName):
+  """
+  Store the measurements for key, keeping the other entries of the cache.
+  """
+  try:
+    cache = json.load(open(fileName))
+  except (IOError, ValueError):
+    cache = {}
+  cache[key] = {"maxMemory": maxMemory, "measurements": measurements}
+  if not os.path.isdir(os.path.dirname(fileName)):
+    os.makedirs(os.path.dirname(fileName))
+  temporaryName = "%s.%d" % (fileName, os.getpid())
+  fileOut = open(temporaryName, "w")
+  json.dump(cache, fileOut, indent = 1, sort_keys = True)
+  fileOut.close()
+  os.rename(temporaryName, fileName) # other runs never see a partly written cache
+
+
+def calibrate(measure, memory, chunkSizes, workerCounts, maxMemory = None):
+  """
+  Measure the conversion rate of configurations within the memory budget.
+  The read span is tuned with one worker, the number of workers with the
+  best span, then the neighbouring spans are tried with the best number
+  of workers.
+    Inputs:
+      measure: function (chunkSize, numberWorkers) returning spectra per second.
+      memory: function (chunkSize, numberWorkers) returning the bytes used.
+      chunkSizes: candidate read spans, in increasing order.
+      workerCounts: candidate numbers of workers, in increasing order.
+      maxMemory: memory budget in bytes, None for no limit.
+    Output:
+      measurements: list of dictionaries with chunkSize, numberWorkers,
+                    rate (spectra per second) and memory (bytes).
+  """
+  measured = {}
+  def run(chunkSize, numberWorkers):
+    if (chunkSize, numberWorkers) not in measured:
+      bytesUsed = memory(chunkSize, numberWorkers)
+      if maxMemory is not None and bytesUsed > maxMemory:
+        measured[(chunkSize, numberWorkers)] = None
+      else:
+        rate = measure(chunkSize, numberWorkers)
+        print ("autotune: chunkSize %6d  workers %3d  %12.0f spectra/s  %8.1f MB") % (chunkSize, numberWorkers, rate, bytesUsed / 1024.0**2)
+        measured[(chunkSize, numberWorkers)] = {"chunkSize": chunkSize, "numberWorkers": numberWorkers, "rate": rate, "memory": bytesUsed}
+    return measured[(chunkSize, numberWorkers)]
+  def best(configurations):
+    results = [run(*configuration) for configuration in configurations]
+    results = [result for result in results if result is not None]
+    return max(results, key = lambda result: result["rate"]) if results else None
+  # Warming up the page cache and the compiled kernels on the smallest
+  # configuration within the budget.
+  for chunkSize in chunkSizes:
+    if maxMemory is None or memory(chunkSize, workerCounts[0]) <= maxMemory:
+      measure(chunkSize, workerCounts[0])
+      break
+  bestChunk = best([(chunkSize, workerCounts[0]) for chunkSize in chunkSizes])
+  if bestChunk is not None:
+    bestWorkers = best([(bestChunk["chunkSize"], numberWorkers) for numberWorkers in workerCounts])
+    i = chunkSizes.index(bestChunk["chunkSize"])
+    best([(chunkSize, bestWorkers["numberWorkers"]) for chunkSize in chunkSizes[max(0, i - 1):i + 2]])
+  return [result for result in measured.values() if result is not None]
+
+
+def choose(measurements, maxMemory = None):
+  """
+  Return the fastest measured configuration within the memory budget,
+  None if there is none.
+  """
+  fitting = [result for result in measurements if maxMemory is None or result["memory"] <= maxMemory]
+  if not fitting:
+    return None
+  return max(fitting, key = lambda result: result["rate"])
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 by Maciej Serylak
+# Licensed under the Academic Free License version 3.0
+# This program comes with ABSOLUTELY NO WARRANTY.
+# You are free to modify and redistribute this code as long
+# as you do not remove the above attribution and reasonably
+# inform recipients that you have modified the original work.
+
+# Batch conversion of many observations: pairs the pol0/pol1 beamformer
+# HDF5 files by their timestamps, runs fastH5.py, PSRFITS2fil.py and
+# preparePCAP.py concurrently within limits on CPU cores and readers per
+# disk, retries failures and writes a summary report.
+
+import os
+import re
+import sys
+import glob
+import json
+import time
+import Queue
+import threading
+import multiprocessing
+import optparse as opt
+import converterRun
+
+
+def expandInputs(patterns, manifestFileName = None):
+  """
+  Return the sorted input files matching the patterns and the lines of the
+  manifest (one file name or glob per line, # starts a comment).
+  """
+  patterns = list(patterns)
+  if manifestFileName:
+    for line in open(manifestFileName):
+      line = line.split("#")[0].strip()
+      if line:
+        patterns.append(line)
+  fileNames = set()
+  for pattern in patterns:
+    matches = glob.glob(os.path.expanduser(pattern))
+    if not matches:
+      print ("No files match %s") % pattern
+    fileNames.update(os.path.abspath(fileName) for fileName in matches)
+  return sorted(fileNames)
+
+
+def timestampRange(fileName):
+  """
+  Return (sync time, first ADC count, last ADC count) of a beamformer file,
+  None if it cannot be read.
+  """
+  import beamformerH5
+  try:
+    dataFile = beamformerH5.openBeamformerFile(fileName)
+    timestamps = dataFile["Data/timestamps"]
+    if timestamps.shape[0] == 0:
+      dataFile.close()
+      return None
+    syncTime = int(dataFile["TelescopeModel/cbf"].attrs["sync_time"])
+    first, last = int(timestamps[0]), int(timestamps[-1])
+    dataFile.close()
+  except (IOError, KeyError):
+    return None
+  return syncTime, first, last
+
+
+def _polarisationKey(fileName):
+  """
+  Return a key ordering pol0 before pol1: the file name with its digits
+  after a pol/p marker, then the path.
+  """
+  match = re.search(r"(?:pol|p)[_\-]?(\d)", os.path.basename(fileName), re.IGNORECASE)
+  return (match.group(1) if match else "", fileName)
+
+
+def pairBeamformerFiles(fileNames):
+  """
+  Pair the beamformer files recorded with the same sync time whose
+  timestamp ranges overlap most, ordering each pair pol0, pol1.
+    Output:
+      pairs: list of (pol0, pol1) file names.
+      unpaired: files without a partner or with unreadable timestamps.
+  """
+  ranges = {}
+  unpaired = []
+  for fileName in fileNames:
+    timeRange = timestampRange(fileName)
+    if timeRange is None:
+      unpaired.append(fileName)
+    else:
+      ranges[fileName] = timeRange
+  candidates = []
+  names = sorted(ranges, key = lambda name: ranges[name])
+  for i, name0 in enumerate(names):
+    for name1 in names[i + 1:]:
+      sync0, first0, last0 = ranges[name0]
+      sync1, first1, last1 = ranges[name1]
+      if first1 > last0:
+        break # sorted by start, no later file overlaps name0
+      overlap = min(last0, last1) - max(first0, first1)
+      if sync0 == sync1 and overlap > 0:
+        candidates.append((overlap, name0, name1))
+  pairs = []
+  paired = set()
+  for overlap, name0, name1 in sorted(candidates, reverse = True):
+    if name0 not in paired and name1 not in paired:
+      paired.update([name0, name1])
+      pairs.append(tuple(sorted([name0, name1], key = _polarisationKey)))
+  unpaired.extend(name for name in names if name not in paired)
+  return sorted(pairs), sorted(unpaired)
+
+
+def diskOf(fileName):
+  """
+  Return the identifier of the device holding fileName.
+  """
+  return os.stat(fileName).st_dev
+
+
+def makeJobs(fileNames, outDirectory, h5Arguments = (), fitsArguments = (), pcapArguments = (), coresPerJob = 1):
+  """
+  Return the conversion jobs for the input files: a dictionary per job with
+  its name, command (script first), inputs, output, disks and cores.
+  Beamformer pairs are converted by fastH5.py with coresPerJob workers,
+  .fits/.sf files by PSRFITS2fil.py and .pcap files by preparePCAP.py.
+  """
+  h5Files = [name for name in fileNames if name.endswith((".h5", ".hdf5"))]
+  fitsFiles = [name for name in fileNames if name.endswith((".fits", ".sf"))]
+  pcapFiles = [name for name in fileNames if name.endswith(".pcap")]
+  pairs, unpaired = pairBeamformerFiles(h5Files)
+  for name in unpaired:
+    print ("No partner polarisation for %s, skipped.") % name
+  for name in sorted(set(fileNames) - set(h5Files) - set(fitsFiles) - set(pcapFiles)):
+    print ("Unknown file type %s, skipped.") % name
+  jobs = []
+  def output(fileName):
+    return os.path.join(outDirectory, os.path.splitext(os.path.basename(fileName))[0] + ".fil")
+  for (pol0, pol1) in pairs:
+    outFileName = output(pol0)
+    command = ["fastH5.py", "--raw0", pol0, "--raw1", pol1, "--out", outFileName, "--workers", str(coresPerJob)] + list(h5Arguments)
+    jobs.append({"name": os.path.basename(outFileName), "command": command, "inputs": [pol0, pol1], "output": outFileName, "cores": coresPerJob})
+  for fileName in fitsFiles:
+    outFileName = output(fileName)
+    command = ["PSRFITS2fil.py", "--file", fileName, "--out", outFileName] + list(fitsArguments)
+    jobs.append({"name": os.path.basename(outFileName), "command": command, "inputs": [fileName], "output": outFileName, "cores": 1})
+  for fileName in pcapFiles:
+    outFileName = output(fileName)
+    command = ["preparePCAP.py", "--raw", fileName, "--out", outFileName] + list(pcapArguments)
+    jobs.append({"name": os.path.basename(outFileName), "command": command, "inputs": [fileName], "output": outFileName, "cores": 1})
+  names = [job["name"] for job in jobs]
+  for job in jobs:
+    if names.count(job["name"]) > 1:
+      raise ValueError("Several inputs would be written to %s." % job["output"])
+    job["disks"] = sorted(set(diskOf(fileName) for fileName in job["inputs"]))
+    job["inputBytes"] = sum(os.path.getsize(fileName) for fileName in job["inputs"])
+    job["attempts"] = []
+  return jobs
+
+
+class Scheduler(object):
+  """
+  Run jobs concurrently while the cores in use stay within numberCores and
+  the jobs reading from any disk stay within readersPerDisk. Waiting jobs
+  are started in order, skipping those that do not fit, and among the
+  fitting ones the job reading the least busy disks goes first, so one
+  slow disk does not hold back the others. Failed jobs are queued again up
+  to retries times.
+  """
+
+  def __init__(self, jobs, numberCores, readersPerDisk, retries, logDirectory):
+    self.waiting = list(jobs)
+    self.numberCores = numberCores
+    self.readersPerDisk = readersPerDisk
+    self.retries = retries
+    self.logDirectory = logDirectory
+    self.coresInUse = 0
+    self.readers = {}
+    self.running = 0
+    self.finished = Queue.Queue()
+
+  def _fits(self, job):
+    if not self.running:
+      return True # nothing to wait for
+    if self.coresInUse + job["cores"] > self.numberCores:
+      return False
+    return all(self.readers.get(disk, 0) < self.readersPerDisk for disk in job["disks"])
+
+  def _next(self):
+    fitting = [job for job in self.waiting if self._fits(job)]
+    if not fitting:
+      return None
+    job = min(fitting, key = lambda job: max(self.readers.get(disk, 0) for disk in job["disks"]))
+    self.waiting.remove(job)
+    return job
+
+  def _run(self, job):
+    logFileName = os.path.join(self.logDirectory, "%s.%d.log" % (job["name"], len(job["attempts"])))
+    startTime = time.time()
+    try:
+      status, elapsed, peakMemory = converterRun.runConverter(job["command"], self.logDirectory, logFileName)
+      status = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    except OSError, error:
+      status, elapsed, peakMemory = -1, time.time() - startTime, 0
+      open(logFileName, "a").write("%s\n" % error)
+    if status == 0 and not os.path.exists(job["output"]):
+      status = -1 # the converters exit with 0 on bad options
+    self.finished.put((job, {"status": status, "seconds": elapsed, "peakRSS": peakMemory, "log": logFileName}))
+
+  def run(self):
+    """
+    Run all jobs and return them with their attempts.
+    """
+    done = []
+    while self.waiting or self.running:
+      job = self._next()
+      while job is not None:
+        self.coresInUse += job["cores"]
+        for disk in job["disks"]:
+          self.readers[disk] = self.readers.get(disk, 0) + 1
+        self.running += 1
+        print ("Starting %s (attempt %d)") % (job["name"], len(job["attempts"]) + 1)
+        worker = threading.Thread(target = self._run, args = (job,))
+        worker.daemon = True
+        worker.start()
+        job = self._next()
+      job, attempt = self.finished.get()
+      self.running -= 1
+      self.coresInUse -= job["cores"]
+      for disk in job["disks"]:
+        self.readers[disk] -= 1
+      job["attempts"].append(attempt)
+      if attempt["status"] == 0:
+        print ("Finished %s in %.1f s") % (job["name"], attempt["seconds"])
+        done.append(job)
+      elif len(job["attempts"]) <= self.retries:
+        print ("Failed %s (status %d), retrying, see %s") % (job["name"], attempt["status"], attempt["log"])
+        self.waiting.append(job)
+      else:
+        print ("Failed %s (status %d), giving up, see %s") % (job["name"], attempt["status"], attempt["log"])
+        done.append(job)
+    return done
+
+
+def writeReport(fileName, jobs, wallTime, numberCores, readersPerDisk):
+  """
+  Write the summary of the batch as JSON and print it as a table.
+  """
+  print ("%-40s %9s %9s %9s %8s  %s") % ("job", "seconds", "MB/s", "RSS MB", "attempts", "status")
+  for job in jobs:
+    last = job["attempts"][-1]
+    rate = job["inputBytes"] / 1024.0**2 / last["seconds"] if last["seconds"] > 0 else 0.0
+    print ("%-40s %9.1f %9.1f %9.1f %8d  %s") % (job["name"], last["seconds"], rate, last["peakRSS"] / 1024.0**2, len(job["attempts"]), "ok" if last["status"] == 0 else "FAILED")
+  totalBytes = sum(job["inputBytes"] for job in jobs)
+  failed = [job["name"] for job in jobs if job["attempts"][-1]["status"] != 0]
+  print ("Converted %d of %d jobs, %.1f GB in %.1f s (%.1f MB/s)") % (len(jobs) - len(failed), len(jobs), totalBytes / 1024.0**3, wallTime, totalBytes / 1024.0**2 / wallTime if wallTime > 0 else 0.0)
+  report = {"wallTime": wallTime, "cores": numberCores, "readersPerDisk": readersPerDisk, "inputBytes": totalBytes, "failed": failed,
+            "jobs": [dict((key, job[key]) for key in ["name", "command", "inputs", "output", "cores", "inputBytes", "attempts"]) for job in jobs]}
+  fileOut = open(fileName, "w")
+  json.dump(report, fileOut, indent = 1, sort_keys = True)
+  fileOut.close()
+  print ("Report written to %s") % fileName
+
+
+# Main body of the script
+if __name__=="__main__":
+  # Parsing the command line options
+  usage = "Usage: %prog [--manifest=\"files.txt\"] [--outdir=\"fil\"] \"<glob>\" [\"<glob>\" ...]"
+  cmdline = opt.OptionParser(usage)
+  cmdline.formatter.max_help_position = 100 # increase space reserved for option flags (default 24), trick to make the help more readable
+  cmdline.formatter.width = 250 # increase help width from 120 to 200
+  cmdline.add_option("--manifest", type = "string", dest = "manifestFileName", metavar = "<manifestFileName>", help = "Give file listing the inputs, one file name or glob per line.")
+  cmdline.add_option("--outdir", type = "string", dest = "outDirectory", metavar = "<outDirectory>", default = ".", help = "Give directory for the filterbank files, logs and report (default: current directory).")
+  cmdline.add_option("--cores", type = "int", dest = "numberCores", metavar = "<numberCores>", default = multiprocessing.cpu_count(), help = "Give number of cores used by all running conversions (default: all).")
+  cmdline.add_option("--job-workers", type = "int", dest = "coresPerJob", metavar = "<coresPerJob>", default = "1", help = "Give number of fastH5.py workers per beamformer pair (default: 1).")
+  cmdline.add_option("--readers", type = "int", dest = "readersPerDisk", metavar = "<readersPerDisk>", default = "2", help = "Give number of conversions reading from one disk at the same time (default: 2).")
+  cmdline.add_option("--retries", type = "int", dest = "retries", metavar = "<retries>", default = "1", help = "Give number of times a failed conversion is run again (default: 1).")
+  cmdline.add_option("--h5-args", type = "string", dest = "h5Arguments", metavar = "<h5Arguments>", default = "", help = "Give extra options for fastH5.py, e.g. \"--ndec 4 --nbits 8\".")
+  cmdline.add_option("--fits-args", type = "string", dest = "fitsArguments", metavar = "<fitsArguments>", default = "", help = "Give extra options for PSRFITS2fil.py.")
+  cmdline.add_option("--pcap-args", type = "string", dest = "pcapArguments", metavar = "<pcapArguments>", default = "", help = "Give extra options for preparePCAP.py.")
+  cmdline.add_option("--skip-existing", dest = "skipExisting", action = "store_true", help = "Do not convert inputs whose filterbank file already exists.")
+  cmdline.add_option("--report", type = "string", dest = "reportFileName", metavar = "<reportFileName>", default = "batch_report.json", help = "Give name of the report in outdir (default: batch_report.json).")
+  cmdline.add_option("--dry-run", dest = "dryRun", action = "store_true", help = "List the jobs without running them.")
+  (opts, args) = cmdline.parse_args() # reading cmd options
+
+  if not args and not opts.manifestFileName:
+    cmdline.print_usage()
+    sys.exit(0)
+  if opts.coresPerJob > opts.numberCores:
+    print ("job-workers cannot exceed cores.")
+    sys.exit(0)
+  if opts.readersPerDisk < 1:
+    print ("readers must be at least 1.")
+    sys.exit(0)
+  outDirectory = os.path.abspath(opts.outDirectory)
+  if not os.path.isdir(outDirectory):
+    os.makedirs(outDirectory)
+  fileNames = expandInputs(args, opts.manifestFileName)
+  jobs = makeJobs(fileNames, outDirectory, opts.h5Arguments.split(), opts.fitsArguments.split(), opts.pcapArguments.split(), opts.coresPerJob)
+  if opts.skipExisting:
+    for job in [job for job in jobs if os.path.exists(job["output"])]:
+      print ("Skipping %s, output exists.") % job["name"]
+      jobs.remove(job)
+  for job in jobs:
+    print ("%s: %s") % (job["name"], " ".join(job["command"]))
+  if opts.dryRun or not jobs:
+    sys.exit(0)
+
+  startTime = time.time()
+  scheduler = Scheduler(jobs, opts.numberCores, opts.readersPerDisk, opts.retries, outDirectory)
+  jobs = scheduler.run()
+  writeReport(os.path.join(outDirectory, opts.reportFileName), jobs, time.time() - startTime, opts.numberCores, opts.readersPerDisk)
@@ -0,0 +1,716 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 by Maciej Serylak
+# Licensed under the Academic Free License version 3.0
+# This program comes with ABSOLUTELY NO WARRANTY.
+# You are free to modify and redistribute this code as long
+# as you do not remove the above attribution and reasonably
+# inform recipients that you have modified the original work.
+
+# Helpers shared by the converters reading MeerKAT beamformer HDF5 files
+# (Data/bf_raw with shape (channels, time, 2) and Data/timestamps).
+
+import os
+import glob
+import time
+import Queue
+import threading
+import numpy as np
+import h5py
+
+# ADC samples between consecutive spectra in Data/timestamps.
+timestampStep = 8192
+
+
+def datasetLayout(fileName, datasetName = "Data/bf_raw", swmr = False):
+  """
+  Return the storage layout of a dataset.
+    Inputs:
+      fileName: HDF5 file name.
+      datasetName: dataset to inspect (default: Data/bf_raw).
+      swmr: open a file still being written in SWMR read mode.
+    Output:
+      layout: dictionary with shape, storage chunk shape (None if the
+              dataset is contiguous), compression and item size.
+  """
+  dataFile = openBeamformerFile(fileName, swmr = swmr)
+  dataset = dataFile[datasetName]
+  layout = {"shape": dataset.shape, "chunks": dataset.chunks, "compression": dataset.compression, "itemsize": dataset.dtype.itemsize}
+  if dataset.is_virtual:
+    # A capture concatenated by concatenateCapture() is stored like its first file.
+    source = dataset.virtual_sources()[0]
+    sourceFile = openBeamformerFile(source.file_name)
+    layout["chunks"] = sourceFile[source.dset_name].chunks
+    layout["compression"] = sourceFile[source.dset_name].compression
+    sourceFile.close()
+  dataFile.close()
+  return layout
+
+
+def spectraPerRead(layout, decimationFactor, requestedSize = None, defaultSize = 256):
+  """
+  Choose how many spectra to read at once.
+  The read span is the smallest multiple of decimationFactor (and, for a
+  chunked dataset, of the storage chunk length along time) not shorter than
+  the requested or default size, so output samples never straddle two reads
+  and consecutive reads never split a storage chunk.
+    Inputs:
+      layout: dictionary from datasetLayout().
+      decimationFactor: number of spectra averaged into one output sample.
+      requestedSize: read span given by the user, rounded up if needed.
+      defaultSize: read span aimed at (default: 256).
+    Output:
+      chunkSize: number of spectra per read.
+  """
+  step = decimationFactor
+  if layout["chunks"] is not None:
+    step = layout["chunks"][1]
+    while step % decimationFactor:
+      step += layout["chunks"][1]
+  if requestedSize:
+    size = requestedSize
+  elif decimationFactor > defaultSize:
+    size = 2 * decimationFactor
+  else:
+    size = defaultSize
+  chunkSize = step * max(1, -(-size // step))
+  if requestedSize and chunkSize != requestedSize:
+    print ("Read span of %d spectra rounded up to %d, a multiple of the decimation factor%s.") % (requestedSize, chunkSize, "" if layout["chunks"] is None else " and of the storage chunk")
+  return chunkSize
+
+
+def _nextPrime(number):
+  number = max(number, 2)
+  while any(number % divisor == 0 for divisor in range(2, int(number**0.5) + 1)):
+    number += 1
+  return number
+
+
+def chunkCacheSettings(layout, chunkSize, channels = None):
+  """
+  Size the HDF5 raw-data chunk cache to hold every storage chunk touched by
+  one read span plus the time stripe shared with the previous span, so each
+  storage chunk is read and decompressed only once.
+    Inputs:
+      layout: dictionary from datasetLayout().
+      chunkSize: number of spectra per read.
+      channels: (first, end) channels read, None for all of them.
+    Output:
+      cacheBytes, cacheSlots: values for rdcc_nbytes and rdcc_nslots.
+  """
+  if layout["chunks"] is None:
+    return 1024**2, 521 # HDF5 defaults, a contiguous dataset bypasses the cache
+  chunks = layout["chunks"]
+  chunkBytes = int(np.prod(chunks)) * layout["itemsize"]
+  if channels is None:
+    channels = (0, layout["shape"][0])
+  chunksAlongChannels = (channels[1] - 1) // chunks[0] - channels[0] // chunks[0] + 1
+  stripes = -(-chunkSize // chunks[1]) + 1
+  cacheChunks = chunksAlongChannels * stripes
+  return cacheChunks * chunkBytes, _nextPrime(100 * cacheChunks)
+
+
+def openBeamformerFile(fileName, cacheBytes = None, cacheSlots = None, swmr = False):
+  """
+  Open a beamformer HDF5 file read-only with the given chunk cache.
+  Fully read storage chunks are evicted first (rdcc_w0 = 1).
+  With swmr the file is opened in SWMR read mode, so a file still being
+  written can be read and its datasets refreshed as they grow.
+  """
+  options = {}
+  if cacheBytes is not None:
+    options = {"rdcc_nbytes": cacheBytes, "rdcc_nslots": cacheSlots, "rdcc_w0": 1.0}
+  if swmr:
+    return h5py.File(fileName, "r", libver = "latest", swmr = True, **options)
+  return h5py.File(fileName, "r", **options)
+
+
+def writerActive(fileName):
+  """
+  Return True while a writer has the HDF5 file open, from the file
+  consistency flags of a version 2 or 3 superblock (set by a writer,
+  cleared when it closes the file). Older superblocks have no flags and
+  cannot be written in SWMR mode, so they are taken as complete.
+  """
+  fileIn = open(fileName, "rb")
+  superblock = fileIn.read(12)
+  fileIn.close()
+  if len(superblock) < 12 or superblock[:8] != "\x89HDF\r\n\x1a\n" or ord(superblock[8]) < 2:
+    return False
+  return (ord(superblock[11]) & 0x05) != 0 # write or SWMR write access
+
+
+def waitForSpectra(fileNames, pollInterval = 1.0, timeout = None):
+  """
+  Wait until the beamformer files exist and hold spectra overlapping in
+  time, for captures that are still starting. Returns False if that did not
+  happen within timeout seconds.
+  """
+  startTime = time.time()
+  while True:
+    try:
+      ranges = []
+      for fileName in fileNames:
+        dataFile = openBeamformerFile(fileName, swmr = True)
+        numberSpectra = min(dataFile["Data/bf_raw"].shape[1], dataFile["Data/timestamps"].shape[0])
+        if numberSpectra > 0:
+          ranges.append((int(dataFile["Data/timestamps"][0]), int(dataFile["Data/timestamps"][numberSpectra - 1])))
+        dataFile.close()
+      if len(ranges) == len(fileNames) and max(first for (first, last) in ranges) <= min(last for (first, last) in ranges):
+        return True
+    except (IOError, KeyError):
+      pass # not created yet
+    if timeout is not None and time.time() - startTime > timeout:
+      return False
+    time.sleep(pollInterval)
+
+
+def captureFiles(fileNames):
+  """
+  Return the files of one polarisation given as a comma-separated list of
+  file names and glob patterns (each pattern expanded in sorted order).
+  """
+  files = []
+  for name in fileNames.split(","):
+    matches = sorted(glob.glob(name))
+    files.extend(matches if matches else [name])
+  return files
+
+
+def concatenateCapture(fileNames, virtualFileName):
+  """
+  Present a capture split across several beamformer files as a single
+  file: virtualFileName gets Data/bf_raw and Data/timestamps as HDF5
+  virtual datasets mapping the spectra of every file in timestamp order,
+  and the TelescopeModel/cbf attributes of the first file. Nothing is
+  copied, the spectra are read from the original files.
+  At every file boundary the timestamps are checked for continuity: gaps
+  are reported (and found again by TimestampIndex, so --fill handles them),
+  spectra repeated by the next file are left out of the view.
+    Inputs:
+      fileNames: beamformer files of one polarisation.
+      virtualFileName: file to write the concatenated view to.
+    Output:
+      fileName: virtualFileName, or the only file if there is just one.
+  """
+  if len(fileNames) == 1:
+    return fileNames[0]
+  parts = []
+  for fileName in fileNames:
+    dataFile = openBeamformerFile(fileName)
+    numberSpectra = min(dataFile["Data/bf_raw"].shape[1], dataFile["Data/timestamps"].shape[0])
+    if numberSpectra > 0:
+      parts.append({"fileName": os.path.abspath(fileName), "shape": dataFile["Data/bf_raw"].shape, "dtype": dataFile["Data/bf_raw"].dtype,
+                    "timestampType": dataFile["Data/timestamps"].dtype, "timestampShape": dataFile["Data/timestamps"].shape, "numberSpectra": numberSpectra,
+                    "first": int(dataFile["Data/timestamps"][0]), "last": int(dataFile["Data/timestamps"][numberSpectra - 1]),
+                    "attributes": dict(dataFile["TelescopeModel/cbf"].attrs) if "TelescopeModel/cbf" in dataFile else {}})
+    else:
+      print ("%s holds no spectra, skipping it.") % fileName
+    dataFile.close()
+  if not parts:
+    raise ValueError("No spectra in %s." % ", ".join(fileNames))
+  parts.sort(key = lambda part: part["first"])
+  for part in parts[1:]:
+    if part["shape"][0] != parts[0]["shape"][0] or part["dtype"] != parts[0]["dtype"]:
+      raise ValueError("%s does not have the channels and sample type of %s." % (part["fileName"], parts[0]["fileName"]))
+    if part["attributes"].get("sync_time") != parts[0]["attributes"].get("sync_time"):
+      raise ValueError("%s does not have the sync time of %s." % (part["fileName"], parts[0]["fileName"]))
+  # Spectra of each file in the view: skip the ones the previous file already has.
+  previous = None
+  for part in parts:
+    part["skip"] = 0
+    if previous is not None:
+      jump = part["first"] - previous["last"]
+      if jump % timestampStep:
+        raise ValueError("Timestamps of %s are not on the grid of %s." % (part["fileName"], previous["fileName"]))
+      if jump > timestampStep:
+        print ("Gap of %d spectra between %s and %s.") % (jump // timestampStep - 1, previous["fileName"], part["fileName"])
+      elif jump <= 0:
+        part["skip"] = min(part["numberSpectra"], 1 - jump // timestampStep)
+        print ("%s repeats %d spectra of %s, leaving them out.") % (part["fileName"], part["skip"], previous["fileName"])
+    if part["skip"] < part["numberSpectra"]:
+      previous = part
+  parts = [part for part in parts if part["skip"] < part["numberSpectra"]]
+  totalSpectra = sum(part["numberSpectra"] - part["skip"] for part in parts)
+  spectraLayout = h5py.VirtualLayout((parts[0]["shape"][0], totalSpectra) + parts[0]["shape"][2:], parts[0]["dtype"])
+  timestampLayout = h5py.VirtualLayout((totalSpectra,), parts[0]["timestampType"])
+  position = 0
+  for part in parts:
+    count = part["numberSpectra"] - part["skip"]
+    spectraSource = h5py.VirtualSource(part["fileName"], "Data/bf_raw", part["shape"])
+    timestampSource = h5py.VirtualSource(part["fileName"], "Data/timestamps", part["timestampShape"])
+    spectraLayout[:, position:position + count] = spectraSource[:, part["skip"]:part["skip"] + count]
+    timestampLayout[position:position + count] = timestampSource[part["skip"]:part["skip"] + count]
+    position += count
+  virtualFile = h5py.File(virtualFileName, "w", libver = "latest")
+  virtualFile.create_virtual_dataset("Data/bf_raw", spectraLayout, fillvalue = 0)
+  virtualFile.create_virtual_dataset("Data/timestamps", timestampLayout, fillvalue = 0)
+  cbf = virtualFile.create_group("TelescopeModel/cbf")
+  for key, value in parts[0]["attributes"].items():
+    cbf.attrs[key] = value
+  virtualFile.close()
+  print ("Concatenated %d files, %d spectra, into %s") % (len(parts), totalSpectra, virtualFileName)
+  return virtualFileName
+
+
+class ContiguousSpectra(object):
+  """
+  Spectra of both polarisations taken as gapless from the given start indices.
+  Output sample s is spectrum startIndex + s of each file.
+  """
+  def __init__(self, startIndexPol0, startIndexPol1):
+    self.startIndices = (startIndexPol0, startIndexPol1)
+
+  def locate(self, pol, s0, s1):
+    startIndex = self.startIndices[pol]
+    return startIndex + s0, startIndex + s1, None
+
+  def valid(self, s0, s1):
+    return None
+
+
+class TimestampIndex(object):
+  """
+  Compact model of a monotonic Data/timestamps dataset: a list of segments
+  in which the timestamp grows by exactly one step per spectrum.
+  The segments are found by bisection, reading only the two ends of ever
+  smaller ranges until they are consistent with a constant step, so the
+  cost grows with the number of discontinuities and the logarithm of the
+  length instead of with the length itself. A lost spectrum hidden by a
+  repeated one in the same range is not detected.
+    Inputs:
+      dataset: Data/timestamps dataset (or array).
+      step: ADC samples between consecutive spectra (default: timestampStep).
+      blockSize: ranges up to this length are read whole (default: 4096).
+  """
+  def __init__(self, dataset, step = timestampStep, blockSize = 4096):
+    self.step = step
+    self.size = dataset.shape[0]
+    values = {}
+    def value(index):
+      if index not in values:
+        values[index] = int(dataset[index])
+      return values[index]
+    discontinuities = []
+    ranges = [(0, self.size - 1)]
+    while ranges:
+      a, b = ranges.pop()
+      if b <= a or value(b) - value(a) == (b - a) * step:
+        continue
+      if b - a <= blockSize:
+        block = dataset[a:b + 1].astype(np.int64)
+        for j in np.flatnonzero(np.diff(block) != step):
+          discontinuities.append((a + j + 1, int(block[j + 1] - block[j]) // step - 1))
+      else:
+        mid = (a + b) // 2
+        ranges.append((mid, b))
+        ranges.append((a, mid))
+    discontinuities.sort()
+    self.discontinuities = discontinuities
+    self.segmentIndices = np.array([0] + [index for (index, jump) in discontinuities], np.int64)
+    self.segmentTimestamps = np.array([value(index) for index in self.segmentIndices], np.int64)
+    self.first = value(0)
+    self.last = value(self.size - 1)
+
+  def timestamps(self, i0, i1):
+    """
+    Return the timestamps of spectra i0..i1 without reading them.
+    """
+    indices = np.arange(i0, i1, dtype = np.int64)
+    segments = np.searchsorted(self.segmentIndices, indices, "right") - 1
+    return self.segmentTimestamps[segments] + (indices - self.segmentIndices[segments]) * self.step
+
+  def search(self, value, side = "left"):
+    """
+    Index of the first spectrum with timestamp >= value (side "left")
+    or > value (side "right"), like np.searchsorted.
+    """
+    segment = np.searchsorted(self.segmentTimestamps, value, "right") - 1
+    if segment < 0:
+      return 0
+    segmentEnd = self.segmentIndices[segment + 1] if segment + 1 < self.segmentIndices.size else self.size
+    offset = value - self.segmentTimestamps[segment]
+    if side == "left":
+      index = self.segmentIndices[segment] + -(-offset // self.step)
+    else:
+      index = self.segmentIndices[segment] + offset // self.step + 1
+    return int(min(index, segmentEnd))
+
+
+def alignTimestamps(indexPol0, indexPol1):
+  """
+  Find the common time range of both polarisations.
+  The first and last timestamps present in both files are found by
+  binary search, so a spectrum missing at either end of one file does not
+  need an exact match.
+    Inputs:
+      indexPol0, indexPol1: TimestampIndex of each polarisation.
+    Output:
+      overlap: dictionary with startADC, endADC and the start and
+               (exclusive) end index of the overlap in each file.
+  """
+  indices = (indexPol0, indexPol1)
+  startADC = max(indexPol0.first, indexPol1.first)
+  while True:
+    starts = [index.search(startADC) for index in indices]
+    if starts[0] >= indexPol0.size or starts[1] >= indexPol1.size:
+      raise ValueError("Polarisations do not overlap in time.")
+    values = [int(index.timestamps(start, start + 1)[0]) for (index, start) in zip(indices, starts)]
+    if values[0] == values[1]:
+      break
+    startADC = max(values)
+  endADC = min(indexPol0.last, indexPol1.last)
+  while True:
+    ends = [index.search(endADC, "right") for index in indices]
+    values = [int(index.timestamps(end - 1, end)[0]) for (index, end) in zip(indices, ends)]
+    if values[0] == values[1]:
+      break
+    endADC = min(values)
+  if endADC < startADC:
+    raise ValueError("Polarisations do not overlap in time.")
+  return {"startADC": startADC, "endADC": endADC,
+          "startIndexPol0": starts[0], "startIndexPol1": starts[1],
+          "endIndexPol0": ends[0], "endIndexPol1": ends[1]}
+
+
+class SpectrumSlots(object):
+  """
+  Map every ADC timestamp of both polarisations to its output slot,
+  (timestamp - startADC) / timestampStep, so spectra lost in either
+  polarisation leave empty slots instead of shifting all later samples.
+    Inputs:
+      indexPol0, indexPol1: TimestampIndex of each polarisation.
+      overlap: dictionary from alignTimestamps().
+  """
+  def __init__(self, indexPol0, indexPol1, overlap):
+    self.indices = (indexPol0, indexPol1)
+    self.step = indexPol0.step
+    self.startADC = overlap["startADC"]
+    self.numberSlots = int((overlap["endADC"] - overlap["startADC"]) // self.step) + 1
+
+  def locate(self, pol, s0, s1):
+    """
+    Return the index range i0..i1 of spectra falling in slots s0..s1 and
+    their slot positions relative to s0 (None if no slot is empty).
+    """
+    index = self.indices[pol]
+    i0 = index.search(self.startADC + s0 * self.step)
+    i1 = index.search(self.startADC + s1 * self.step)
+    if i1 - i0 == s1 - s0:
+      segments = np.searchsorted(index.segmentIndices, [i0, i1 - 1], "right")
+      if segments[0] == segments[1]:
+        return i0, i1, None
+    slots = ((index.timestamps(i0, i1) - self.startADC) // self.step).astype(np.intp) - s0
+    return i0, i1, slots
+
+  def valid(self, s0, s1):
+    """
+    Return which slots s0..s1 hold a spectrum in both polarisations,
+    or None if all of them do.
+    """
+    present = np.ones((2, s1 - s0), bool)
+    for pol in (0, 1):
+      i0, i1, slots = self.locate(pol, s0, s1)
+      if slots is not None:
+        present[pol] = False
+        present[pol, slots] = True
+    present = present.all(axis = 0)
+    if present.all():
+      return None
+    return present
+
+
+def channelSelection(numberChannels, channelRange = None, frequencyRange = None, freqBottom = 0.0, channelBW = 1.0, fscrunch = 1):
+  """
+  Return the (first, end) channels to convert, end exclusive.
+    Inputs:
+      numberChannels: number of channels in the files.
+      channelRange: (first, end) channels, takes precedence over frequencyRange.
+      frequencyRange: (low, high) frequencies in MHz, channels whose centre
+                      frequency lies in the range are selected.
+      freqBottom, channelBW: centre frequency of channel 0 and channel width.
+      fscrunch: number of channels added into one output channel, the
+                selection is shortened to a multiple of it.
+  """
+  if channelRange is not None:
+    first, end = channelRange
+  elif frequencyRange is not None:
+    low, high = sorted(frequencyRange)
+    first = int(np.ceil((low - freqBottom) / channelBW))
+    end = int(np.floor((high - freqBottom) / channelBW)) + 1
+  else:
+    first, end = 0, numberChannels
+  first = max(0, first)
+  end = min(numberChannels, end)
+  end = first + max(0, end - first) // fscrunch * fscrunch
+  if end <= first:
+    raise ValueError("No channels selected.")
+  return first, end
+
+
+def readSpectra(dataset, spectra, pol, s0, s1, out, channels = None):
+  """
+  Read output slots s0..s1 of one polarisation into out[:, :s1 - s0, :],
+  only the (first, end) channels if channels is given.
+  Slots without a spectrum are set to zero.
+  """
+  if channels is None:
+    channels = (0, dataset.shape[0])
+  i0, i1, slots = spectra.locate(pol, s0, s1)
+  if slots is None:
+    dataset.read_direct(out, np.s_[channels[0]:channels[1], i0:i1, :], np.s_[:, 0:s1 - s0, :])
+  else:
+    out[:, :s1 - s0, :] = 0
+    if i1 > i0:
+      out[:, slots, :] = dataset[channels[0]:channels[1], i0:i1, :]
+
+
+def fillGaps(output, valid, decimationFactor, fillMode):
+  """
+  Repair detected samples whose decimation window had missing spectra.
+  Partly empty windows are rescaled to the mean of the spectra present.
+  Empty windows are set to zero ("zero"), to the mean of the other samples
+  in the chunk ("mean") or to the nearest earlier sample in the chunk,
+  or the first one if the chunk starts with a gap ("previous"). Only the
+  current chunk is used, so the result does not depend on how the
+  observation is split between workers.
+    Inputs:
+      output: detected chunk with shape (time, pol, chan), modified in place.
+      valid: per-spectrum validity from valid(), None if nothing is missing.
+      decimationFactor: number of spectra averaged into one sample.
+      fillMode: "zero", "mean" or "previous".
+    Output:
+      filled: indices of the samples that were rescaled or filled.
+  """
+  if valid is None:
+    return np.zeros(0, np.intp)
+  present = valid.reshape(-1, decimationFactor).sum(axis = 1)
+  partial = (present > 0) & (present < decimationFactor)
+  output[partial] *= (np.float32(decimationFactor) / present[partial]).astype(output.dtype)[:, None, None]
+  empty = present == 0
+  if empty.any():
+    complete = np.flatnonzero(~empty)
+    if fillMode == "zero" or complete.size == 0:
+      output[empty] = 0
+    elif fillMode == "mean":
+      output[empty] = output[complete].mean(axis = 0)
+    elif fillMode == "previous":
+      nearest = np.where(empty, -1, np.arange(empty.size))
+      nearest = np.maximum.accumulate(nearest)
+      nearest[nearest < 0] = complete[0]
+      output[empty] = output[nearest[empty]]
+    else:
+      raise ValueError("Unknown fill mode: %s" % fillMode)
+  return np.flatnonzero(present < decimationFactor)
+
+
+def writeMask(fileName, samples):
+  """
+  Write the filled output samples as "firstSample numberSamples" ranges.
+  """
+  samples = np.unique(samples)
+  fileMask = open(fileName, "w")
+  fileMask.write("# Filled output samples: firstSample numberSamples\n")
+  if samples.size:
+    breaks = np.flatnonzero(np.diff(samples) != 1) + 1
+    for run in np.split(samples, breaks):
+      fileMask.write("%d %d\n" % (run[0], run.size))
+  fileMask.close()
+
+
+def powerSums(spectraChunkPol0, spectraChunkPol1):
+  """
+  Return the (channels, 4) sums of power and of squared power of the
+  polarisation 0 and 1 spectra (channels, time, 2), in that order.
+  """
+  sums = np.empty((spectraChunkPol0.shape[0], 4), np.float64)
+  for pol, spectraChunk in enumerate((spectraChunkPol0, spectraChunkPol1)):
+    power = spectraChunk[:, :, 0].astype(np.float64)**2 + spectraChunk[:, :, 1].astype(np.float64)**2
+    sums[:, 2 * pol] = power.sum(axis = 1)
+    sums[:, 2 * pol + 1] = (power * power).sum(axis = 1)
+  return sums
+
+
+def spectralKurtosis(powerSums, numberSpectra):
+  """
+  Return the (channels, 2) generalised spectral kurtosis estimator of each
+  polarisation from the sums of numberSpectra power samples.
+  Gaussian noise gives 1 with a standard deviation of about 2/sqrt(numberSpectra).
+  """
+  M = float(max(numberSpectra, 2))
+  s1 = powerSums[:, 0::2]
+  s2 = powerSums[:, 1::2]
+  sk = np.ones(s1.shape)
+  nonzero = s1 > 0
+  sk[nonzero] = (M + 1) / (M - 1) * (M * s2[nonzero] / s1[nonzero]**2 - 1)
+  return sk
+
+
+def exciseRFI(output, powerSums, numberSpectra, skSigma, fscrunch = 1):
+  """
+  Flag the output channels of a detected chunk where the spectral kurtosis
+  of any input channel, in either polarisation, is more than skSigma
+  standard deviations from 1, and replace them with the mean of the
+  unflagged channels of the same sample and IF. Only the current chunk is
+  used, so the result does not depend on how the observation is split
+  between workers.
+    Inputs:
+      output: detected chunk with shape (time, pol, chan), modified in place.
+      powerSums: (input channels, 4) sums from powerSums().
+      numberSpectra: number of spectra present in the chunk.
+      skSigma: flagging threshold in standard deviations.
+      fscrunch: number of input channels added into one output channel.
+    Output:
+      flagged: indices of the flagged output channels.
+  """
+  sk = spectralKurtosis(powerSums, numberSpectra)
+  outlier = np.abs(sk - 1) > skSigma * 2.0 / np.sqrt(max(numberSpectra, 1))
+  outlier = outlier.any(axis = 1).reshape(-1, fscrunch).any(axis = 1)
+  flagged = np.flatnonzero(outlier)
+  if flagged.size == outlier.size:
+    output[:] = 0
+  elif flagged.size:
+    output[:, :, flagged] = output[:, :, ~outlier].mean(axis = 2)[:, :, None]
+  return flagged
+
+
+def writeRFIMask(fileName, blocks):
+  """
+  Write the channel-blocks flagged by exciseRFI() as
+  "firstSample numberSamples channel channel ..." lines.
+  """
+  fileMask = open(fileName, "w")
+  fileMask.write("# Flagged channel-blocks: firstSample numberSamples channels\n")
+  for firstSample, numberSamples, channels in sorted(blocks, key = lambda block: block[0]):
+    fileMask.write("%d %d %s\n" % (firstSample, numberSamples, " ".join("%d" % channel for channel in channels)))
+  fileMask.close()
+
+
+class ChunkPrefetcher(object):
+  """
+  Read chunks of Data/bf_raw from both polarisations on a background thread.
+    Inputs:
+      datasetPol0, datasetPol1: Data/bf_raw datasets.
+      chunks: list of (t0, t1) output slot ranges.
+      spectra: ContiguousSpectra or SpectrumSlots locating the slots in the files.
+      stageTimes: perfMetrics.Metrics collecting the read stage timing.
+      numberBuffers: number of preallocated buffer pairs (default: 2).
+      channels: (first, end) channels read, None for all of them.
+    Iterating yields (t0, t1, spectraChunkPol0, spectraChunkPol1, valid). The
+    buffers are reused, a chunk is only valid until the next one is requested.
+  """
+  def __init__(self, datasetPol0, datasetPol1, chunks, spectra, stageTimes, numberBuffers = 2, channels = None):
+    self.datasets = (datasetPol0, datasetPol1)
+    self.spectra = spectra
+    if channels is None:
+      channels = (0, datasetPol0.shape[0])
+    self.channels = channels
+    self.chunks = chunks
+    self.stageTimes = stageTimes
+    maxChunk = max([t1 - t0 for (t0, t1) in chunks] + [1])
+    self.freeBuffers = Queue.Queue()
+    for i in range(numberBuffers):
+      self.freeBuffers.put(tuple(np.empty((channels[1] - channels[0], maxChunk, dataset.shape[2]), dataset.dtype) for dataset in self.datasets))
+    self.filledBuffers = Queue.Queue()
+    self.thread = threading.Thread(target = self._read)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _read(self):
+    try:
+      for (t0, t1) in self.chunks:
+        stallStart = time.time()
+        buffers = self.freeBuffers.get()
+        readStart = time.time()
+        for pol in (0, 1):
+          readSpectra(self.datasets[pol], self.spectra, pol, t0, t1, buffers[pol], self.channels)
+        valid = self.spectra.valid(t0, t1)
+        self.stageTimes.add("read", busy = time.time() - readStart, stalled = readStart - stallStart)
+        self.filledBuffers.put((t0, t1, buffers, valid))
+    except Exception as error:
+      self.filledBuffers.put(error)
+    self.filledBuffers.put(None)
+
+  def __iter__(self):
+    previous = None
+    while True:
+      if previous is not None:
+        self.freeBuffers.put(previous)
+      stallStart = time.time()
+      item = self.filledBuffers.get()
+      self.stageTimes.add("compute", stalled = time.time() - stallStart)
+      if item is None:
+        break
+      if isinstance(item, Exception):
+        raise item
+      t0, t1, previous, valid = item
+      yield t0, t1, previous[0][:, :t1 - t0, :], previous[1][:, :t1 - t0, :], valid
+    self.thread.join()
+
+
+class BackgroundWriter(object):
+  """
+  Write arrays to a filterbank.FilterbankSink on a background thread,
+  in submission order.
+    Inputs:
+      sink: FilterbankSink receiving the output samples.
+      stageTimes: perfMetrics.Metrics collecting the write stage timing.
+      bufferShape: if given, shape of the reusable output buffers handed
+                   out by buffer() (default: no buffer pool).
+      dtype: type of the output buffers (default: float32).
+      queueDepth: number of arrays allowed to wait for the disk (default: 2).
+  """
+  def __init__(self, sink, stageTimes, bufferShape = None, dtype = np.float32, queueDepth = 2):
+    self.sink = sink
+    self.stageTimes = stageTimes
+    self.pending = Queue.Queue(queueDepth)
+    self.freeBuffers = Queue.Queue()
+    if bufferShape is not None:
+      for i in range(queueDepth + 2):
+        self.freeBuffers.put(np.empty(bufferShape, dtype))
+    self.error = None
+    self.thread = threading.Thread(target = self._write)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _write(self):
+    while True:
+      stallStart = time.time()
+      item = self.pending.get()
+      writeStart = time.time()
+      if item is None:
+        break
+      sample, data, buffer = item
+      try:
+        self.sink.write(sample, data)
+      except Exception as error:
+        self.error = error
+      if buffer is not None:
+        self.freeBuffers.put(buffer)
+      self.stageTimes.add("write", busy = time.time() - writeStart, stalled = writeStart - stallStart)
+
+  def buffer(self):
+    """
+    Return a free output buffer, waiting for the disk if none is left.
+    """
+    stallStart = time.time()
+    buffer = self.freeBuffers.get()
+    self.stageTimes.add("compute", stalled = time.time() - stallStart)
+    return buffer
+
+  def write(self, sample, data, buffer = None):
+    """
+    Queue data for writing at output sample sample. If data is a view of
+    a pool buffer, pass the buffer too so it is recycled once written.
+    """
+    if self.error is not None:
+      raise self.error
+    stallStart = time.time()
+    self.pending.put((sample, data, buffer))
+    self.stageTimes.add("compute", stalled = time.time() - stallStart)
+
+  def close(self):
+    self.pending.put(None)
+    self.thread.join()
+    if self.error is not None:
+      raise self.error
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 by Maciej Serylak
+# Licensed under the Academic Free License version 3.0
+# This program comes with ABSOLUTELY NO WARRANTY.
+# You are free to modify and redistribute this code as long
+# as you do not remove the above attribution and reasonably
+# inform recipients that you have modified the original work.
+
+# End-to-end benchmark of the converters on synthetic inputs: throughput,
+# peak memory and a checksum of the output, compared with a stored baseline.
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import multiprocessing
+import optparse as opt
+import syntheticData
+import converterRun
+
+
+def benchmarkCases(scale = 1.0):
+  """
+  Return the benchmark cases as dictionaries with the case name, the
+  generators of the inputs (file name, function, keyword arguments), the
+  converter command line, the output files and the number of input spectra.
+  A case with sameAs must give the same output as the case named by it.
+  """
+  h5Spectra = int(16384 * scale)
+  fitsSubints = int(32 * scale)
+  numberWorkers = multiprocessing.cpu_count()
+  h5Inputs = [("pol0.h5", syntheticData.beamformerH5, {"numberSpectra": h5Spectra, "seed": 0}),
+              ("pol1.h5", syntheticData.beamformerH5, {"numberSpectra": h5Spectra, "seed": 1})]
+  # NaN scales in a few channels over subints that start the requantisation
+  # window of some workers but not of others.
+  nanInputs = [("nan.fits", syntheticData.psrfitsSearch, {"numberSubints": fitsSubints, "nanSubints": range(fitsSubints // 4, fitsSubints // 4 + 3), "nanChannels": (0, 100, 513)})]
+  cases = [{"name": "fastH5", "inputs": h5Inputs, "spectra": h5Spectra,
+            "command": ["fastH5.py", "--raw0", "pol0.h5", "--raw1", "pol1.h5", "--ndec", "4", "--out", "fastH5.fil"], "outputs": ["fastH5.fil"]},
+           {"name": "fastH5-pol", "inputs": h5Inputs, "spectra": h5Spectra,
+            "command": ["fastH5.py", "--raw0", "pol0.h5", "--raw1", "pol1.h5", "--ndec", "4", "--pol", "--out", "fastH5-pol.fil"], "outputs": ["fastH5-pol.fil"]},
+           {"name": "fastH5-workers", "inputs": h5Inputs, "spectra": h5Spectra,
+            "command": ["fastH5.py", "--raw0", "pol0.h5", "--raw1", "pol1.h5", "--ndec", "4", "--workers", str(numberWorkers), "--out", "fastH5-workers.fil"], "outputs": ["fastH5-workers.fil"]},
+           {"name": "prepareH5", "inputs": h5Inputs, "spectra": h5Spectra,
+            "command": ["prepareH5.py", "--raw0", "pol0.h5", "--raw1", "pol1.h5", "--ndec", "4", "--out", "prepareH5.fil"], "outputs": ["prepareH5.fil"]},
+           {"name": "PSRFITS2fil", "spectra": fitsSubints * 1024,
+            "inputs": [("search.fits", syntheticData.psrfitsSearch, {"numberSubints": fitsSubints})],
+            "command": ["PSRFITS2fil.py", "--file", "search.fits", "--out", "PSRFITS2fil.fil"], "outputs": ["PSRFITS2fil.fil"]},
+           {"name": "PSRFITS2fil-2bit", "spectra": fitsSubints * 1024,
+            "inputs": [("search2bit.fits", syntheticData.psrfitsSearch, {"numberSubints": fitsSubints, "nbits": 2})],
+            "command": ["PSRFITS2fil.py", "--file", "search2bit.fits", "--out", "PSRFITS2fil-2bit.fil"], "outputs": ["PSRFITS2fil-2bit.fil"]},
+           {"name": "PSRFITS2fil-nan", "spectra": fitsSubints * 1024, "inputs": nanInputs,
+            "command": ["PSRFITS2fil.py", "--file", "nan.fits", "--nBit", "8", "--block", "4", "--window", "3", "--out", "PSRFITS2fil-nan.fil"], "outputs": ["PSRFITS2fil-nan.fil"]},
+           {"name": "PSRFITS2fil-nan-workers", "spectra": fitsSubints * 1024, "inputs": nanInputs, "sameAs": "PSRFITS2fil-nan",
+            "command": ["PSRFITS2fil.py", "--file", "nan.fits", "--nBit", "8", "--block", "4", "--window", "3", "--workers", "2", "--out", "PSRFITS2fil-nan-workers.fil"], "outputs": ["PSRFITS2fil-nan-workers.fil"]},
+           {"name": "preparePCAP", "spectra": int(8192 * scale),
+            "inputs": [("capture.pcap", syntheticData.pcap, {"numberPackets": int(8192 * scale)})],
+            "command": ["preparePCAP.py", "--raw", "capture.pcap", "--out", "preparePCAP.fil"], "outputs": ["preparePCAP.fil"]},
+           {"name": "prepareFeng", "spectra": int(32768 * scale),
+            "inputs": [("fengine.dat", syntheticData.fengine, {"numberSpectra": int(32768 * scale)})],
+            "command": ["prepareFeng.py", "--raw", "fengine.dat", "--out", "prepareFeng.fil"], "outputs": ["prepareFeng.fil"]},
+           {"name": "prepareICBF", "spectra": int(8192 * scale),
+            "inputs": [("icbf.dada", syntheticData.dada, {"numberSpectra": int(8192 * scale)})],
+            "command": ["prepareICBF.py", "--raw", "icbf.dada", "--out", "prepareICBF.fil"], "outputs": ["prepareICBF.fil"]}]
+  return cases
+
+
+def checksum(fileNames):
+  """
+  Return the MD5 digest of the concatenated files.
+  """
+  digest = hashlib.md5()
+  for fileName in fileNames:
+    fileIn = open(fileName, "rb")
+    while True:
+      block = fileIn.read(16 * 1024**2)
+      if not block:
+        break
+      digest.update(block)
+    fileIn.close()
+  return digest.hexdigest()
+
+
+def compareBaseline(result, baseline, tolerance):
+  """
+  Return the status of a result against its baseline entry: ok, FASTER,
+  SLOWER (by more than tolerance), OUTPUT CHANGED or FAILED.
+  """
+  if result["status"] != 0:
+    return "FAILED"
+  if baseline is None:
+    return "new"
+  if result["md5"] != baseline["md5"]:
+    return "OUTPUT CHANGED"
+  if result["seconds"] > baseline["seconds"] * (1.0 + tolerance):
+    return "SLOWER (%.0f%%)" % (100.0 * (result["seconds"] / baseline["seconds"] - 1.0))
+  if result["seconds"] < baseline["seconds"] * (1.0 - tolerance):
+    return "FASTER (%.0f%%)" % (100.0 * (1.0 - result["seconds"] / baseline["seconds"]))
+  return "ok"
+
+
+# Main body of the script
+if __name__=="__main__":
+  # Parsing the command line options
+  usage = "Usage: %prog [--cases=fastH5,prepareH5] [--baseline=\"baseline.json\"] [--save]"
+  cmdline = opt.OptionParser(usage)
+  cmdline.formatter.max_help_position = 100 # increase space reserved for option flags (default 24), trick to make the help more readable
+  cmdline.formatter.width = 250 # increase help width from 120 to 200
+  cmdline.add_option("--cases", type = "string", dest = "cases", metavar = "<cases>", help = "Give comma-separated names of the cases to run (default: all).")
+  cmdline.add_option("--scale", type = "float", dest = "scale", metavar = "<scale>", default = "1.0", help = "Give factor multiplying the size of the synthetic inputs (default: 1).")
+  cmdline.add_option("--repeat", type = "int", dest = "repeat", metavar = "<repeat>", default = "1", help = "Give number of runs of each case, the fastest is kept (default: 1).")
+  cmdline.add_option("--dir", type = "string", dest = "workDirectory", metavar = "<workDirectory>", help = "Give directory for the inputs and outputs, kept afterwards (default: temporary directory).")
+  cmdline.add_option("--baseline", type = "string", dest = "baselineFileName", metavar = "<baselineFileName>", default = "benchmark_baseline.json", help = "Give baseline file (default: benchmark_baseline.json).")
+  cmdline.add_option("--save", dest = "saveBaseline", action = "store_true", help = "Store the results as the new baseline.")
+  cmdline.add_option("--tolerance", type = "float", dest = "tolerance", metavar = "<tolerance>", default = "0.1", help = "Give relative change of the run time reported as slower or faster (default: 0.1).")
+  cmdline.add_option("--list", dest = "listCases", action = "store_true", help = "List the cases and exit.")
+  (opts, args) = cmdline.parse_args() # reading cmd options
+
+  cases = benchmarkCases(opts.scale)
+  if opts.listCases:
+    for case in cases:
+      print ("%-24s %s") % (case["name"], " ".join(case["command"]))
+    sys.exit(0)
+  if opts.cases:
+    names = opts.cases.split(",")
+    cases = [case for case in cases if case["name"] in names]
+  try:
+    baseline = json.load(open(opts.baselineFileName))
+  except (IOError, ValueError):
+    baseline = {}
+  if baseline.get("scale", opts.scale) != opts.scale:
+    print ("Baseline made with scale %g, not comparing.") % baseline["scale"]
+    baseline = {}
+
+  workDirectory = opts.workDirectory or tempfile.mkdtemp(prefix = "benchmark")
+  if not os.path.isdir(workDirectory):
+    os.makedirs(workDirectory)
+  print ("workDirectory: %s") % workDirectory
+  results = {}
+  generated = {}
+  mismatches = []
+  print ("%-24s %9s %9s %12s %9s  %s") % ("case", "seconds", "MB/s", "spectra/s", "RSS MB", "status")
+  for case in cases:
+    inputBytes = 0
+    for (fileName, generator, arguments) in case["inputs"]:
+      if fileName not in generated:
+        generated[fileName] = generator(os.path.join(workDirectory, fileName), **arguments)
+      inputBytes += os.path.getsize(os.path.join(workDirectory, fileName))
+    best = None
+    for run in range(max(1, opts.repeat)):
+      status, elapsed, peakMemory = converterRun.runConverter(case["command"], workDirectory, os.path.join(workDirectory, case["name"] + ".log"))
+      if best is None or elapsed < best[1]:
+        best = (status, elapsed, peakMemory)
+    status, elapsed, peakMemory = best
+    outputs = [os.path.join(workDirectory, fileName) for fileName in case["outputs"]]
+    result = {"status": status, "seconds": elapsed, "MBps": inputBytes / 1024.0**2 / elapsed, "spectraps": case["spectra"] / elapsed,
+              "peakRSS": peakMemory, "md5": checksum(outputs) if all(os.path.exists(fileName) for fileName in outputs) else None}
+    results[case["name"]] = result
+    status = compareBaseline(result, baseline.get("cases", {}).get(case["name"]), opts.tolerance)
+    if case.get("sameAs") in results and result["md5"] != results[case["sameAs"]]["md5"]:
+      status = "DIFFERS FROM %s" % case["sameAs"]
+      mismatches.append(case["name"])
+    print ("%-24s %9.2f %9.1f %12.0f %9.1f  %s") % (case["name"], elapsed, result["MBps"], result["spectraps"], peakMemory / 1024.0**2, status)
+
+  if opts.saveBaseline:
+    baseline = {"scale": opts.scale, "python": sys.version.split()[0], "cases": dict(baseline.get("cases", {}), **results)}
+    fileOut = open(opts.baselineFileName, "w")
+    json.dump(baseline, fileOut, indent = 1, sort_keys = True)
+    fileOut.close()
+    print ("Baseline written to %s") % opts.baselineFileName
+  if not opts.workDirectory:
+    shutil.rmtree(workDirectory)
+  if mismatches:
+    sys.exit(1)
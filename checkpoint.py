@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 by Maciej Serylak
+# Licensed under the Academic Free License version 3.0
+# This program comes with ABSOLUTELY NO WARRANTY.
+# You are free to modify and redistribute this code as long
+# as you do not remove the above attribution and reasonably
+# inform recipients that you have modified the original work.
+
+# Checkpoints of conversions into a preallocated output, so that a run
+# killed part way can be resumed from the last input range known to be
+# on disk instead of from the start.
+
+import os
+import json
+import time
+
+
+def checkpointFileName(outFileName):
+  """
+  Return the name of the checkpoint kept next to the output.
+  """
+  return outFileName + ".checkpoint"
+
+
+def _normalise(value):
+  # Compare settings as they come back from JSON (tuples become lists).
+  return json.loads(json.dumps(value))
+
+
+class Checkpoint(object):
+  """
+  Progress of a conversion: the input ranges [start, end) whose output is
+  on disk, each with the side results of the range (e.g. filled samples
+  or RFI flags) needed to finish the conversion. The checkpoint is saved
+  as JSON, replaced atomically, and belongs to the settings it was made
+  with.
+    Inputs:
+      fileName: checkpoint file name.
+      settings: dictionary of everything that determines the output, a
+                checkpoint made with other settings is not resumed.
+      interval: seconds between saves (default: 60).
+  """
+  def __init__(self, fileName, settings, interval = 60.0):
+    self.fileName = fileName
+    self.settings = _normalise(settings)
+    self.interval = interval
+    self.ranges = {}
+    self.lastSave = time.time()
+
+  def load(self):
+    """
+    Read the checkpoint from disk.
+      Output:
+        found: False if there is no checkpoint.
+    Raises ValueError if the checkpoint was made with other settings.
+    """
+    if not os.path.exists(self.fileName):
+      return False
+    fileIn = open(self.fileName)
+    try:
+      stored = json.load(fileIn)
+    except ValueError:
+      raise ValueError("%s is not a readable checkpoint." % self.fileName)
+    finally:
+      fileIn.close()
+    if stored.get("settings") != self.settings:
+      changed = sorted(key for key in set(self.settings) | set(stored.get("settings", {})) if self.settings.get(key) != stored.get("settings", {}).get(key))
+      raise ValueError("%s was made with different settings: %s." % (self.fileName, ", ".join(changed)))
+    self.ranges = dict((int(start), (int(end), results)) for start, end, results in stored["ranges"])
+    return True
+
+  def record(self, start, end, results = None):
+    """
+    Record that the output of input start..end is on disk. A range
+    already recorded with the same start is extended.
+    """
+    self.ranges[start] = (end, results)
+
+  def done(self):
+    """
+    Return the recorded ranges as sorted (start, end, results).
+    """
+    return [(start, self.ranges[start][0], self.ranges[start][1]) for start in sorted(self.ranges)]
+
+  def remaining(self, end):
+    """
+    Return the ranges of 0..end not recorded yet, as sorted (start, end).
+    """
+    missing = []
+    position = 0
+    for start, stop, results in self.done():
+      if start > position:
+        missing.append((position, min(start, end)))
+      position = max(position, stop)
+    if position < end:
+      missing.append((position, end))
+    return [span for span in missing if span[1] > span[0]]
+
+  def due(self):
+    """
+    Return True if interval seconds have passed since the last save.
+    """
+    return time.time() - self.lastSave >= self.interval
+
+  def save(self):
+    stored = {"settings": self.settings, "ranges": [[start, end, results] for start, end, results in self.done()], "time": time.time()}
+    temporaryName = "%s.%d" % (self.fileName, os.getpid())
+    fileOut = open(temporaryName, "w")
+    json.dump(stored, fileOut)
+    fileOut.flush()
+    os.fsync(fileOut.fileno())
+    fileOut.close()
+    os.rename(temporaryName, self.fileName) # a crash leaves the previous checkpoint
+    self.lastSave = time.time()
+
+  def remove(self):
+    """
+    Delete the checkpoint once the conversion has finished.
+    """
+    if os.path.exists(self.fileName):
+      os.remove(self.fileName)
+
+
+def outputMatches(fileName, headerBytes, size):
+  """
+  Check that a partial output has the header and size of the output
+  being resumed.
+    Output:
+      problem: description of the mismatch, None if the output matches.
+  """
+  if not os.path.exists(fileName):
+    return "%s does not exist." % fileName
+  if os.path.getsize(fileName) != size:
+    return "%s has %d bytes instead of %d." % (fileName, os.path.getsize(fileName), size)
+  fileIn = open(fileName, "rb")
+  fileHeader = fileIn.read(len(headerBytes))
+  fileIn.close()
+  if fileHeader != headerBytes:
+    return "The header of %s differs from the one of this conversion." % fileName
+  return None
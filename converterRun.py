@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 by Maciej Serylak
+# Licensed under the Academic Free License version 3.0
+# This program comes with ABSOLUTELY NO WARRANTY.
+# You are free to modify and redistribute this code as long
+# as you do not remove the above attribution and reasonably
+# inform recipients that you have modified the original work.
+
+# Running a converter script as a child process, with its output in a log
+# file, for benchmark.py and batchConvert.py.
+
+import os
+import sys
+import time
+import subprocess
+
+scriptDirectory = os.path.dirname(os.path.abspath(__file__))
+
+
+def runConverter(command, workDirectory, logFileName):
+  """
+  Run a converter script in workDirectory and return the exit status,
+  wall-clock seconds and peak resident memory in bytes.
+  """
+  logFile = open(logFileName, "w")
+  startTime = time.time()
+  process = subprocess.Popen([sys.executable, os.path.join(scriptDirectory, command[0])] + command[1:], cwd = workDirectory, stdout = logFile, stderr = subprocess.STDOUT)
+  pid, status, usage = os.wait4(process.pid, 0)
+  elapsed = time.time() - startTime
+  process.returncode = status
+  logFile.close()
+  return status, elapsed, usage.ru_maxrss * 1024 # kilobytes on Linux
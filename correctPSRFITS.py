@@ -12,6 +12,7 @@ import argparse
 import time
 import astropy.io.fits as pyfits
 from astropy.time import Time
+import psrfits
 
 __version__ = 1.1
 
@@ -79,30 +80,8 @@ if __name__=="__main__":
   startTime = Time(hduPrimary["STT_IMJD"] + ((hduPrimary["STT_SMJD"] + hduPrimary["STT_OFFS"]) / 86400.0), format = "mjd", precision = 9)
   startTime.format = "isot"
   startTime = startTime.value
-  hduPrimary["TELESCOP"] = "MeerKAT"
-  hduPrimary["FRONTEND"] = "L-band"
-  hduPrimary["RA"] = rightAscension
-  hduPrimary["DEC"] = declination
-  hduPrimary["STT_CRD1"] = rightAscension
-  hduPrimary["STT_CRD2"] = declination
-  hduPrimary["STP_CRD1"] = rightAscension
-  hduPrimary["STP_CRD2"] = declination
-  hduPrimary["TRK_MODE"] = "TRACK"
-  hduPrimary["OBS_MODE"] = "SEARCH"
-  hduPrimary["TCYCLE"] = 0
-  hduPrimary["ANT_X"] = 5109318.8410
-  hduPrimary["ANT_Y"] = 2006836.3673
-  hduPrimary["ANT_Z"] = -3238921.7749
-  hduPrimary["NRCVR"] = 2
-  hduPrimary["BACKEND"]="KAT"
-  hduPrimary["CAL_MODE"] = "OFF"
-  hduPrimary["CAL_FREQ"] = 0.0
-  hduPrimary["CAL_DCYC"] = 0.0
-  hduPrimary["CAL_PHS"] = 0.0
-  hduPrimary["CAL_NPHS"]=0.0
-  hduPrimary["CHAN_DM"] = 0.0
-  hduPrimary["DATE-OBS"] = startTime
-  hduPrimary["DATE"] = startTime
+  for key, value in psrfits.meerkatValues + psrfits.pointingValues(rightAscension, declination, startTime):
+    hduPrimary[key] = value
   hduSubint["NPOL"] = nPolarisations
   hduSubint["POL_TYPE"] = polarisationType
   hduSubint["NCHNOFFS"] = 0
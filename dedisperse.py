@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 by Maciej Serylak
+# Licensed under the Academic Free License version 3.0
+# This program comes with ABSOLUTELY NO WARRANTY.
+# You are free to modify and redistribute this code as long
+# as you do not remove the above attribution and reasonably
+# inform recipients that you have modified the original work.
+
+# Incoherent dedispersion of SIGPROC filterbank data at many trial DMs
+# with the subband algorithm, writing one SIGPROC .tim series per DM.
+# Dedisperser can also be fed spectra directly by the converter scripts.
+
+import sys
+import time
+import optparse as opt
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from numba import jit
+import filterbank
+
+# Dispersion constant in MHz^2 pc^-1 cm^3 s.
+dispersionConstant = 4.148808e3
+
+
+@jit(nopython=True, nogil=True)
+def _formSubbands(data, subbandEdges, delays, out):
+  # data (channels, time), out (subbands, time)
+  for s in range(out.shape[0]):
+    for t in range(out.shape[1]):
+      out[s, t] = 0.0
+    for c in range(subbandEdges[s], subbandEdges[s + 1]):
+      delay = delays[c]
+      for t in range(out.shape[1]):
+        out[s, t] += data[c, t + delay]
+
+@jit(nopython=True, nogil=True)
+def _sumSubbands(subbands, delays, out):
+  # subbands (subbands, time), out (time)
+  for t in range(out.shape[0]):
+    out[t] = 0.0
+  for s in range(subbands.shape[0]):
+    delay = delays[s]
+    for t in range(out.shape[0]):
+      out[t] += subbands[s, t + delay]
+
+
+def dispersionDelays(frequencies, dm, samplingTime, referenceFrequency):
+  """
+  Return the dispersion delays in samples of frequencies (MHz) relative
+  to referenceFrequency, rounded to the nearest sample.
+  """
+  frequencies = np.asarray(frequencies, np.float64)
+  delays = dispersionConstant * dm * (frequencies**-2 - referenceFrequency**-2) / samplingTime
+  return np.round(delays).astype(np.intp)
+
+
+def dmTrials(dmStart, dmEnd, dmStep = None, frequencies = None, samplingTime = None):
+  """
+  Return the list of trial DMs from dmStart to dmEnd (included).
+  Without dmStep the step is the DM whose delay across the band is one
+  sample.
+  """
+  if dmStep is None:
+    sweep = dispersionConstant * (np.min(frequencies)**-2 - np.max(frequencies)**-2)
+    dmStep = samplingTime / sweep
+  numberTrials = int(np.floor((dmEnd - dmStart) / dmStep + 1e-9)) + 1
+  return dmStart + dmStep * np.arange(max(numberTrials, 1))
+
+
+class SubbandPlan(object):
+  """
+  Subband dedispersion plan. The channels are split into numberSubbands
+  contiguous subbands. Trial DMs are grouped so that within a group the
+  subbands can be formed once at the nominal DM of the group with less
+  than half a sample of extra smearing, then every trial of the group is
+  a shift-and-add of the subbands only.
+    Inputs:
+      frequencies: centre frequency of every channel in MHz.
+      samplingTime: sampling time in seconds.
+      dms: trial DMs.
+      numberSubbands: number of subbands (default: 32).
+  """
+  def __init__(self, frequencies, samplingTime, dms, numberSubbands = 32):
+    frequencies = np.asarray(frequencies, np.float64)
+    numberChannels = frequencies.size
+    numberSubbands = max(1, min(numberSubbands, numberChannels))
+    self.dms = np.sort(np.asarray(dms, np.float64))
+    self.subbandEdges = np.array([(s * numberChannels) // numberSubbands for s in range(numberSubbands + 1)], np.intp)
+    topFrequency = frequencies.max()
+    subbandFrequencies = np.array([frequencies[self.subbandEdges[s]:self.subbandEdges[s + 1]].max() for s in range(numberSubbands)])
+    # Largest delay across a single subband per unit DM.
+    sweep = max(dispersionConstant * (frequencies[self.subbandEdges[s]:self.subbandEdges[s + 1]].min()**-2 - subbandFrequencies[s]**-2) for s in range(numberSubbands))
+    groupWidth = samplingTime / sweep if sweep > 0 else np.inf
+    self.groups = []
+    first = 0
+    while first < self.dms.size:
+      last = first
+      while last + 1 < self.dms.size and self.dms[last + 1] - self.dms[first] <= groupWidth:
+        last += 1
+      nominalDM = 0.5 * (self.dms[first] + self.dms[last])
+      channelDelays = np.concatenate([dispersionDelays(frequencies[self.subbandEdges[s]:self.subbandEdges[s + 1]], nominalDM, samplingTime, subbandFrequencies[s]) for s in range(numberSubbands)])
+      trialDelays = [dispersionDelays(subbandFrequencies, dm, samplingTime, topFrequency) for dm in self.dms[first:last + 1]]
+      self.groups.append({"nominalDM": nominalDM, "trials": range(first, last + 1), "channelDelays": channelDelays, "trialDelays": trialDelays,
+                          "maxDelay": channelDelays.max() + max(delays.max() for delays in trialDelays)})
+      first = last + 1
+    self.maxDelay = max(group["maxDelay"] for group in self.groups)
+
+
+def timHeader(header, dm):
+  """
+  Return the packed SIGPROC header of the time series at dm, with the
+  observation keys taken from the filterbank header dictionary.
+  """
+  frequencies = header["fch1"] + header["foff"] * np.arange(header["nchans"])
+  parameters = [(key, header[key]) for key in ("source_name", "machine_id", "telescope_id", "src_raj", "src_dej", "tstart", "tsamp") if key in header]
+  parameters += [("data_type", 2), ("fch1", frequencies.max()), ("nchans", 1), ("nbits", 32), ("nifs", 1), ("refdm", dm)]
+  return filterbank.makeHeader(parameters)
+
+
+class Dedisperser(object):
+  """
+  Streaming subband dedisperser. Spectra are fed in time order, in blocks
+  of any length, and dedispersed every blockSize samples; the last
+  maxDelay samples of each block are kept as the overlap with the next one,
+  so memory does not depend on the length of the observation. Every trial
+  DM is written to its own preallocated .tim file.
+    Inputs:
+      header: filterbank header dictionary (fch1, foff, nchans, tsamp, ...).
+      dms: trial DMs.
+      outPrefix: output files are outPrefix_DM<dm>.tim.
+      numberSamples: number of spectra that will be fed.
+      numberSubbands: number of subbands (default: 32).
+      numberThreads: number of threads dedispersing (default: 1).
+      blockSize: number of output samples per block (default: 65536).
+      ifIndex: IF dedispersed when the spectra have several (default: 0).
+  """
+  def __init__(self, header, dms, outPrefix, numberSamples, numberSubbands = 32, numberThreads = 1, blockSize = 65536, ifIndex = 0):
+    frequencies = header["fch1"] + header["foff"] * np.arange(header["nchans"])
+    self.plan = SubbandPlan(frequencies, header["tsamp"], dms, numberSubbands)
+    self.dms = self.plan.dms
+    self.maxDelay = self.plan.maxDelay
+    self.numberOutput = numberSamples - self.maxDelay
+    if self.numberOutput <= 0:
+      raise ValueError("Data shorter than the dispersion delay at DM %.2f (%d samples)." % (self.dms[-1], self.maxDelay))
+    self.ifIndex = ifIndex
+    self.buffer = np.zeros((header["nchans"], blockSize + self.maxDelay), np.float32)
+    self.bufferFill = 0
+    self.outputSample = 0
+    self.fileNames = ["%s_DM%.2f.tim" % (outPrefix, dm) for dm in self.dms]
+    self.sinks = [filterbank.FilterbankSink(fileName, timHeader(header, dm), self.numberOutput, 1, 1) for fileName, dm in zip(self.fileNames, self.dms)]
+    self.numberThreads = max(1, numberThreads)
+    self.pool = ThreadPool(self.numberThreads) if self.numberThreads > 1 else None
+    self.busy = 0.0
+
+  def _map(self, function, tasks):
+    if self.pool is None:
+      return [function(task) for task in tasks]
+    return self.pool.map(function, tasks)
+
+  def _dedisperseBlock(self, length):
+    numberOutput = min(length - self.maxDelay, self.numberOutput - self.outputSample)
+    if numberOutput <= 0:
+      return
+    blockStart = time.time()
+    data = self.buffer[:, :length]
+    groups = self.plan.groups
+    # Subbands of at most numberThreads groups are held at once.
+    for g0 in range(0, len(groups), self.numberThreads):
+      batch = groups[g0:g0 + self.numberThreads]
+      def formSubbands(group):
+        subbands = np.empty((len(self.plan.subbandEdges) - 1, length - group["channelDelays"].max()), np.float32)
+        _formSubbands(data, self.plan.subbandEdges, group["channelDelays"], subbands)
+        return subbands
+      subbands = self._map(formSubbands, batch)
+      trials = [(i, trial, delays) for i, group in enumerate(batch) for trial, delays in zip(group["trials"], group["trialDelays"])]
+      def sumSubbands(trialSlice):
+        for i, trial, delays in trialSlice:
+          output = np.asarray(self.sinks[trial].data[self.outputSample:self.outputSample + numberOutput, 0, 0])
+          _sumSubbands(subbands[i], delays, output)
+      self._map(sumSubbands, [trials[k::self.numberThreads] for k in range(self.numberThreads)])
+    self.outputSample += numberOutput
+    self.busy += time.time() - blockStart
+
+  def feed(self, spectra):
+    """
+    Add spectra (time, IFs, channels) or (time, channels) following the
+    ones already fed.
+    """
+    spectra = np.asarray(spectra)
+    if spectra.ndim == 3:
+      spectra = spectra[:, self.ifIndex]
+    while spectra.shape[0]:
+      count = min(spectra.shape[0], self.buffer.shape[1] - self.bufferFill)
+      self.buffer[:, self.bufferFill:self.bufferFill + count] = spectra[:count].T
+      self.bufferFill += count
+      spectra = spectra[count:]
+      if self.bufferFill == self.buffer.shape[1]:
+        self._dedisperseBlock(self.bufferFill)
+        self.buffer[:, :self.maxDelay] = self.buffer[:, self.bufferFill - self.maxDelay:self.bufferFill]
+        self.bufferFill = self.maxDelay
+
+  def close(self):
+    """
+    Dedisperse the spectra left in the buffer and close the output files.
+    """
+    if self.bufferFill > self.maxDelay:
+      self._dedisperseBlock(self.bufferFill)
+    self.bufferFill = 0
+    if self.pool is not None:
+      self.pool.close()
+      self.pool.join()
+    for sink in self.sinks:
+      sink.close()
+
+  def report(self):
+    print ("Dedispersed %d samples at %d DMs (%d subband groups, maxDelay %d samples) in %.2f s") % (self.outputSample, self.dms.size, len(self.plan.groups), self.maxDelay, self.busy)
+
+
+# Main body of the script
+if __name__=="__main__":
+
+  # Parsing the command line options
+  usage = "Usage: %prog --fil=\"input.fil\" --dm-range 0 100 --out=\"prefix\""
+  cmdline = opt.OptionParser(usage)
+  cmdline.formatter.max_help_position = 100 # increase space reserved for option flags (default 24), trick to make the help more readable
+  cmdline.formatter.width = 250 # increase help width from 120 to 200
+  cmdline.add_option("--fil", type = "string", dest = "filFileName", metavar = "<filFileName>", help = "Give input filterbank filename.")
+  cmdline.add_option("--out", type = "string", dest = "outPrefix", metavar = "<outPrefix>", help = "Give prefix of the output .tim files (default: input name without .fil).")
+  cmdline.add_option("--dm-range", type = "float", nargs = 2, dest = "dmRange", metavar = "<dmStart> <dmEnd>", help = "Give range of trial DMs.")
+  cmdline.add_option("--dm-step", type = "float", dest = "dmStep", metavar = "<dmStep>", help = "Give step between trial DMs (default: one sample of delay across the band).")
+  cmdline.add_option("--subbands", type = "int", dest = "numberSubbands", metavar = "<numberSubbands>", default = "32", help = "Give number of subbands (default: 32).")
+  cmdline.add_option("--block", type = "int", dest = "blockSize", metavar = "<blockSize>", default = "65536", help = "Give number of samples dedispersed at once (default: 65536).")
+  cmdline.add_option("--threads", type = "int", dest = "numberThreads", metavar = "<numberThreads>", default = "1", help = "Give number of threads dedispersing in parallel.")
+  cmdline.add_option("--if", type = "int", dest = "ifIndex", metavar = "<ifIndex>", default = "0", help = "Give IF to dedisperse, 0 is Stokes I (default: 0).")
+
+  (opts, args) = cmdline.parse_args() # reading cmd options
+  if not opts.filFileName or not opts.dmRange:
+    cmdline.print_usage()
+    sys.exit(0)
+  outPrefix = opts.outPrefix
+  if not outPrefix:
+    outPrefix = opts.filFileName[:-4] if opts.filFileName.endswith(".fil") else opts.filFileName
+
+  reader = filterbank.FilterbankReader(opts.filFileName)
+  print ("numberSamples: %d, nchans: %d, tsamp: %g s") % (reader.numberSamples, reader.numberChannels, reader.header["tsamp"])
+  dms = dmTrials(opts.dmRange[0], opts.dmRange[1], opts.dmStep, reader.frequencies(), reader.header["tsamp"])
+  print ("Trial DMs: %d from %.3f to %.3f") % (dms.size, dms[0], dms[-1])
+  try:
+    dedisperser = Dedisperser(reader.header, dms, outPrefix, reader.numberSamples, opts.numberSubbands, opts.numberThreads, opts.blockSize, opts.ifIndex)
+  except ValueError as error:
+    print error
+    sys.exit(0)
+  for first, block in reader.blocks(opts.blockSize):
+    dedisperser.feed(block)
+  dedisperser.close()
+  dedisperser.report()
+  reader.close()
@@ -12,69 +12,568 @@
 import numpy as np
 import h5py
 import os
-import struct
 import sys
 import ephem
 import katpoint
-#import time
+import time
 #import datetime
 import optparse as opt
+import multiprocessing
+import beamformerH5
+import filterbank
+import requantise
+import dedisperse
+import autotune
+import perfMetrics
+import checkpoint
 import numba
 from numba import jit
 
-# Functions used in SIGPROC header creation
-def _write_string(key, value):
-  return "".join([struct.pack("I", len(key)), key, struct.pack("I", len(value)), value])
+@jit(nopython=True, nogil=True)
+def _to_stokesI(x, y, decimationFactor, fscrunch, out):
+  for i in range(out.shape[1]):
+    for j in range(out.shape[0]):
+      s = np.float32(0)
+      for c in range(i * fscrunch, (i + 1) * fscrunch):
+        for k in range(j * decimationFactor, (j + 1) * decimationFactor):
+          x_r = np.float32(x[c, k, 0])
+          x_i = np.float32(x[c, k, 1])
+          y_r = np.float32(y[c, k, 0])
+          y_i = np.float32(y[c, k, 1])
+          s += x_r * x_r + x_i * x_i + y_r * y_r + y_i * y_i
+      out[j, i] = s / (decimationFactor * fscrunch)
 
-def _write_int(key, value):
-  return "".join([struct.pack("I",len(key)), key, struct.pack("I", value)])
+def to_stokesI(x, y, decimationFactor, out = None, fscrunch = 1):
+  if out is None:
+    out = np.zeros((x.shape[1] // decimationFactor, x.shape[0] // fscrunch), np.float32)
+  _to_stokesI(x, y, decimationFactor, fscrunch, out)
+  return out
 
-def _write_double(key, value):
-  return "".join([struct.pack("I",len(key)), key, struct.pack("d", value)])
+@jit(nopython=True, nogil=True)
+def _to_stokes(x, y, decimationFactor, fscrunch, out):
+  for i in range(out.shape[2]):
+    for j in range(out.shape[0]):
+      sI = np.float32(0)
+      sQ = np.float32(0)
+      sU = np.float32(0)
+      sV = np.float32(0)
+      for c in range(i * fscrunch, (i + 1) * fscrunch):
+        for k in range(j * decimationFactor, (j + 1) * decimationFactor):
+          x_r = np.float32(x[c, k, 0])
+          x_i = np.float32(x[c, k, 1])
+          y_r = np.float32(y[c, k, 0])
+          y_i = np.float32(y[c, k, 1])
+          xx = x_r * x_r + x_i * x_i
+          yy = y_r * y_r + y_i * y_i
+          xy_r = x_r * y_r + x_i * y_i
+          xy_i = x_i * y_r - x_r * y_i
+          sI += xx + yy
+          sQ += xx - yy
+          sU += 2 * xy_r
+          sV += 2 * xy_i
+      out[j, 0, i] = sI / (decimationFactor * fscrunch)
+      out[j, 1, i] = sQ / (decimationFactor * fscrunch)
+      out[j, 2, i] = sU / (decimationFactor * fscrunch)
+      out[j, 3, i] = sV / (decimationFactor * fscrunch)
 
-def _write_char(key, value):
-  return "".join([struct.pack("I",len(key)), key, struct.pack("b", value)])
+def to_stokes(x, y, decimationFactor, out = None, fscrunch = 1):
+  """
+  Form full Stokes averaged over decimationFactor spectra and fscrunch
+  channels, written straight into SIGPROC (time, pol, chan) order.
+  """
+  if out is None:
+    out = np.empty((x.shape[1] // decimationFactor, 4, x.shape[0] // fscrunch), np.float32)
+  _to_stokes(x, y, decimationFactor, fscrunch, out)
+  return out
 
-@jit(nopython=True)
-def _to_stokesI(x, y, decimationFactor, out):
+@jit(nopython=True, nogil=True)
+def _to_stokesI_sk(x, y, decimationFactor, fscrunch, out, powerSums):
   for i in range(out.shape[1]):
     for j in range(out.shape[0]):
       s = np.float32(0)
-      for k in range(j * decimationFactor, (j + 1) * decimationFactor):
-        x_r = np.float32(x[i, k, 0])
-        x_i = np.float32(x[i, k, 1])
-        y_r = np.float32(y[i, k, 0])
-        y_i = np.float32(y[i, k, 1])
-        s += x_r * x_r + x_i * x_i + y_r * y_r + y_i * y_i
-      out[j, i] = s / decimationFactor
-
-def to_stokesI(x, y, decimationFactor):
-  out = np.zeros((x.shape[1] // decimationFactor, x.shape[0]), np.float32)
-  _to_stokesI(x, y, decimationFactor, out)
+      for c in range(i * fscrunch, (i + 1) * fscrunch):
+        for k in range(j * decimationFactor, (j + 1) * decimationFactor):
+          x_r = np.float32(x[c, k, 0])
+          x_i = np.float32(x[c, k, 1])
+          y_r = np.float32(y[c, k, 0])
+          y_i = np.float32(y[c, k, 1])
+          xx = x_r * x_r + x_i * x_i
+          yy = y_r * y_r + y_i * y_i
+          s += xx + yy
+          powerSums[c, 0] += xx
+          powerSums[c, 1] += np.float64(xx) * xx
+          powerSums[c, 2] += yy
+          powerSums[c, 3] += np.float64(yy) * yy
+      out[j, i] = s / (decimationFactor * fscrunch)
+
+@jit(nopython=True, nogil=True)
+def _to_stokes_sk(x, y, decimationFactor, fscrunch, out, powerSums):
+  for i in range(out.shape[2]):
+    for j in range(out.shape[0]):
+      sI = np.float32(0)
+      sQ = np.float32(0)
+      sU = np.float32(0)
+      sV = np.float32(0)
+      for c in range(i * fscrunch, (i + 1) * fscrunch):
+        for k in range(j * decimationFactor, (j + 1) * decimationFactor):
+          x_r = np.float32(x[c, k, 0])
+          x_i = np.float32(x[c, k, 1])
+          y_r = np.float32(y[c, k, 0])
+          y_i = np.float32(y[c, k, 1])
+          xx = x_r * x_r + x_i * x_i
+          yy = y_r * y_r + y_i * y_i
+          xy_r = x_r * y_r + x_i * y_i
+          xy_i = x_i * y_r - x_r * y_i
+          sI += xx + yy
+          sQ += xx - yy
+          sU += 2 * xy_r
+          sV += 2 * xy_i
+          powerSums[c, 0] += xx
+          powerSums[c, 1] += np.float64(xx) * xx
+          powerSums[c, 2] += yy
+          powerSums[c, 3] += np.float64(yy) * yy
+      out[j, 0, i] = sI / (decimationFactor * fscrunch)
+      out[j, 1, i] = sQ / (decimationFactor * fscrunch)
+      out[j, 2, i] = sU / (decimationFactor * fscrunch)
+      out[j, 3, i] = sV / (decimationFactor * fscrunch)
+
+def detect_sk(x, y, decimationFactor, fullStokes, out, powerSums, fscrunch = 1):
+  """
+  Detect like detect() and, in the same pass over the voltages, add the
+  power and squared power of every input channel and polarisation to
+  powerSums (channels, 4) for the spectral kurtosis.
+  """
+  if fullStokes:
+    _to_stokes_sk(x, y, decimationFactor, fscrunch, out, powerSums)
+  else:
+    _to_stokesI_sk(x, y, decimationFactor, fscrunch, out[:, 0, :], powerSums)
+  return out
+
+@jit(nopython=True, nogil=True)
+def _quantise(value, scale, offset, maxValue, clipCounts):
+  level = np.floor(value * scale + offset + np.float32(0.5))
+  if level < 0:
+    clipCounts[0] += 1
+    return np.float32(0)
+  if level > maxValue:
+    clipCounts[1] += 1
+    return maxValue
+  return level
+
+@jit(nopython=True, nogil=True)
+def _to_stokesI_quantised(x, y, decimationFactor, fscrunch, scale, offset, maxValue, out, clipCounts):
+  for i in range(out.shape[1]):
+    for j in range(out.shape[0]):
+      s = np.float32(0)
+      for c in range(i * fscrunch, (i + 1) * fscrunch):
+        for k in range(j * decimationFactor, (j + 1) * decimationFactor):
+          x_r = np.float32(x[c, k, 0])
+          x_i = np.float32(x[c, k, 1])
+          y_r = np.float32(y[c, k, 0])
+          y_i = np.float32(y[c, k, 1])
+          s += x_r * x_r + x_i * x_i + y_r * y_r + y_i * y_i
+      out[j, i] = _quantise(np.float32(s / (decimationFactor * fscrunch)), scale[0, i], offset[0, i], maxValue, clipCounts)
+
+@jit(nopython=True, nogil=True)
+def _to_stokes_quantised(x, y, decimationFactor, fscrunch, scale, offset, maxValue, out, clipCounts):
+  for i in range(out.shape[2]):
+    for j in range(out.shape[0]):
+      sI = np.float32(0)
+      sQ = np.float32(0)
+      sU = np.float32(0)
+      sV = np.float32(0)
+      for c in range(i * fscrunch, (i + 1) * fscrunch):
+        for k in range(j * decimationFactor, (j + 1) * decimationFactor):
+          x_r = np.float32(x[c, k, 0])
+          x_i = np.float32(x[c, k, 1])
+          y_r = np.float32(y[c, k, 0])
+          y_i = np.float32(y[c, k, 1])
+          xx = x_r * x_r + x_i * x_i
+          yy = y_r * y_r + y_i * y_i
+          xy_r = x_r * y_r + x_i * y_i
+          xy_i = x_i * y_r - x_r * y_i
+          sI += xx + yy
+          sQ += xx - yy
+          sU += 2 * xy_r
+          sV += 2 * xy_i
+      out[j, 0, i] = _quantise(np.float32(sI / (decimationFactor * fscrunch)), scale[0, i], offset[0, i], maxValue, clipCounts)
+      out[j, 1, i] = _quantise(np.float32(sQ / (decimationFactor * fscrunch)), scale[1, i], offset[1, i], maxValue, clipCounts)
+      out[j, 2, i] = _quantise(np.float32(sU / (decimationFactor * fscrunch)), scale[2, i], offset[2, i], maxValue, clipCounts)
+      out[j, 3, i] = _quantise(np.float32(sV / (decimationFactor * fscrunch)), scale[3, i], offset[3, i], maxValue, clipCounts)
+
+def to_stokes_quantised(x, y, decimationFactor, fullStokes, scale, offset, nbits, out, clipCounts, fscrunch = 1):
+  """
+  Detect and requantise in one pass: the averaged Stokes values are mapped
+  to nbits unsigned integers with the per-channel scale and offset
+  (IFs, channels) and written to out (time, IFs, channels).
+  Values clipped at either end are counted in clipCounts.
+  """
+  maxValue = np.float32(2**nbits - 1)
+  if fullStokes:
+    _to_stokes_quantised(x, y, decimationFactor, fscrunch, scale, offset, maxValue, out, clipCounts)
+  else:
+    _to_stokesI_quantised(x, y, decimationFactor, fscrunch, scale, offset, maxValue, out[:, 0, :], clipCounts)
   return out
 
-@jit(nopython=True)
-def _to_stokes(x, y, out):
-  for i in range(x.shape[0]):
-    for j in range(x.shape[1]):
-      x_r = np.float32(x[i, j, 0])
-      x_i = np.float32(x[i, j, 1])
-      y_r = np.float32(y[i, j, 0])
-      y_i = np.float32(y[i, j, 1])
-      xx = x_r * x_r + x_i * x_i
-      yy = y_r * y_r + y_i * y_i
-      xy_r = x_r * y_r + x_i * y_i
-      xy_i = x_i * y_r - x_r * y_i
-      out[i, 0, j] = xx + yy
-      out[i, 1, j] = xx - yy
-      out[i, 2, j] = 2 * xy_r
-      out[i, 3, j] = 2 * xy_i
-
-def to_stokes(x, y):
-  out = np.empty((x.shape[0], 4, x.shape[1]), np.float32)
-  _to_stokes(x, y, out)
+def detect(x, y, decimationFactor, fullStokes, out, fscrunch = 1):
+  if fullStokes:
+    to_stokes(x, y, decimationFactor, out, fscrunch)
+  else:
+    to_stokesI(x, y, decimationFactor, out[:, 0, :], fscrunch)
   return out
 
+def windowScaling(datasetPol0, datasetPol1, task, windowStart):
+  """
+  Scale and offset for the requantisation interval starting at spectrum
+  windowStart, from the statistics of its first windowSpectra spectra.
+  Every worker entering the interval computes the same values, so the
+  output does not depend on how the spectra were split between workers.
+  """
+  chunkSize = task["chunkSize"]
+  decimationFactor = task["decimationFactor"]
+  channels = task["channels"]
+  channelNumber = (channels[1] - channels[0]) // task["fscrunch"]
+  statistics = requantise.RunningStatistics(task["numberIFs"], channelNumber)
+  spectraChunkPol0 = np.empty((channels[1] - channels[0], chunkSize, 2), datasetPol0.dtype)
+  spectraChunkPol1 = np.empty((channels[1] - channels[0], chunkSize, 2), datasetPol1.dtype)
+  output = np.empty((chunkSize // decimationFactor, task["numberIFs"], channelNumber), np.float32)
+  windowEnd = min(windowStart + task["windowSpectra"], task["numberSamples"] * decimationFactor)
+  for t0 in range(windowStart, windowEnd, chunkSize):
+    t1 = min(windowEnd, t0 + chunkSize)
+    beamformerH5.readSpectra(datasetPol0, task["spectra"], 0, t0, t1, spectraChunkPol0, channels)
+    beamformerH5.readSpectra(datasetPol1, task["spectra"], 1, t0, t1, spectraChunkPol1, channels)
+    valid = task["spectra"].valid(t0, t1)
+    if task["skSigma"]:
+      powerSums = np.zeros((channels[1] - channels[0], 4), np.float64)
+      values = detect_sk(spectraChunkPol0[:, :t1 - t0], spectraChunkPol1[:, :t1 - t0], decimationFactor, task["fullStokes"], output[:(t1 - t0) // decimationFactor], powerSums, task["fscrunch"])
+      beamformerH5.exciseRFI(values, powerSums, t1 - t0 if valid is None else valid.sum(), task["skSigma"], task["fscrunch"])
+    else:
+      values = detect(spectraChunkPol0[:, :t1 - t0], spectraChunkPol1[:, :t1 - t0], decimationFactor, task["fullStokes"], output[:(t1 - t0) // decimationFactor], task["fscrunch"])
+    if task["fillMode"]:
+      beamformerH5.fillGaps(values, valid, decimationFactor, task["fillMode"])
+    statistics.add(values)
+  return statistics.scaling(task["nbits"])
+
+def splitSpans(endIndex, chunkSize, numberWorkers):
+  """
+  Partition spectra 0..endIndex into contiguous spans for the workers.
+  Span boundaries fall on multiples of chunkSize so every span is
+  detected with exactly the same chunks as the serial loop.
+  """
+  numberChunks = (endIndex + chunkSize - 1) // chunkSize
+  numberSpans = min(numberChunks, 4 * numberWorkers) # a few spans per worker to balance the load
+  spans = []
+  for i in range(numberSpans):
+    c0 = (i * numberChunks) // numberSpans
+    c1 = ((i + 1) * numberChunks) // numberSpans
+    spans.append((c0 * chunkSize, min(endIndex, c1 * chunkSize)))
+  return spans
+
+def checkpointSpans(start, end, spanSpectra):
+  """
+  Split spectra start..end at the multiples of spanSpectra, so that the
+  converted spectra can be recorded in the checkpoint span by span.
+  """
+  boundaries = [start] + range((start // spanSpectra + 1) * spanSpectra, end, spanSpectra) + [end]
+  return [(boundaries[i], boundaries[i + 1]) for i in range(len(boundaries) - 1) if boundaries[i + 1] > boundaries[i]]
+
+def spanResults(filledSamples, clipCounts, rfiBlocks):
+  """
+  Return the side results of a span in the form stored in the checkpoint.
+  """
+  return {"filled": np.concatenate(filledSamples + [np.zeros(0, np.intp)]).tolist(), "clip": clipCounts.tolist(),
+          "rfi": [[sample, length, flagged.tolist()] for (sample, length, flagged) in rfiBlocks]}
+
+def detectChunk(task, spectraChunkPol0, spectraChunkPol1, valid, output, values = None, powerSums = None, scale = None, offset = None, clipCounts = None, stageTimes = None):
+  """
+  Detect one chunk of spectra into output (time, IFs, channels) with the
+  gap filling, RFI excision and requantisation set in the task.
+  values (float32, shaped like output) and powerSums (input channels, 4)
+  are scratch arrays needed for filled or excised 8/16-bit output and for
+  spectral kurtosis. The time spent is added to the compute and quantise
+  stages of stageTimes, and the chunk to its counters.
+    Output:
+      filled: samples of the chunk that were filled.
+      flagged: output channels replaced as RFI.
+  """
+  decimationFactor = task["decimationFactor"]
+  fscrunch = task["fscrunch"]
+  nbits = task["nbits"]
+  filled = np.zeros(0, np.intp)
+  flagged = np.zeros(0, np.intp)
+  computeStart = time.time()
+  quantiseTime = None
+  if nbits == 32 or task["fillMode"] or task["skSigma"]:
+    chunkValues = output if nbits == 32 else values[:output.shape[0]]
+    if task["skSigma"]:
+      powerSums[:] = 0
+      detect_sk(spectraChunkPol0, spectraChunkPol1, decimationFactor, task["fullStokes"], chunkValues, powerSums, fscrunch)
+      flagged = beamformerH5.exciseRFI(chunkValues, powerSums, output.shape[0] * decimationFactor if valid is None else valid.sum(), task["skSigma"], fscrunch)
+    else:
+      detect(spectraChunkPol0, spectraChunkPol1, decimationFactor, task["fullStokes"], chunkValues, fscrunch)
+    if task["fillMode"]:
+      filled = beamformerH5.fillGaps(chunkValues, valid, decimationFactor, task["fillMode"])
+    if nbits != 32:
+      quantiseStart = time.time()
+      requantise.quantise(chunkValues, scale, offset, nbits, output, clipCounts)
+      quantiseTime = time.time() - quantiseStart
+  else:
+    to_stokes_quantised(spectraChunkPol0, spectraChunkPol1, decimationFactor, task["fullStokes"], scale, offset, nbits, output, clipCounts, fscrunch) # quantised within the compute stage
+  if stageTimes is not None:
+    stageTimes.add("compute", busy = time.time() - computeStart - (quantiseTime or 0.0))
+    if quantiseTime is not None:
+      stageTimes.add("quantise", busy = quantiseTime)
+    numberSpectra = output.shape[0] * decimationFactor
+    stageTimes.count("spectra", numberSpectra)
+    stageTimes.count("bytesIn", numberSpectra * (spectraChunkPol0.nbytes // spectraChunkPol0.shape[1] + spectraChunkPol1.nbytes // spectraChunkPol1.shape[1]))
+    stageTimes.count("samples", output.shape[0])
+    stageTimes.count("filledSamples", filled.size)
+    stageTimes.count("flaggedBlocks", flagged.size)
+  return filled, flagged
+
+def outputSink(task, numberSamples, create = True):
+  """
+  Return the output sink of the task: a PSRFITS search-mode file if
+  task["psrfits"] is set, otherwise a filterbank file.
+  """
+  channelNumber = (task["channels"][1] - task["channels"][0]) // task["fscrunch"]
+  settings = task.get("psrfits")
+  if settings:
+    import psrfits # astropy is only loaded for PSRFITS output
+    return psrfits.SearchModeSink(task["outFileName"], settings["header"], numberSamples, task["numberIFs"], channelNumber, settings["frequencies"], settings["samplingTime"], settings["samplesPerSubint"], create)
+  return filterbank.FilterbankSink(task["outFileName"], task["header"], numberSamples, task["numberIFs"], channelNumber, task["nbits"], task["sequentialWrite"] or numberSamples is None, create)
+
+def spanAlignment(task):
+  """
+  Return the number of spectra span boundaries have to be multiples of:
+  the read span, and for PSRFITS output also whole subints.
+  """
+  alignment = task["chunkSize"]
+  if task.get("psrfits"):
+    subintSpectra = task["psrfits"]["samplesPerSubint"] * task["decimationFactor"]
+    while alignment % subintSpectra:
+      alignment += task["chunkSize"]
+  return alignment
+
+def convertSpan(task):
+  """
+  Detect spectra spanStart..spanEnd (counted from the start of the overlap)
+  and write them at their sample offset in the preallocated output file.
+  Each call opens its own h5py and output file handles, so it can run
+  in a separate process.
+  """
+  spanStart, spanEnd = task["span"]
+  chunkSize = task["chunkSize"]
+  decimationFactor = task["decimationFactor"]
+  dataH5FilePol0 = beamformerH5.openBeamformerFile(task["h5FilePol0"], *task["cachePol0"])
+  dataH5FilePol1 = beamformerH5.openBeamformerFile(task["h5FilePol1"], *task["cachePol1"])
+  channels = task["channels"]
+  fscrunch = task["fscrunch"]
+  channelNumber = (channels[1] - channels[0]) // fscrunch
+  nbits = task["nbits"]
+  sink = outputSink(task, task["numberSamples"], create = False)
+  # Chunk N+1 is read while chunk N is detected.
+  stageTimes = perfMetrics.Metrics()
+  chunks = [(t0, min(spanEnd, t0 + chunkSize)) for t0 in range(spanStart, spanEnd, chunkSize)]
+  reader = beamformerH5.ChunkPrefetcher(dataH5FilePol0["Data/bf_raw"], dataH5FilePol1["Data/bf_raw"], chunks, task["spectra"], stageTimes, channels = channels)
+  if sink.sequential:
+    # Output buffers are reused, each goes back to the writer's pool once on disk.
+    writer = beamformerH5.BackgroundWriter(sink, stageTimes, (chunkSize // decimationFactor, task["numberIFs"], channelNumber), sink.dtype)
+  else:
+    writer = None
+  values = None
+  powerSums = None
+  if nbits != 32 and (task["fillMode"] or task["skSigma"]):
+    # Gaps are filled and RFI excised in float before requantising.
+    values = np.empty((chunkSize // decimationFactor, task["numberIFs"], channelNumber), np.float32)
+  if task["skSigma"]:
+    powerSums = np.empty((channels[1] - channels[0], 4), np.float64)
+  interval = None
+  scale = offset = None
+  clipCounts = np.zeros(2, np.int64)
+  filledSamples = []
+  rfiBlocks = []
+  for (t0, t1, spectraChunkPol0, spectraChunkPol1, valid) in reader:
+    sample = t0 // decimationFactor
+    if nbits != 32 and t0 // task["intervalSpectra"] != interval:
+      interval = t0 // task["intervalSpectra"]
+      scale, offset = windowScaling(dataH5FilePol0["Data/bf_raw"], dataH5FilePol1["Data/bf_raw"], task, interval * task["intervalSpectra"])
+    if writer is None:
+      output = sink.data[sample:t1 // decimationFactor] # detected straight into the memory-mapped file
+    else:
+      outBuffer = writer.buffer()
+      output = outBuffer[:(t1 - t0) // decimationFactor]
+    filled, flagged = detectChunk(task, spectraChunkPol0, spectraChunkPol1, valid, output, values, powerSums, scale, offset, clipCounts, stageTimes)
+    stageTimes.count("bytesOut", output.shape[0] * sink.bytesPerSample)
+    if task["fillMode"]:
+      filledSamples.append(sample + filled)
+    if flagged.size:
+      rfiBlocks.append((sample, output.shape[0], flagged))
+    if task.get("dedisperser") is not None:
+      task["dedisperser"].feed(output)
+    if writer is not None:
+      writer.write(sample, output, outBuffer)
+    if task.get("exporter") is not None:
+      task["exporter"].update(stageTimes)
+  if writer is not None:
+    writer.close()
+  if task.get("checkpoint"):
+    sink.flush() # on disk before the span is recorded as converted
+  sink.close()
+  dataH5FilePol0.close()
+  dataH5FilePol1.close()
+  return task["span"], stageTimes, filledSamples, clipCounts, rfiBlocks
+
+def chunkSettings(task, chunkSize, layoutPol0, layoutPol1, rescaleTime, samplingTime):
+  """
+  Set the read span of the task and the settings depending on it: chunk
+  caches and requantisation intervals.
+  """
+  decimationFactor = task["decimationFactor"]
+  task["chunkSize"] = chunkSize
+  task["cachePol0"] = beamformerH5.chunkCacheSettings(layoutPol0, chunkSize, task["channels"])
+  task["cachePol1"] = beamformerH5.chunkCacheSettings(layoutPol1, chunkSize, task["channels"])
+  # Requantisation scaling comes from the first windowSpectra spectra of every interval.
+  task["intervalSpectra"] = chunkSize * max(1, int(round(rescaleTime * decimationFactor / samplingTime / chunkSize)))
+  task["windowSpectra"] = min(task["intervalSpectra"], chunkSize * ((1024 * decimationFactor + chunkSize - 1) // chunkSize))
+
+def workerMemory(task, layoutPol0, chunkSize):
+  """
+  Estimate the bytes used by one worker converting with read span chunkSize:
+  read buffers, chunk caches and output buffers.
+  """
+  channels = task["channels"]
+  readBytes = (channels[1] - channels[0]) * chunkSize * 2 * layoutPol0["itemsize"] * 2 # both polarisations
+  cacheBytes = beamformerH5.chunkCacheSettings(layoutPol0, chunkSize, channels)[0] * 2
+  outputBytes = (chunkSize // task["decimationFactor"]) * task["numberIFs"] * ((channels[1] - channels[0]) // task["fscrunch"]) * 4
+  memory = 3 * readBytes + cacheBytes + 2 * outputBytes # prefetch buffers, scaling window, scratch
+  if task["sequentialWrite"]:
+    memory += 4 * outputBytes + 64 * 1024**2 # writer buffer pool and sink buffer
+  return memory
+
+def timeConfiguration(task, layoutPol0, layoutPol1, rescaleTime, samplingTime, calibrationSpectra, chunkSize, numberWorkers):
+  """
+  Convert the first calibrationSpectra spectra with read span chunkSize and
+  numberWorkers workers to a scratch file next to the output, and return
+  the rate in spectra per second.
+  """
+  decimationFactor = task["decimationFactor"]
+  tuneTask = dict(task)
+  chunkSettings(tuneTask, chunkSize, layoutPol0, layoutPol1, rescaleTime, samplingTime)
+  endIndex = calibrationSpectra - calibrationSpectra % decimationFactor
+  tuneTask["numberSamples"] = endIndex // decimationFactor
+  tuneTask["outFileName"] = task["outFileName"] + ".autotune"
+  tuneTask["dedisperser"] = None
+  startTime = time.time()
+  outputSink(tuneTask, tuneTask["numberSamples"]).close()
+  if numberWorkers == 1:
+    spans = [(0, endIndex)]
+  else:
+    spans = splitSpans(endIndex, spanAlignment(tuneTask), numberWorkers)
+  tasks = []
+  for span in spans:
+    spanTask = dict(tuneTask)
+    spanTask["span"] = span
+    tasks.append(spanTask)
+  if numberWorkers == 1:
+    map(convertSpan, tasks)
+  else:
+    workerPool = multiprocessing.Pool(numberWorkers)
+    workerPool.map(convertSpan, tasks)
+    workerPool.close()
+    workerPool.join()
+  elapsed = time.time() - startTime
+  os.remove(tuneTask["outFileName"])
+  return endIndex / max(elapsed, 1e-6)
+
+def followConversion(task, startIndices, startADC, pollInterval, idleTimeout):
+  """
+  Convert HDF5 files still being written, opened in SWMR read mode.
+  Data/bf_raw and Data/timestamps are polled every pollInterval seconds
+  and every complete chunk present in both polarisations is detected and
+  appended to the output. Once the writers have closed both files, or
+  nothing was added for idleTimeout seconds, the remaining spectra are
+  converted and the output is closed.
+    Inputs:
+      task: conversion settings as for convertSpan().
+      startIndices: index of the first common spectrum in each file.
+      startADC: timestamp of the first common spectrum.
+    Output:
+      numberSamples, stageTimes, clipCounts, rfiBlocks.
+  """
+  chunkSize = task["chunkSize"]
+  decimationFactor = task["decimationFactor"]
+  channels = task["channels"]
+  nbits = task["nbits"]
+  channelNumber = (channels[1] - channels[0]) // task["fscrunch"]
+  fileNames = (task["h5FilePol0"], task["h5FilePol1"])
+  dataFiles = [beamformerH5.openBeamformerFile(fileNames[0], *task["cachePol0"], swmr = True), beamformerH5.openBeamformerFile(fileNames[1], *task["cachePol1"], swmr = True)]
+  datasets = [dataFile["Data/bf_raw"] for dataFile in dataFiles]
+  timestamps = [dataFile["Data/timestamps"] for dataFile in dataFiles]
+  sink = outputSink(task, None)
+  spectraChunks = [np.empty((channels[1] - channels[0], chunkSize, 2), dataset.dtype) for dataset in datasets]
+  output = np.empty((chunkSize // decimationFactor, task["numberIFs"], channelNumber), sink.dtype)
+  values = np.empty(output.shape, np.float32) if nbits != 32 and task["skSigma"] else None
+  powerSums = np.empty((channels[1] - channels[0], 4), np.float64) if task["skSigma"] else None
+  stageTimes = perfMetrics.Metrics()
+  clipCounts = np.zeros(2, np.int64)
+  rfiBlocks = []
+  interval = None
+  scale = offset = None
+  position = 0
+  lastAvailable = 0
+  lastGrowth = time.time()
+  while True:
+    finished = not any(beamformerH5.writerActive(fileName) for fileName in fileNames) or time.time() - lastGrowth > idleTimeout
+    for dataset in datasets + timestamps:
+      dataset.refresh()
+    available = min(min(datasets[pol].shape[1], timestamps[pol].shape[0]) - startIndices[pol] for pol in (0, 1))
+    if available > lastAvailable:
+      lastAvailable = available
+      lastGrowth = time.time()
+    if finished:
+      end = available - available % decimationFactor
+    else:
+      end = position + (available - position) // chunkSize * chunkSize
+    t0 = position
+    while t0 < end:
+      t1 = min(end, t0 + chunkSize)
+      if nbits != 32 and t0 // task["intervalSpectra"] != interval:
+        if not finished and available < t0 + task["windowSpectra"]:
+          break # wait for the whole scaling window
+        interval = t0 // task["intervalSpectra"]
+        task["numberSamples"] = available // decimationFactor
+        scale, offset = windowScaling(datasets[0], datasets[1], task, interval * task["intervalSpectra"])
+      readStart = time.time()
+      for pol in (0, 1):
+        beamformerH5.readSpectra(datasets[pol], task["spectra"], pol, t0, t1, spectraChunks[pol], channels)
+        chunkTimestamps = timestamps[pol][startIndices[pol] + t0:startIndices[pol] + t1].astype(np.int64)
+        expected = startADC + beamformerH5.timestampStep * np.arange(t0, t1, dtype = np.int64)
+        if np.any(chunkTimestamps != expected):
+          print ("Discontinuity in %s within spectra %d-%d, spectra are placed contiguously.") % (fileNames[pol], t0, t1)
+      stageTimes.add("read", busy = time.time() - readStart)
+      chunkOutput = output[:(t1 - t0) // decimationFactor]
+      filled, flagged = detectChunk(task, spectraChunks[0][:, :t1 - t0], spectraChunks[1][:, :t1 - t0], None, chunkOutput, values, powerSums, scale, offset, clipCounts, stageTimes)
+      if flagged.size:
+        rfiBlocks.append((t0 // decimationFactor, chunkOutput.shape[0], flagged))
+      writeStart = time.time()
+      sink.append(chunkOutput)
+      stageTimes.add("write", busy = time.time() - writeStart)
+      stageTimes.count("bytesOut", chunkOutput.shape[0] * sink.bytesPerSample)
+      t0 = t1
+    if t0 > position:
+      print ("Converted spectra %d-%d") % (position, t0)
+      position = t0
+    if task.get("exporter") is not None:
+      task["exporter"].update(stageTimes)
+    if finished:
+      break
+    time.sleep(pollInterval)
+  sink.close()
+  for dataFile in dataFiles:
+    dataFile.close()
+  return position // decimationFactor, stageTimes, clipCounts, rfiBlocks
+
 # Main body of the script
 if __name__=="__main__":
 
@@ -94,32 +593,102 @@ if __name__=="__main__":
   #cmdline.add_option("--tsamp", type = "float", dest = "samplingTime", metavar = "<samplingTime>", default = "4.78504672897196" , help = "Give sampling time in microseconds.")
   cmdline.add_option("--freq", type = "float", dest = "freqCent", metavar = "<freqCent>", default = "1391.0" , help = "Give centre frequency.")
   #cmdline.add_option("--sync", type = "int", dest = "syncTime", metavar = "<syncTime>", default = "1462436476" , help = "Give UTC sync time of F-engines.")
-  cmdline.add_option("--chunk", type = "int", dest = "chunkSize", metavar = "<chunkSize>", default = "256" , help = "Give number of samples for script to proccess.")
+  cmdline.add_option("--chunk", type = "int", dest = "chunkSize", metavar = "<chunkSize>", help = "Give number of samples for script to proccess (default: multiple of the HDF5 storage chunk, about 256).")
   cmdline.add_option("--ndec", type = "int", dest = "decimationFactor", metavar = "<decimationFactor>", default = "1" , help = "Give decimation factor.")
   cmdline.add_option("--source", type = "string", dest = "sourceName", metavar = "<sourceName>", default = "J0835-4510", help = "Give source name.")
   cmdline.add_option("--ra", type = "string", dest = "rightAscension", metavar = "<rightAscension>", default = "08:35:20.61149", help = "Give right ascension of the source.")
   cmdline.add_option("--dec", type = "string", dest = "declination", metavar = "<declination>", default = "-45:10:34.8751", help = "Give declination of the source.")
-  cmdline.add_option("--raw0", type = "string", dest = "h5FilePol0", metavar = "<h5FilePol0>", help = "Give input pol0 filename.")
-  cmdline.add_option("--raw1", type = "string", dest = "h5FilePol1", metavar = "<h5FilePol1>", help = "Give input pol1 filename.")
+  cmdline.add_option("--raw0", type = "string", dest = "h5FilePol0", metavar = "<h5FilePol0>", help = "Give input pol0 filename, or a comma-separated list of files and glob patterns of a capture split across files.")
+  cmdline.add_option("--raw1", type = "string", dest = "h5FilePol1", metavar = "<h5FilePol1>", help = "Give input pol1 filename, or a comma-separated list of files and glob patterns of a capture split across files.")
   cmdline.add_option("--out", type = "string", dest = "outFileName", metavar = "<outFileName>", default = "out.fil", help = "Give output filename.")
   cmdline.add_option("--pol", dest="fullStokes", action="store_true", help="Convert to full Stokes.")
+  cmdline.add_option("--fill", type = "choice", dest = "fillMode", metavar = "<fillMode>", choices = ["zero", "mean", "previous"], help = "Place spectra by timestamp and fill missing ones with zero, mean or previous.")
+  cmdline.add_option("--workers", type = "int", dest = "numberWorkers", metavar = "<numberWorkers>", default = "1" , help = "Give number of processes converting the data in parallel.")
+  cmdline.add_option("--nbits", type = "int", dest = "nbits", metavar = "<nbits>", default = "32" , help = "Give number of bits per output value, 8, 16 or 32 (default: 32).")
+  cmdline.add_option("--rescale", type = "float", dest = "rescaleTime", metavar = "<rescaleTime>", default = "10.0" , help = "Give interval in seconds between updates of the 8/16-bit scaling (default: 10).")
+  cmdline.add_option("--chan-range", type = "int", nargs = 2, dest = "channelRange", metavar = "<firstChannel> <endChannel>", help = "Give range of channels to convert, end channel excluded (default: all).")
+  cmdline.add_option("--freq-range", type = "float", nargs = 2, dest = "frequencyRange", metavar = "<lowFreq> <highFreq>", help = "Give range of frequencies in MHz to convert (default: all).")
+  cmdline.add_option("--fscrunch", type = "int", dest = "fscrunch", metavar = "<fscrunch>", default = "1" , help = "Give number of channels added into one output channel.")
+  cmdline.add_option("--sk", type = "float", dest = "skSigma", metavar = "<skSigma>", help = "Flag and replace channels whose spectral kurtosis over a read chunk is more than skSigma standard deviations from 1 (e.g. 3), writing the flags to <outFileName>.rfi.")
+  cmdline.add_option("--dm-range", type = "float", nargs = 2, dest = "dmRange", metavar = "<dmStart> <dmEnd>", help = "Give range of trial DMs to dedisperse the output at, writing one .tim file per DM.")
+  cmdline.add_option("--dm-step", type = "float", dest = "dmStep", metavar = "<dmStep>", help = "Give step between trial DMs (default: one sample of delay across the band).")
+  cmdline.add_option("--subbands", type = "int", dest = "numberSubbands", metavar = "<numberSubbands>", default = "32", help = "Give number of subbands used for dedispersion (default: 32).")
+  cmdline.add_option("--autotune", dest = "autotune", action = "store_true", help = "Choose the read span and number of workers from a calibration on the start of the input, cached per host, data layout and settings.")
+  cmdline.add_option("--tune-time", type = "float", dest = "tuneTime", metavar = "<tuneTime>", default = "2.0", help = "Give seconds of data converted by each calibration run (default: 2).")
+  cmdline.add_option("--max-mem", type = "float", dest = "maxMemory", metavar = "<maxMemory>", help = "Give memory budget in MB for the autotuned configuration (default: no limit).")
+  cmdline.add_option("--follow", dest = "follow", action = "store_true", help = "Convert files still being written (HDF5 SWMR), appending new spectra until the writers close the files.")
+  cmdline.add_option("--poll", type = "float", dest = "pollInterval", metavar = "<pollInterval>", default = "1.0", help = "Give seconds between checks for new spectra in follow mode (default: 1).")
+  cmdline.add_option("--follow-timeout", type = "float", dest = "followTimeout", metavar = "<followTimeout>", default = "60.0", help = "Give seconds without new spectra after which follow mode stops (default: 60).")
+  cmdline.add_option("--psrfits", dest = "psrfits", action = "store_true", help = "Write 8-bit PSRFITS search mode with per-subint scales and offsets instead of filterbank.")
+  cmdline.add_option("--nsblk", type = "int", dest = "samplesPerSubint", metavar = "<samplesPerSubint>", default = "1024", help = "Give number of output samples per PSRFITS subint (default: 1024).")
+  cmdline.add_option("--checkpoint", type = "float", dest = "checkpointInterval", metavar = "<checkpointInterval>", help = "Record the converted spans in <outFileName>.checkpoint at most every checkpointInterval seconds, spans being one rescale interval long.")
+  cmdline.add_option("--resume", dest = "resume", action = "store_true", help = "Continue an interrupted conversion from <outFileName>.checkpoint, checkpointing every 60 s unless --checkpoint is given.")
+  cmdline.add_option("--seqwrite", dest = "sequentialWrite", action = "store_true", help = "Write the output through a large aligned buffer instead of a memory map.")
+  perfMetrics.addOptions(cmdline)
 
   (opts, args) = cmdline.parse_args() # reading cmd options
+  stageTimes = perfMetrics.Metrics()
+  metricsExporter = perfMetrics.exporterFromOptions(opts, stageTimes, "fastH5", opts.outFileName)
   if not opts.h5FilePol0 or not opts.h5FilePol1:
     cmdline.print_usage()
     sys.exit(0)
+  if opts.nbits not in filterbank.nbitsTypes:
+    print ("Writing %d-bit data not supported.") % opts.nbits
+    sys.exit(0)
+  if opts.fscrunch < 1:
+    print ("fscrunch has to be at least 1.")
+    sys.exit(0)
+  if opts.psrfits and (opts.nbits != 32 or opts.dmRange):
+    print ("PSRFITS output is always 8-bit and cannot be combined with --nbits or --dm-range.")
+    sys.exit(0)
+  if opts.follow and (opts.fillMode or opts.dmRange or opts.autotune):
+    print ("--follow cannot be combined with --fill, --dm-range or --autotune.")
+    sys.exit(0)
+  if (opts.checkpointInterval or opts.resume) and (opts.follow or opts.dmRange):
+    print ("--checkpoint and --resume cannot be combined with --follow or --dm-range.")
+    sys.exit(0)
 
   # Getting boolean options.
   fullStokes = opts.fullStokes
   print ("fullStokes: %s") % (fullStokes)
 
-  # Loading the files.
-  h5FilePol0 = opts.h5FilePol0
-  h5FilePol1 = opts.h5FilePol1
+  # Loading the files, a capture split across files is read through one concatenated view.
+  filesPol0 = beamformerH5.captureFiles(opts.h5FilePol0)
+  filesPol1 = beamformerH5.captureFiles(opts.h5FilePol1)
+  if opts.follow and (len(filesPol0) > 1 or len(filesPol1) > 1):
+    print ("--follow takes a single file per polarisation.")
+    sys.exit(0)
+  try:
+    h5FilePol0 = beamformerH5.concatenateCapture(filesPol0, opts.outFileName + ".pol0.vds.h5")
+    h5FilePol1 = beamformerH5.concatenateCapture(filesPol1, opts.outFileName + ".pol1.vds.h5")
+  except (IOError, ValueError) as error:
+    print error
+    sys.exit(0)
   print ("h5FilePol0: %s") % h5FilePol0
   print ("h5FilePol1: %s") % h5FilePol1
-  dataH5FilePol0 = h5py.File(h5FilePol0, "r")
-  dataH5FilePol1 = h5py.File(h5FilePol1, "r")
+  if opts.follow:
+    print ("Waiting for spectra in both files.")
+    if not beamformerH5.waitForSpectra([h5FilePol0, h5FilePol1], opts.pollInterval, opts.followTimeout):
+      print ("No common spectra after %.0f s.") % opts.followTimeout
+      sys.exit(0)
+
+  # Choosing the read span and chunk cache from the storage layout of the data.
+  layoutPol0 = beamformerH5.datasetLayout(h5FilePol0, swmr = opts.follow)
+  layoutPol1 = beamformerH5.datasetLayout(h5FilePol1, swmr = opts.follow)
+  print ("storage chunks: %s, compression: %s") % (layoutPol0["chunks"], layoutPol0["compression"])
+  chunkSize = beamformerH5.spectraPerRead(layoutPol0, opts.decimationFactor, opts.chunkSize)
+  if opts.chunkSize and chunkSize != opts.chunkSize:
+    print ("chunkSize %d shorter than decimationFactor, using %d.") % (opts.chunkSize, chunkSize)
+  # Selecting the band, only this hyperslab of the channel axis is read.
+  fscrunch = opts.fscrunch
+  channels = beamformerH5.channelSelection(layoutPol0["shape"][0], opts.channelRange, opts.frequencyRange, opts.freqCent - (layoutPol0["shape"][0] / 2) * channelBW, channelBW, fscrunch)
+  outputChannels = (channels[1] - channels[0]) // fscrunch
+  print ("channels: %d-%d, fscrunch: %d, output channels: %d") % (channels[0], channels[1], fscrunch, outputChannels)
+  cacheBytesPol0, cacheSlotsPol0 = beamformerH5.chunkCacheSettings(layoutPol0, chunkSize, channels)
+  cacheBytesPol1, cacheSlotsPol1 = beamformerH5.chunkCacheSettings(layoutPol1, chunkSize, channels)
+  print ("chunk cache: %d bytes") % cacheBytesPol0
+  dataH5FilePol0 = beamformerH5.openBeamformerFile(h5FilePol0, cacheBytesPol0, cacheSlotsPol0, opts.follow)
+  dataH5FilePol1 = beamformerH5.openBeamformerFile(h5FilePol1, cacheBytesPol1, cacheSlotsPol1, opts.follow)
 
   # Getting number of channels from each file.
   channelNumberPol0 = dataH5FilePol0["Data/bf_raw"].shape[0]
@@ -139,78 +708,47 @@ if __name__=="__main__":
   print ("spectraNumberPol0: %d") % spectraNumberPol0
   print ("spectraNumberPol1: %d") % spectraNumberPol1
 
-  # Getting ADC counts from each file.
-  countADCPol0 = dataH5FilePol0["Data/timestamps"][:]
-  countADCPol1 = dataH5FilePol1["Data/timestamps"][:]
-  print ("countADCPol0[0]: %d") % countADCPol0[0]
-  print ("countADCPol1[0]: %d") % countADCPol1[0]
-
-  # Calculating where both files start overlaping.
-  if (countADCPol0[0] > countADCPol1[0]):
-    startSyncADC = countADCPol0[0]
-    startIndexPol1 = np.where(countADCPol1 == startSyncADC)[0][0]
-    startIndexPol0 = 0
-    print ("startIndexPol0: %d") % startIndexPol0
-    print ("startIndexPol1: %d") % startIndexPol1
-  elif (countADCPol0[0] < countADCPol1[0]):
-    startSyncADC = countADCPol1[0]
-    startIndexPol0 = np.where(countADCPol0 == startSyncADC)[0][0]
-    startIndexPol1 = 0
-    print ("startIndexPol0: %d") % startIndexPol0
-    print ("startIndexPol1: %d") % startIndexPol1
-  else:
-    startSyncADC = countADCPol0[0]
-    startIndexPol0 = 0
-    startIndexPol1 = 0
-    print ("startIndexPol0: %d") % startIndexPol0
-    print ("startIndexPol1: %d") % startIndexPol1
-  print ("countADCPol0[%d]: %d") % (startIndexPol0, countADCPol0[startIndexPol0])
-  print ("countADCPol1[%d]: %d") % (startIndexPol1, countADCPol1[startIndexPol1])
+  # Aligning both files on their ADC timestamps, reading only a few of them.
+  timestampIndexPol0 = beamformerH5.TimestampIndex(dataH5FilePol0["Data/timestamps"])
+  timestampIndexPol1 = beamformerH5.TimestampIndex(dataH5FilePol1["Data/timestamps"])
+  print ("countADCPol0[0]: %d") % timestampIndexPol0.first
+  print ("countADCPol1[0]: %d") % timestampIndexPol1.first
+  try:
+    overlap = beamformerH5.alignTimestamps(timestampIndexPol0, timestampIndexPol1)
+  except ValueError as error:
+    print error
+    sys.exit(0)
+  startSyncADC = overlap["startADC"]
+  endSyncADC = overlap["endADC"]
+  startIndexPol0 = overlap["startIndexPol0"]
+  startIndexPol1 = overlap["startIndexPol1"]
+  endIndexPol0 = overlap["endIndexPol0"]
+  endIndexPol1 = overlap["endIndexPol1"]
+  endIndex = min(endIndexPol0 - startIndexPol0, endIndexPol1 - startIndexPol1)
+  print ("startIndexPol0: %d") % startIndexPol0
+  print ("startIndexPol1: %d") % startIndexPol1
   print ("startSyncADC: %d") % startSyncADC
-
-  # Calculating where both files end overlaping.
-  if (countADCPol0[-1] > countADCPol1[-1]):
-    endSyncADC = countADCPol1[-1]
-    endIndexPol0 = np.where(countADCPol0 == endSyncADC)[0][0]
-    endIndexPol1 = countADCPol1.size - 1
-    endIndex = endIndexPol0
-    print ("endIndexPol0: %d") % endIndexPol0
-    print ("endIndexPol1: %d") % endIndexPol1
-    print ("endIndex: %d") % endIndex
-  elif (countADCPol0[-1] < countADCPol1[-1]):
-    endSyncADC = countADCPol0[-1]
-    endIndexPol1 = np.where(countADCPol1 == endSyncADC)[0][0]
-    endIndexPol0 = countADCPol0.size - 1
-    endIndex = endIndexPol1
-    print ("endIndexPol0: %d") % endIndexPol0
-    print ("endIndexPol1: %d") % endIndexPol1
-    print ("endIndex: %d") % endIndex
-  else:
-    endSyncADC = countADCPol0[-1]
-    endIndexPol0 = endIndexPol1 = countADCPol0.size
-  print ("countADCPol0[%d]: %d") % (endIndexPol0, countADCPol0[endIndexPol0])
-  print ("countADCPol1[%d]: %d") % (endIndexPol1, countADCPol1[endIndexPol1])
+  print ("endIndexPol0: %d") % endIndexPol0
+  print ("endIndexPol1: %d") % endIndexPol1
+  print ("endIndex: %d") % endIndex
   print ("endSyncADC: %d") % endSyncADC
 
-  # Getting difference between countADC to check for missing packets.
-  differencePol0 = np.diff(countADCPol0[startIndexPol0:])
-  differencePol1 = np.diff(countADCPol1[startIndexPol1:])
-  breaksPol0 = np.where(differencePol0 != 8192)[0]
-  breaksPol1 = np.where(differencePol0 != 8192)[0]
+  # Reporting discontinuities as (index, number of missing spectra).
+  breaksPol0 = timestampIndexPol0.discontinuities
+  breaksPol1 = timestampIndexPol1.discontinuities
+  stageTimes.count("droppedSpectra", sum(missing for (index, missing) in breaksPol0 + breaksPol1))
   print "breaksPol0: ", breaksPol0
   print "breaksPol1: ", breaksPol1
-  if (breaksPol0.size != 0):
+  if (len(breaksPol0) != 0):
     print ("Missing spectra in: %s") % (h5FilePol0)
     print "Missing spectra located at: ", breaksPol0
-  if (breaksPol1.size != 0):
+  if (len(breaksPol1) != 0):
     print ("Missing spectra in: %s") % (h5FilePol1)
     print "Missing spectra located at: ", breaksPol1
 
   # Calculating sampling times, start MJD times, frequencies etc.
   outFileName = opts.outFileName
   #print ("outFileName: %s") % outFileName
-  chunkSize = opts.chunkSize
-  print ("chunkSize: %d") % chunkSize
   #samplingTime = opts.samplingTime
   samplingTime = 4.78504672897196
   samplingTime = samplingTime * 1e-6 # Turn to microseconds.
@@ -224,11 +762,6 @@ if __name__=="__main__":
   if( decimationFactor != 0 and ((decimationFactor & (decimationFactor - 1)) == 0) == False):
     print "decimationFactor not a power of two!"
     sys.exit(0)
-  # Check if decimationFactor is greater than chunkSize.
-  if (decimationFactor > chunkSize):
-    chunkSize = 2 * decimationFactor
-    print ("decimationFactor: %d") % decimationFactor
-    print ("new chunkSize: %d") % chunkSize
   # Find sync time in the data files.
   try:
     syncTime = dataH5FilePol0["/TelescopeModel/cbf"].attrs['sync_time']
@@ -250,6 +783,7 @@ if __name__=="__main__":
   print ("freqTop: %f") % freqTop
   freqBottom = freqCent - (((channelNumberPol0 / 2)) * channelBW)
   print ("freqBottom: %f") % freqBottom
+  freqFirst = freqBottom + (channels[0] + (fscrunch - 1) / 2.0) * channelBW # centre of the first output channel
   sourceName = opts.sourceName
   print ("sourceName: %s") % sourceName
   rightAscension = opts.rightAscension
@@ -257,50 +791,229 @@ if __name__=="__main__":
   declination = opts.declination
   print ("declination: %s") % declination
   # Creating and populating file header.
-  fileOut = open(outFileName, "wab")
-  headerStart = "HEADER_START"
-  headerEnd = "HEADER_END"
-  header = "".join([struct.pack("I", len(headerStart)), headerStart])
-  header = "".join([header, _write_string("source_name", sourceName)])
-  header = "".join([header, _write_int("machine_id", 13)])
-  header = "".join([header, _write_int("telescope_id", 64)])
   src_raj = float(rightAscension.replace(":", ""))
-  header = "".join([header, _write_double("src_raj", src_raj)])
   src_dej = float(declination.replace(":", ""))
-  header = "".join([header, _write_double("src_dej", src_dej)])
-  header = "".join([header, _write_int("data_type", 1)])
-  header = "".join([header, _write_double("fch1", freqBottom)])
-  header = "".join([header, _write_double("foff", channelBW)])
-  #header = "".join([header, _write_double("fch1", freqTop)])
-  #header = "".join([header, _write_double("foff", -1.0 * channelBW)])
-  header = "".join([header, _write_int("nchans", channelNumberPol0)])
-  header = "".join([header, _write_int("nbits", 32)])
-  header = "".join([header, _write_double("tstart", startTimeMJD)])
-  header = "".join([header, _write_double("tsamp", samplingTime)])
   if fullStokes:
-    header = "".join([header, _write_int("nifs", 4)])
+    numberIFs = 4
   else:
-    header = "".join([header, _write_int("nifs", 1)])
-  header = "".join([header, struct.pack("I", len(headerEnd)), headerEnd])
-  fileOut.write(header)
+    numberIFs = 1
+  headerItems = [("source_name", sourceName),
+                 ("machine_id", 13),
+                 ("telescope_id", 64),
+                 ("src_raj", src_raj),
+                 ("src_dej", src_dej),
+                 ("data_type", 1),
+                 ("fch1", freqFirst),
+                 ("foff", channelBW * fscrunch),
+                 #("fch1", freqTop),
+                 #("foff", -1.0 * channelBW),
+                 ("nchans", outputChannels),
+                 ("nbits", opts.nbits),
+                 ("tstart", startTimeMJD),
+                 ("tsamp", samplingTime),
+                 ("nifs", numberIFs)]
+  header = filterbank.makeHeader(headerItems)
   #endIndex = 208985 # Number of Nyquist-sampled spectra in 1 second, use to process only 1 second of data.
+  if opts.fillMode:
+    # Every timestamp gets its own output slot, missing spectra are filled.
+    spectra = beamformerH5.SpectrumSlots(timestampIndexPol0, timestampIndexPol1, overlap)
+    endIndex = spectra.numberSlots
+    print ("fillMode: %s, output slots: %d") % (opts.fillMode, endIndex)
+  else:
+    spectra = beamformerH5.ContiguousSpectra(startIndexPol0, startIndexPol1)
   endIndex -= endIndex % decimationFactor
+
+  numberSamples = endIndex // decimationFactor
+
+  # Dedispersing the output as it is converted.
+  dedisperser = None
+  if opts.dmRange:
+    headerValues = dict(headerItems)
+    dms = dedisperse.dmTrials(opts.dmRange[0], opts.dmRange[1], opts.dmStep, headerValues["fch1"] + headerValues["foff"] * np.arange(outputChannels), samplingTime)
+    try:
+      dedisperser = dedisperse.Dedisperser(headerValues, dms, os.path.splitext(outFileName)[0], numberSamples, opts.numberSubbands, max(1, opts.numberWorkers))
+    except ValueError as error:
+      print error
+      sys.exit(0)
+    print ("Trial DMs: %d from %.3f to %.3f") % (dms.size, dms[0], dms[-1])
+
   # Extracting data from h5 files and writing to filterbank file.
-  for t0 in range(0, endIndex, chunkSize):
-    t1 = min(endIndex, t0 + chunkSize)
-    # TO DO: Replace missing packets in the data...
-    #timestampsChunkPol0 = dataH5FilePol0["Data/timestamps"][t0 + startIndexPol0]
-    #timestampsChunkPol1 = dataH5FilePol1["Data/timestamps"][t0 + startIndexPol1]
-    spectraChunkPol0 = dataH5FilePol0["Data/bf_raw"][:, t0 + startIndexPol0:t1 + startIndexPol0, :]
-    spectraChunkPol1 = dataH5FilePol1["Data/bf_raw"][:, t0 + startIndexPol1:t1 + startIndexPol1, :]
-    if fullStokes:
-      stokesIQUV = to_stokes(spectraChunkPol0, spectraChunkPol1)
-      if (decimationFactor > 1):
-        stokesIQUV = stokesIQUV.reshape(-1, 4, (chunkSize / decimationFactor), decimationFactor).mean(axis = 3)
-      bytesStokesIQUVFloat32 = stokesIQUV.T.astype(np.float32).tobytes(order = "C")
-      fileOut.write(bytesStokesIQUVFloat32)
+  numberWorkers = max(1, opts.numberWorkers)
+  if opts.follow and numberWorkers > 1:
+    print ("Follow mode converts in a single process.")
+    numberWorkers = 1
+  task = {"h5FilePol0": h5FilePol0, "h5FilePol1": h5FilePol1,
+          "spectra": spectra, "fillMode": opts.fillMode,
+          "decimationFactor": decimationFactor,
+          "fullStokes": fullStokes, "outFileName": outFileName, "header": header,
+          "numberSamples": numberSamples, "numberIFs": numberIFs, "sequentialWrite": opts.sequentialWrite,
+          "nbits": opts.nbits, "channels": channels, "fscrunch": fscrunch, "skSigma": opts.skSigma, "psrfits": None}
+  if opts.psrfits:
+    # Samples are detected in float and packed to 8 bits per subint by the sink.
+    import psrfits
+    frequencies = freqFirst + channelBW * fscrunch * np.arange(outputChannels)
+    psrfitsHeader = psrfits.primaryHeader(sourceName, rightAscension, declination, unixTime, frequencies.mean(), -outputChannels * channelBW * fscrunch, outputChannels)
+    task["psrfits"] = {"header": psrfitsHeader, "frequencies": frequencies, "samplingTime": samplingTime, "samplesPerSubint": opts.samplesPerSubint}
+    print ("PSRFITS subints of %d samples") % opts.samplesPerSubint
+  chunkSettings(task, chunkSize, layoutPol0, layoutPol1, opts.rescaleTime, samplingTime)
+
+  # Choosing the read span and number of workers from measurements on this host.
+  maxMemory = opts.maxMemory * 1024**2 if opts.maxMemory else None
+  if opts.autotune:
+    settings = "channels=%d-%d fscrunch=%d pol=%s nbits=%d fill=%s sk=%s seqwrite=%s psrfits=%s" % (channels[0], channels[1], fscrunch, bool(fullStokes), opts.nbits, opts.fillMode, opts.skSigma, bool(opts.sequentialWrite), opts.psrfits and opts.samplesPerSubint)
+    key = autotune.cacheKey(layoutPol0, decimationFactor, settings)
+    measurements = autotune.loadTuning(key, maxMemory)
+    if measurements is None:
+      calibrationSpectra = min(endIndex, int(opts.tuneTime * decimationFactor / samplingTime))
+      if opts.chunkSize:
+        chunkSizes = [chunkSize]
+      else:
+        chunkSizes = sorted(set(beamformerH5.spectraPerRead(layoutPol0, decimationFactor, None, size) for size in (64, 128, 256, 512, 1024, 2048, 4096)))
+        chunkSizes = [size for size in chunkSizes if size <= max(calibrationSpectra, chunkSizes[0])]
+      workerCounts = sorted(set([1 << i for i in range(8) if (1 << i) < multiprocessing.cpu_count()] + [multiprocessing.cpu_count()]))
+      print ("autotune: calibrating on %d spectra") % calibrationSpectra
+      measurements = autotune.calibrate(lambda size, workers: timeConfiguration(task, layoutPol0, layoutPol1, opts.rescaleTime, samplingTime, calibrationSpectra, size, workers),
+                                        lambda size, workers: workers * workerMemory(task, layoutPol0, size), chunkSizes, workerCounts, maxMemory)
+      autotune.saveTuning(key, measurements, maxMemory)
+    else:
+      print ("autotune: using cached measurements from %s") % autotune.cacheFileName
+    tuned = autotune.choose(measurements, maxMemory)
+    if tuned is None:
+      print ("autotune: no configuration fits in %.1f MB, keeping chunkSize %d and %d workers.") % (opts.maxMemory, chunkSize, numberWorkers)
+    else:
+      chunkSize = tuned["chunkSize"]
+      numberWorkers = tuned["numberWorkers"]
+      chunkSettings(task, chunkSize, layoutPol0, layoutPol1, opts.rescaleTime, samplingTime)
+      print ("autotune: chunkSize %d, %d workers, %.0f spectra/s") % (chunkSize, numberWorkers, tuned["rate"])
+  elif maxMemory is not None and numberWorkers * workerMemory(task, layoutPol0, chunkSize) > maxMemory:
+    print ("Estimated memory %.1f MB exceeds --max-mem.") % (numberWorkers * workerMemory(task, layoutPol0, chunkSize) / 1024.0**2)
+  print ("chunkSize: %d") % chunkSize
+  print ("numberWorkers: %d") % numberWorkers
+  if opts.nbits != 32:
+    print ("nbits: %d, rescale every %d spectra from the first %d") % (opts.nbits, task["intervalSpectra"], task["windowSpectra"])
+
+  # Resuming from the spans recorded in the checkpoint, or preallocating the
+  # output so that every span can be written at its own offset.
+  filledSamples = []
+  clipCounts = np.zeros(2, np.int64)
+  rfiBlocks = []
+  checkpointer = None
+  resumed = False
+  if opts.checkpointInterval or opts.resume:
+    settings = {"inputs": [[os.path.abspath(fileName), os.path.getsize(fileName)] for fileName in (h5FilePol0, h5FilePol1)],
+                "endIndex": endIndex, "chunkSize": chunkSize, "decimationFactor": decimationFactor, "intervalSpectra": task["intervalSpectra"],
+                "channels": channels, "fscrunch": fscrunch, "pol": bool(fullStokes), "nbits": opts.nbits, "fill": opts.fillMode, "sk": opts.skSigma,
+                "psrfits": opts.psrfits and opts.samplesPerSubint}
+    checkpointer = checkpoint.Checkpoint(checkpoint.checkpointFileName(outFileName), settings, opts.checkpointInterval or 60.0)
+    task["checkpoint"] = True
+  if opts.resume:
+    try:
+      resumed = checkpointer.load()
+    except ValueError as error:
+      print ("Cannot resume: %s") % error
+      sys.exit(0)
+    if resumed:
+      try:
+        sink = outputSink(task, numberSamples, create = False)
+        problem = checkpoint.outputMatches(outFileName, sink.headerBytes, sink.fileSize)
+        sink.close()
+      except (IOError, ValueError) as error:
+        problem = str(error)
+      if problem:
+        print ("Cannot resume: %s") % problem
+        sys.exit(0)
+      for start, end, results in checkpointer.done():
+        filledSamples.append(np.array(results["filled"], np.intp))
+        clipCounts += results["clip"]
+        rfiBlocks.extend((sample, length, np.array(flagged, np.intp)) for (sample, length, flagged) in results["rfi"])
+      print ("Resuming: %d of %d spectra already converted.") % (sum(end - start for (start, end, results) in checkpointer.done()), endIndex)
     else:
-      stokesI = to_stokesI(spectraChunkPol0, spectraChunkPol1, decimationFactor)
-      stokesI = np.require(stokesI, np.float32, requirements='C')
-      stokesI.tofile(fileOut)
-  fileOut.close()
+      print ("No checkpoint for %s, converting from the start.") % outFileName
+  if not opts.follow and not resumed:
+    outputSink(task, numberSamples).close()
+
+  tasks = []
+  if checkpointer is not None:
+    # Spans of one rescale interval, each recorded once it is on disk.
+    alignment = spanAlignment(task)
+    spanSpectra = alignment * ((task["intervalSpectra"] + alignment - 1) // alignment)
+    spans = []
+    for start, end in checkpointer.remaining(endIndex):
+      spans.extend(checkpointSpans(start, end, spanSpectra))
+  elif numberWorkers == 1:
+    spans = [(0, endIndex)]
+  else:
+    spans = splitSpans(endIndex, spanAlignment(task), numberWorkers)
+  for span in spans:
+    spanTask = dict(task)
+    spanTask["span"] = span
+    tasks.append(spanTask)
+  dataH5FilePol0.close()
+  dataH5FilePol1.close()
+  if opts.follow:
+    print ("Following %s and %s") % (h5FilePol0, h5FilePol1)
+    task["exporter"] = metricsExporter
+    numberSamples, followStageTimes, clipCounts, rfiBlocks = followConversion(task, (startIndexPol0, startIndexPol1), startSyncADC, opts.pollInterval, opts.followTimeout)
+    print ("Output samples: %d") % numberSamples
+    stageTimes.merge(followStageTimes)
+  elif numberWorkers == 1:
+    for spanTask in tasks:
+      spanTask["dedisperser"] = dedisperser
+      spanTask["exporter"] = metricsExporter
+      span, spanStageTimes, spanFilledSamples, spanClipCounts, spanRFIBlocks = convertSpan(spanTask)
+      stageTimes.merge(spanStageTimes)
+      filledSamples.extend(spanFilledSamples)
+      clipCounts += spanClipCounts
+      rfiBlocks.extend(spanRFIBlocks)
+      if checkpointer is not None:
+        checkpointer.record(span[0], span[1], spanResults(spanFilledSamples, spanClipCounts, spanRFIBlocks))
+        if checkpointer.due():
+          checkpointer.save()
+  else:
+    workerPool = multiprocessing.Pool(numberWorkers)
+    if dedisperser is None:
+      results = workerPool.imap_unordered(convertSpan, tasks)
+    else:
+      # Spans come back in order and are fed from the output file while the next ones are converted.
+      results = workerPool.imap(convertSpan, tasks)
+      reader = filterbank.FilterbankReader(outFileName)
+    for span, spanStageTimes, spanFilledSamples, spanClipCounts, spanRFIBlocks in results:
+      print ("Converted spectra %d-%d") % span
+      if dedisperser is not None:
+        dedisperser.feed(reader.data[span[0] // decimationFactor:span[1] // decimationFactor])
+      stageTimes.merge(spanStageTimes)
+      filledSamples.extend(spanFilledSamples)
+      clipCounts += spanClipCounts
+      rfiBlocks.extend(spanRFIBlocks)
+      if checkpointer is not None:
+        checkpointer.record(span[0], span[1], spanResults(spanFilledSamples, spanClipCounts, spanRFIBlocks))
+        if checkpointer.due():
+          checkpointer.save()
+      metricsExporter.update()
+    workerPool.close()
+    workerPool.join()
+  stageTimes.count("clippedValues", clipCounts.sum())
+  stageTimes.report()
+  metricsExporter.close()
+  if dedisperser is not None:
+    dedisperser.close()
+    dedisperser.report()
+  if opts.nbits != 32:
+    requantise.reportClipping(clipCounts, numberSamples * numberIFs * outputChannels)
+
+  # Listing the channel-blocks replaced as RFI.
+  if opts.skSigma:
+    numberBlocks = ((numberSamples * decimationFactor + chunkSize - 1) // chunkSize) * outputChannels
+    numberFlagged = sum(block[2].size for block in rfiBlocks)
+    print ("Flagged channel-blocks: %d of %d (%.4f%%)") % (numberFlagged, numberBlocks, 100.0 * numberFlagged / max(numberBlocks, 1))
+    beamformerH5.writeRFIMask(outFileName + ".rfi", rfiBlocks)
+
+  # Listing the output samples made up from missing spectra.
+  if opts.fillMode:
+    filledSamples = np.concatenate(filledSamples + [np.zeros(0, np.intp)])
+    print ("Filled output samples: %d") % filledSamples.size
+    beamformerH5.writeMask(outFileName + ".mask", filledSamples)
+
+  # The conversion is complete, nothing is left to resume.
+  if checkpointer is not None:
+    checkpointer.remove()
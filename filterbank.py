@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 by Maciej Serylak
+# Licensed under the Academic Free License version 3.0
+# This program comes with ABSOLUTELY NO WARRANTY.
+# You are free to modify and redistribute this code as long
+# as you do not remove the above attribution and reasonably
+# inform recipients that you have modified the original work.
+
+# SIGPROC filterbank header, reader and output shared by the converter scripts.
+
+import os
+import struct
+import ctypes
+import ctypes.util
+import numpy as np
+
+
+# Sample types of the supported SIGPROC nbits values.
+nbitsTypes = {32: np.float32, 16: np.uint16, 8: np.uint8}
+
+
+# SIGPROC header keywords and the types of their values.
+headerParameters = {
+"telescope_id": "i",
+"machine_id": "i",
+"data_type": "i",
+"rawdatafile": "str",
+"source_name": "str",
+"barycentric": "i",
+"pulsarcentric": "i",
+"az_start": "d",
+"za_start": "d",
+"src_raj": "d",
+"src_dej": "d",
+"tstart": "d",
+"tsamp": "d",
+"nbits": "i",
+"nsamples": "i",
+"fch1": "d",
+"foff": "d",
+"nchans": "i",
+"nifs": "i",
+"refdm": "d",
+"period": "d",
+"nbeams": "i",
+"ibeam": "i",
+"signed": "b"}
+
+
+def _packString(string):
+  return struct.pack("i", len(string)) + string
+
+
+def headerEntry(key, value):
+  """
+  Return the packed SIGPROC header entry for key and value.
+  """
+  if key not in headerParameters:
+    raise ValueError("Unknown SIGPROC header key: %s" % key)
+  valueType = headerParameters[key]
+  if valueType == "str":
+    return _packString(key) + _packString(value)
+  elif valueType == "d":
+    return _packString(key) + struct.pack("d", float(value))
+  elif valueType == "b":
+    return _packString(key) + struct.pack("b", int(value))
+  else:
+    return _packString(key) + struct.pack("i", int(value))
+
+
+def makeHeader(parameters):
+  """
+  Return a packed SIGPROC header.
+    Inputs:
+      parameters: sequence of (key, value) pairs, written in that order.
+    Output:
+      header: header string from HEADER_START to HEADER_END.
+  """
+  entries = [_packString("HEADER_START")]
+  for key, value in parameters:
+    entries.append(headerEntry(key, value))
+  entries.append(_packString("HEADER_END"))
+  return "".join(entries)
+
+
+def readHeader(fileName):
+  """
+  Parse the header of a SIGPROC filterbank file.
+    Inputs:
+      fileName: input file name.
+    Output:
+      header: dictionary with header keys and values.
+      headerSize: number of bytes before the data.
+  """
+  fileIn = open(fileName, "rb")
+  def readString():
+    length = struct.unpack("i", fileIn.read(4))[0]
+    if length < 1 or length > 80:
+      raise ValueError("%s is not a SIGPROC filterbank file." % fileName)
+    return fileIn.read(length)
+  if readString() != "HEADER_START":
+    raise ValueError("%s is not a SIGPROC filterbank file." % fileName)
+  header = {}
+  while True:
+    key = readString()
+    if key == "HEADER_END":
+      break
+    if key not in headerParameters:
+      raise ValueError("Unknown SIGPROC header key: %s" % key)
+    valueType = headerParameters[key]
+    if valueType == "str":
+      header[key] = readString()
+    elif valueType == "d":
+      header[key] = struct.unpack("d", fileIn.read(8))[0]
+    elif valueType == "b":
+      header[key] = struct.unpack("b", fileIn.read(1))[0]
+    else:
+      header[key] = struct.unpack("i", fileIn.read(4))[0]
+  headerSize = fileIn.tell()
+  fileIn.close()
+  return header, headerSize
+
+
+class FilterbankReader(object):
+  """
+  SIGPROC filterbank file with the data memory-mapped as
+  (numberSamples, numberIFs, numberChannels). All the accessors return
+  views, so only the bytes actually used are read from disk.
+    Inputs:
+      fileName: input file name.
+  """
+  def __init__(self, fileName):
+    self.fileName = fileName
+    self.header, self.headerSize = readHeader(fileName)
+    self.numberChannels = self.header["nchans"]
+    self.numberIFs = self.header.get("nifs", 1)
+    self.nbits = self.header["nbits"]
+    if self.nbits not in nbitsTypes:
+      raise ValueError("Reading %d-bit data not supported." % self.nbits)
+    self.dtype = np.dtype(nbitsTypes[self.nbits])
+    self.bytesPerSample = self.numberIFs * self.numberChannels * self.dtype.itemsize
+    self.numberSamples = (os.path.getsize(fileName) - self.headerSize) // self.bytesPerSample
+    if self.numberSamples > 0:
+      self.data = np.memmap(fileName, self.dtype, "r", self.headerSize, (self.numberSamples, self.numberIFs, self.numberChannels))
+    else:
+      self.data = np.zeros((0, self.numberIFs, self.numberChannels), self.dtype)
+
+  def frequencies(self):
+    """
+    Return the centre frequency of every channel in MHz.
+    """
+    return self.header["fch1"] + self.header["foff"] * np.arange(self.numberChannels)
+
+  def spectra(self, start, end, ifIndex = None):
+    """
+    Return samples start..end, (time, IFs, channels) or (time, channels)
+    for a single IF.
+    """
+    if ifIndex is None:
+      return self.data[start:end]
+    return self.data[start:end, ifIndex]
+
+  def channel(self, channel, ifIndex = 0, start = 0, end = None):
+    """
+    Return the strided time series of one channel.
+    """
+    return self.data[start:end, ifIndex, channel]
+
+  def blocks(self, blockSize, start = 0, end = None, overlap = 0):
+    """
+    Iterate over (firstSample, block) with blocks of blockSize samples,
+    each extended by overlap samples shared with the next block.
+    """
+    if end is None or end > self.numberSamples:
+      end = self.numberSamples
+    for first in range(start, end, blockSize):
+      yield first, self.data[first:min(end, first + blockSize + overlap)]
+
+  def close(self):
+    self.data = None
+
+
+def _preallocate(fileOut, size):
+  """
+  Reserve size bytes for the file on disk (posix_fallocate), falling back
+  to a sparse ftruncate where the filesystem does not support it.
+  """
+  fileOut.flush()
+  fileDescriptor = fileOut.fileno()
+  try:
+    os.posix_fallocate(fileDescriptor, 0, size) # Python 3.3+
+    return
+  except AttributeError:
+    pass
+  except OSError:
+    os.ftruncate(fileDescriptor, size)
+    return
+  libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+  libc.posix_fallocate.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+  if libc.posix_fallocate(fileDescriptor, 0, size) != 0:
+    os.ftruncate(fileDescriptor, size)
+
+
+class FilterbankSink(object):
+  """
+  SIGPROC filterbank file with the header written and the data preallocated.
+  In the default mode the data region is a writable np.memmap with shape
+  (numberSamples, numberIFs, numberChannels), so producers can fill it in
+  any order, from several processes, without intermediate copies.
+  In sequential mode writes go through one large page-aligned buffer that is
+  flushed with plain writes, for filesystems where mmap writes are slow.
+    Inputs:
+      fileName: output file name.
+      header: packed SIGPROC header.
+      numberSamples: number of output samples, None to grow the file as
+                     data is appended (sequential mode only).
+      numberIFs, numberChannels: shape of one output sample.
+      nbits: bits per value, 32 (float), 16 or 8 (unsigned) (default: 32).
+      sequential: use the buffered sequential writer (default: False).
+      create: write the header and preallocate the file. Set to False to
+              attach to a file already created by another process
+              (default: True).
+      bufferBytes: size of the sequential write buffer (default: 64 MiB).
+  """
+  def __init__(self, fileName, header, numberSamples, numberIFs, numberChannels, nbits = 32, sequential = False, create = True, bufferBytes = 64 * 1024**2):
+    if nbits not in nbitsTypes:
+      raise ValueError("Writing %d-bit data not supported." % nbits)
+    if numberSamples is None and not sequential:
+      raise ValueError("Memory-mapped output needs the number of samples.")
+    self.fileName = fileName
+    self.headerBytes = header
+    self.headerSize = len(header)
+    self.numberSamples = numberSamples
+    self.sampleShape = (numberIFs, numberChannels)
+    self.dtype = np.dtype(nbitsTypes[nbits])
+    self.bytesPerSample = numberIFs * numberChannels * self.dtype.itemsize
+    self.sequential = sequential
+    self.fileSize = None if numberSamples is None else self.headerSize + numberSamples * self.bytesPerSample
+    if create:
+      fileOut = open(fileName, "wb")
+      fileOut.write(header)
+      if numberSamples is not None:
+        _preallocate(fileOut, self.fileSize)
+      fileOut.close()
+    elif numberSamples is not None and os.path.getsize(fileName) != self.fileSize:
+      raise ValueError("%s does not have the expected size." % fileName)
+    if sequential:
+      self.data = None
+      self.fileOut = open(fileName, "r+b", 0)
+      self.fileOut.seek(0, os.SEEK_END)
+      self.position = self.fileOut.tell() if numberSamples is None else self.headerSize
+      self.fileOut.seek(self.position)
+      rawBuffer = np.empty(bufferBytes + 4096, np.uint8)
+      alignment = (-rawBuffer.ctypes.data) % 4096
+      self.buffer = rawBuffer[alignment:alignment + bufferBytes]
+      self.bufferFill = 0
+    elif numberSamples > 0:
+      self.data = np.memmap(fileName, self.dtype, "r+", self.headerSize, (numberSamples,) + self.sampleShape)
+    else:
+      self.data = np.zeros((0,) + self.sampleShape, self.dtype)
+
+  def _flush(self):
+    if self.bufferFill:
+      self.fileOut.write(self.buffer[:self.bufferFill])
+      self.position += self.bufferFill
+      self.bufferFill = 0
+
+  def write(self, sample, values):
+    """
+    Store values (samples, IFs, channels) starting at output sample sample.
+    """
+    values = np.asarray(values, self.dtype)
+    if not self.sequential:
+      self.data[sample:sample + values.shape[0]] = values.reshape((-1,) + self.sampleShape)
+      return
+    offset = self.headerSize + sample * self.bytesPerSample
+    if offset != self.position + self.bufferFill:
+      self._flush()
+      self.fileOut.seek(offset)
+      self.position = offset
+    raw = np.ascontiguousarray(values).view(np.uint8).reshape(-1)
+    while raw.size:
+      if self.bufferFill == 0 and raw.size >= self.buffer.size:
+        self.fileOut.write(raw)
+        self.position += raw.size
+        break
+      count = min(raw.size, self.buffer.size - self.bufferFill)
+      self.buffer[self.bufferFill:self.bufferFill + count] = raw[:count]
+      self.bufferFill += count
+      raw = raw[count:]
+      if self.bufferFill == self.buffer.size:
+        self._flush()
+
+  def append(self, values):
+    """
+    Store values after the last sample written (sequential mode).
+    """
+    self.write((self.position + self.bufferFill - self.headerSize) // self.bytesPerSample, values)
+
+  def flush(self):
+    """
+    Make sure every sample written so far is on disk.
+    """
+    if self.sequential:
+      self._flush()
+      os.fsync(self.fileOut.fileno())
+    elif isinstance(self.data, np.memmap):
+      self.data.flush()
+
+  def close(self):
+    if self.sequential:
+      self._flush()
+      self.fileOut.close()
+    elif isinstance(self.data, np.memmap):
+      self.data.flush()
+    self.data = None
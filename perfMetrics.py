@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 by Maciej Serylak
+# Licensed under the Academic Free License version 3.0
+# This program comes with ABSOLUTELY NO WARRANTY.
+# You are free to modify and redistribute this code as long
+# as you do not remove the above attribution and reasonably
+# inform recipients that you have modified the original work.
+
+# Performance metrics of the converters: time per pipeline stage and
+# counts of data processed, reported at the end and exported while the
+# conversion runs as JSON lines and a Prometheus textfile.
+
+import os
+import json
+import time
+import socket
+import threading
+
+# Stages in the order they are reported.
+stageNames = ("read", "compute", "quantise", "write")
+
+# Counters and their Prometheus names and help.
+counterNames = [("spectra", "converter_spectra_total", "Input spectra processed."),
+                ("samples", "converter_samples_total", "Output samples written."),
+                ("bytesIn", "converter_bytes_in_total", "Bytes read from the input."),
+                ("bytesOut", "converter_bytes_out_total", "Bytes written to the output."),
+                ("droppedSpectra", "converter_dropped_spectra_total", "Spectra missing from the input."),
+                ("filledSamples", "converter_filled_samples_total", "Output samples filled in for missing spectra."),
+                ("clippedValues", "converter_clipped_values_total", "Output values clipped by requantisation."),
+                ("flaggedBlocks", "converter_flagged_blocks_total", "Channel-blocks replaced as RFI.")]
+
+
+class Metrics(object):
+  """
+  Accumulate busy and stalled wall-clock time for each pipeline stage and
+  counters of the data processed. Metrics of workers are combined with
+  merge(). The pipeline threads of a conversion update the same Metrics
+  while the exporter reads them, so every access holds a lock.
+  """
+  def __init__(self):
+    self.startTime = time.time()
+    self.busy = {}
+    self.stalled = {}
+    self.counters = {}
+    self.lock = threading.Lock()
+
+  def __getstate__(self):
+    # Metrics of worker processes are pickled, the lock is not.
+    with self.lock:
+      state = dict(self.__dict__, busy = dict(self.busy), stalled = dict(self.stalled), counters = dict(self.counters))
+    del state["lock"]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.lock = threading.Lock()
+
+  def add(self, stage, busy = 0.0, stalled = 0.0):
+    with self.lock:
+      self.busy[stage] = self.busy.get(stage, 0.0) + busy
+      self.stalled[stage] = self.stalled.get(stage, 0.0) + stalled
+
+  def count(self, name, value = 1):
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + int(value)
+
+  def merge(self, other):
+    state = other.__getstate__()
+    for stage in state["busy"]:
+      self.add(stage, state["busy"][stage], state["stalled"][stage])
+    for name in state["counters"]:
+      self.count(name, state["counters"][name])
+
+  def snapshot(self):
+    """
+    Return the metrics as a dictionary, with rates over the time elapsed
+    since the metrics were created.
+    """
+    elapsed = time.time() - self.startTime
+    with self.lock:
+      stages = dict((stage, {"busy": self.busy[stage], "stalled": self.stalled[stage]}) for stage in self.busy)
+      counters = dict(self.counters)
+    rates = {}
+    for name in ("spectra", "bytesIn", "bytesOut"):
+      rates[name + "PerSecond"] = counters.get(name, 0) / elapsed if elapsed > 0 else 0.0
+    return {"elapsed": elapsed, "stages": stages, "counters": counters, "rates": rates}
+
+  def report(self):
+    values = self.snapshot()
+    stages, counters = values["stages"], values["counters"]
+    for stage in stageNames:
+      if stage in stages:
+        print ("%s stage: busy %.2f s, stalled %.2f s") % (stage, stages[stage]["busy"], stages[stage]["stalled"])
+    if counters.get("spectra") or counters.get("bytesIn"):
+      print ("Processed %d spectra, %.1f MB in, %.1f MB out in %.1f s (%.1f MB/s in, %.0f spectra/s)") % (counters.get("spectra", 0), counters.get("bytesIn", 0) / 1024.0**2, counters.get("bytesOut", 0) / 1024.0**2,
+                                                                                                   values["elapsed"], values["rates"]["bytesInPerSecond"] / 1024.0**2, values["rates"]["spectraPerSecond"])
+    for name in ("droppedSpectra", "filledSamples"):
+      if counters.get(name):
+        print ("%s: %d") % (name, counters[name])
+
+
+def _labels(labels):
+  return ",".join("%s=\"%s\"" % (key, str(labels[key]).replace("\\", "\\\\").replace("\"", "\\\"")) for key in sorted(labels))
+
+
+def prometheusText(values, labels, running):
+  """
+  Return the metrics snapshot in the Prometheus text exposition format.
+  """
+  lines = ["# HELP converter_running 1 while the conversion runs, 0 once it has finished.",
+           "# TYPE converter_running gauge",
+           "converter_running{%s} %d" % (_labels(labels), running),
+           "# HELP converter_elapsed_seconds Wall-clock time since the conversion started.",
+           "# TYPE converter_elapsed_seconds gauge",
+           "converter_elapsed_seconds{%s} %.3f" % (_labels(labels), values["elapsed"])]
+  for kind in ("busy", "stalled"):
+    lines.append("# HELP converter_stage_%s_seconds Time each stage spent %s." % (kind, "working" if kind == "busy" else "waiting for the other stages"))
+    lines.append("# TYPE converter_stage_%s_seconds counter" % kind)
+    for stage in sorted(values["stages"]):
+      lines.append("converter_stage_%s_seconds{%s} %.6f" % (kind, _labels(dict(labels, stage = stage)), values["stages"][stage][kind]))
+  for name, metricName, helpText in counterNames:
+    if name in values["counters"]:
+      lines.append("# HELP %s %s" % (metricName, helpText))
+      lines.append("# TYPE %s counter" % metricName)
+      lines.append("%s{%s} %d" % (metricName, _labels(labels), values["counters"][name]))
+  return "\n".join(lines) + "\n"
+
+
+class MetricsExporter(object):
+  """
+  Export Metrics every interval seconds while a conversion runs and once
+  at the end: one JSON object per line appended to jsonFileName, and the
+  latest values in the Prometheus textfile promFileName (replaced
+  atomically, for the node exporter textfile collector).
+    Inputs:
+      metrics: Metrics of the conversion.
+      script: name of the converter.
+      output: output file name, labels the exported metrics.
+      jsonFileName, promFileName: exported files, None to skip.
+      interval: seconds between exports (default: 10).
+  """
+  def __init__(self, metrics, script, output, jsonFileName = None, promFileName = None, interval = 10.0):
+    self.metrics = metrics
+    self.labels = {"script": script, "output": os.path.abspath(output), "host": socket.gethostname()}
+    self.jsonFileName = jsonFileName
+    self.promFileName = promFileName
+    self.interval = interval
+    self.lastExport = time.time()
+
+  def update(self, *pending):
+    """
+    Export if interval seconds have passed, including the metrics of work
+    in progress not yet merged into the conversion's metrics.
+    """
+    if (self.jsonFileName or self.promFileName) and time.time() - self.lastExport >= self.interval:
+      self.export(pending)
+
+  def export(self, pending = (), final = False):
+    combined = Metrics()
+    combined.startTime = self.metrics.startTime
+    for metrics in (self.metrics,) + tuple(pending):
+      combined.merge(metrics)
+    values = combined.snapshot()
+    if self.jsonFileName:
+      record = dict(values, time = time.time(), final = final, **self.labels)
+      fileOut = open(self.jsonFileName, "a")
+      fileOut.write(json.dumps(record, sort_keys = True) + "\n")
+      fileOut.close()
+    if self.promFileName:
+      temporaryName = "%s.%d" % (self.promFileName, os.getpid())
+      fileOut = open(temporaryName, "w")
+      fileOut.write(prometheusText(values, self.labels, 0 if final else 1))
+      fileOut.close()
+      os.rename(temporaryName, self.promFileName) # the collector never reads a partial file
+    self.lastExport = time.time()
+
+  def close(self):
+    """
+    Export the final metrics.
+    """
+    if self.jsonFileName or self.promFileName:
+      self.export(final = True)
+
+
+def addOptions(parser):
+  """
+  Add the metrics options to an optparse or argparse command line parser.
+  """
+  add = parser.add_argument if hasattr(parser, "add_argument") else parser.add_option
+  add("--metrics", dest = "metricsFileName", metavar = "<metricsFileName>", help = "Give file to append performance metrics to as JSON lines.")
+  add("--prom", dest = "promFileName", metavar = "<promFileName>", help = "Give Prometheus textfile to keep the latest performance metrics in.")
+  add("--metrics-interval", type = float, dest = "metricsInterval", metavar = "<metricsInterval>", default = 10.0, help = "Give seconds between metrics exports (default: 10).")
+
+
+def exporterFromOptions(opts, metrics, script, output):
+  """
+  Return the MetricsExporter set up by the options of addOptions().
+  """
+  return MetricsExporter(metrics, script, output, opts.metricsFileName, opts.promFileName, opts.metricsInterval)
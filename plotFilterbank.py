@@ -15,7 +15,7 @@ import argparse
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import cm
-from sigpyproc.Readers import FilReader
+import filterbank
 
 
 __version__ = 1.3
@@ -48,10 +48,10 @@ if __name__=='__main__':
     filterbankFileName = args.filterbankFileName
 
   # Define constants and variables.
-  filterbankFile = FilReader(filterbankFileName) # read filterbank file
+  filterbankFile = filterbank.FilterbankReader(filterbankFileName) # memory-map filterbank file
   #print 'File %s opened.' % (filterbankFilename)
-  numberChannels = filterbankFile.header.nchans # get number of spectral channels
-  numberSpectra = filterbankFile.header.nsamples # get number of spectra/samples
+  numberChannels = filterbankFile.numberChannels # get number of spectral channels
+  numberSpectra = filterbankFile.numberSamples # get number of spectra/samples
 
   # Only one option for plotting is allowed.
   if (args.spectrum and args.dynamic) or\
@@ -71,7 +71,7 @@ if __name__=='__main__':
     if (spectrum >= numberSpectra):
       spectrum = numberSpectra-1
       print 'Selected spectrum exceeds available number of spectra!'
-    singleSpectrum = filterbankFile.readBlock(spectrum, 1) # read specific spectrum from the data
+    singleSpectrum = filterbankFile.spectra(spectrum, spectrum + 1, 0)[0] # read specific spectrum from the data
     plt.plot(singleSpectrum)
     plt.xlabel('Channel number')
     plt.ylabel('Intensity (a.u.)')
@@ -88,8 +88,8 @@ if __name__=='__main__':
     if (block[-1] >= numberSpectra):
       block[-1] = numberSpectra-1
       print 'Selected spectrum exceeds available number of spectra!'
-    blockSpectrum = filterbankFile.readBlock(block[0], block[-1]) # read specific spectrum from the data
-    blockBandpass = blockSpectrum.get_bandpass() # calculate bandpass from entire observation
+    blockSpectrum = filterbankFile.spectra(block[0], block[-1], 0) # read specific spectrum from the data
+    blockBandpass = blockSpectrum.sum(axis = 0, dtype = np.float64) # calculate bandpass from the block
     plt.plot(blockBandpass)
     plt.xlabel('Channel number')
     plt.ylabel('Intensity (a.u.)')
@@ -110,7 +110,7 @@ if __name__=='__main__':
     if (dynamic[-1] >= numberSpectra):
       dynamic[-1] = numberSpectra-1
       print 'Selected spectrum exceeds available number of spectra!'
-    dynamicSpectrum = filterbankFile.readBlock(dynamic[0], dynamic[-1]) # read specific spectrum from the data
+    dynamicSpectrum = filterbankFile.spectra(dynamic[0], dynamic[-1], 0).T # read specific spectrum from the data
     dynamicSpectrumMax = dynamicSpectrum.max().item() * cutoff
     plt.imshow(dynamicSpectrum, vmax = dynamicSpectrumMax, origin='lower', cmap = cm.hot, interpolation='nearest', aspect='auto')
     plt.colorbar()
@@ -134,9 +134,7 @@ if __name__=='__main__':
     if (channel >= numberChannels):
       channel = numberChannels-1
       print 'Selected channel exceeds available number of channels!'
-    timeseriesChannel = filterbankFile.getChan(channel)
-    timeseriesChannel.shape
-    timeseriesSelected = timeseriesChannel[begin:end]
+    timeseriesSelected = filterbankFile.channel(channel, 0, begin, end) # strided view, only these spectra are read
     plt.plot(timeseriesSelected)
     plt.xlabel('Spectrum number')
     plt.ylabel('Intensity (a.u.)')
@@ -147,7 +145,10 @@ if __name__=='__main__':
       plt.savefig(baseFilterbankFilename + '_timeseries_ch' + str(channel) + '_' + str(begin) + '-' + str(end) + '.png')
       sys.exit(0)
   elif args.bandpass:
-    totalBandpass = filterbankFile.bandpass() # calculate bandpass from entire observation
+    totalBandpass = np.zeros(numberChannels, dtype = np.float64)
+    for blockStart, blockSpectra in filterbankFile.blocks(65536): # calculate bandpass from entire observation
+      totalBandpass += blockSpectra[:, 0, :].sum(axis = 0, dtype = np.float64)
+    totalBandpass /= max(numberSpectra, 1)
     plt.plot(totalBandpass)
     plt.xlabel('Channel number')
     plt.ylabel('Intensity (a.u.)')
@@ -10,23 +10,12 @@
 import numpy as np
 import os
 import sys
-import struct
 import ephem
 import datetime
+import time
 import optparse as opt
-
-# Functions used in SIGPROC header creation
-def _write_string(key, value):
-  return "".join([struct.pack("I", len(key)), key, struct.pack("I", len(value)), value])
-
-def _write_int(key, value):
-  return "".join([struct.pack("I",len(key)), key, struct.pack("I", value)])
-
-def _write_double(key, value):
-  return "".join([struct.pack("I",len(key)), key, struct.pack("d", value)])
-
-def _write_char(key, value):
-  return "".join([struct.pack("I",len(key)), key, struct.pack("b", value)])
+import filterbank
+import perfMetrics
 
 # Main body of the script
 if __name__=="__main__":
@@ -42,7 +31,10 @@ if __name__=="__main__":
   cmdline.add_option("--dec", type = "string", dest = "declination", metavar = "<declination>", default = "-45:10:34.8751", help = "Give declination of the source.")
   cmdline.add_option('--raw', type = 'string', dest = 'f_engineFile', metavar = '<f_engineFile>', help = 'Give input filename.')
   cmdline.add_option('--out', type = 'string', dest = 'outFileName', metavar = '<outFileName>', default = 'out.fil', help = 'Give output filename.')
+  perfMetrics.addOptions(cmdline)
   (opts, args) = cmdline.parse_args() # reading cmd options
+  metrics = perfMetrics.Metrics()
+  metricsExporter = perfMetrics.exporterFromOptions(opts, metrics, "prepareFeng", opts.outFileName)
   if not opts.f_engineFile:
     cmdline.print_usage()
     sys.exit(0)
@@ -81,32 +73,29 @@ if __name__=="__main__":
   #print blockSize
   numberOfItems = blockSize
   #print numberOfItems
-  fileOut = open(outFileName, "ab+")
-  headerStart = "HEADER_START"
-  headerEnd = "HEADER_END"
-  header = "".join([struct.pack("I", len(headerStart)), headerStart])
-  header = "".join([header, _write_string("source_name", sourceName)])
-  header = "".join([header, _write_int("machine_id", 13)])
-  header = "".join([header, _write_int("telescope_id", 64)])
   src_raj = float(rightAscension.replace(":", ""))
-  header = "".join([header, _write_double("src_raj", src_raj)])
   src_dej = float(declination.replace(":", ""))
-  header = "".join([header, _write_double("src_dej", src_dej)])
-  header = "".join([header, _write_int("data_type", 1)])
-  header = "".join([header, _write_double("fch1", 2021.6093750)])
-  header = "".join([header, _write_double("foff", -0.390625)])
-  header = "".join([header, _write_int("nchans", numberChannels)])
-  header = "".join([header, _write_int("nbits", 32)])
-  header = "".join([header, _write_double("tstart", startTimeMJD)])
-  header = "".join([header, _write_double("tsamp", samplingTime)])
-  header = "".join([header, _write_int("nifs", 1)])
-  header = "".join([header, struct.pack("I", len(headerEnd)), headerEnd])
-  fileOut.write(header)
+  header = filterbank.makeHeader([("source_name", sourceName),
+                                  ("machine_id", 13),
+                                  ("telescope_id", 64),
+                                  ("src_raj", src_raj),
+                                  ("src_dej", src_dej),
+                                  ("data_type", 1),
+                                  ("fch1", 2021.6093750),
+                                  ("foff", -0.390625),
+                                  ("nchans", numberChannels),
+                                  ("nbits", 32),
+                                  ("tstart", startTimeMJD),
+                                  ("tsamp", samplingTime),
+                                  ("nifs", 1)])
+  sink = filterbank.FilterbankSink(outFileName, header, int(spectraNumber), 1, numberChannels)
   fileIn = open(f_engineFile, "rb")
-  fileOut = open(outFileName, "ab+")
   for spectrum in range(int(spectraNumber)):
+    readStart = time.time()
     fileIn.seek(blockSize * spectrum, os.SEEK_SET)
     binaryDataArray = np.fromfile(fileIn, dtype = np.uint8, count = numberOfItems)
+    computeStart = time.time()
+    metrics.add("read", busy = computeStart - readStart)
     realDataArray = np.bitwise_and(binaryDataArray, 0x0f)
     #imagDataArray = np.bitwise_and(binaryDataArray >> 4, 0x0f)
     evenChanPol0 = realDataArray[::4]
@@ -122,7 +111,16 @@ if __name__=="__main__":
     xPolFloat32 = xPol.astype(dtype = np.float32)
     yPolFloat32 = yPol.astype(dtype = np.float32)
     totalIntensity = (xPolFloat32 * xPolFloat32) + (yPolFloat32 * yPolFloat32)
-    bytesTotalIntensity = totalIntensity.tobytes(order = "C")
-    fileOut.seek(0, 2) # Move pointer to the end of file.
-    fileOut.write(bytesTotalIntensity)
-  fileOut.close()
+    sink.data[spectrum, 0, :] = totalIntensity
+    metrics.add("compute", busy = time.time() - computeStart)
+    metrics.count("spectra")
+    metrics.count("bytesIn", binaryDataArray.nbytes)
+    metrics.count("samples")
+    metrics.count("bytesOut", sink.bytesPerSample)
+    metricsExporter.update()
+  fileIn.close()
+  writeStart = time.time()
+  sink.close()
+  metrics.add("write", busy = time.time() - writeStart) # pages of the memory map still to be written
+  metrics.report()
+  metricsExporter.close()
@@ -10,24 +10,79 @@
 import numpy as np
 import h5py
 import os
-import struct
 import sys
 import ephem
 import datetime
+import time
 import optparse as opt
+import beamformerH5
+import filterbank
+import requantise
+import dedisperse
+import perfMetrics
 
-# Functions used in SIGPROC header creation
-def _write_string(key, value):
-  return "".join([struct.pack("I", len(key)), key, struct.pack("I", len(value)), value])
-
-def _write_int(key, value):
-  return "".join([struct.pack("I",len(key)), key, struct.pack("I", value)])
-
-def _write_double(key, value):
-  return "".join([struct.pack("I",len(key)), key, struct.pack("d", value)])
+def detectSpectra(spectraChunkPol0, spectraChunkPol1, chunkLength, decimationFactor, fullStokes, out, fscrunch = 1):
+  """
+  Form Stokes I or full Stokes from chunkLength spectra of both
+  polarisations, averaged over decimationFactor spectra and fscrunch
+  channels, into out (time, IFs, channels).
+  """
+  channelNumber = spectraChunkPol0.shape[0]
+  spectraChunkComplexPol0 = spectraChunkPol0[:, :chunkLength, 0] + 1j * spectraChunkPol0[:, :chunkLength, 1]
+  spectraChunkComplexPol1 = spectraChunkPol1[:, :chunkLength, 0] + 1j * spectraChunkPol1[:, :chunkLength, 1]
+  if fullStokes:
+    if (decimationFactor > 1):
+      stokesI = ((((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) + (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).reshape(-1, (chunkLength / decimationFactor), decimationFactor).mean(axis = 2)).T
+      stokesQ = ((((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) - (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).reshape(-1, (chunkLength / decimationFactor), decimationFactor).mean(axis = 2)).T
+      stokesU = ((((spectraChunkComplexPol0 * spectraChunkComplexPol1.conjugate()) + (spectraChunkComplexPol0.conjugate() * spectraChunkComplexPol1)).real).reshape(-1, (chunkLength / decimationFactor), decimationFactor).mean(axis = 2)).T
+      stokesV = ((((spectraChunkComplexPol0 * spectraChunkComplexPol1.conjugate()) - (spectraChunkComplexPol0.conjugate() * spectraChunkComplexPol1)).imag).reshape(-1, (chunkLength / decimationFactor), decimationFactor).mean(axis = 2)).T
+      stokesIQUV = np.concatenate((stokesI, stokesQ, stokesU, stokesV), axis = 1)
+      stokesIQUV = stokesIQUV.reshape((chunkLength * 4) / decimationFactor, channelNumber)
+    else:
+      stokesI = (((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) + (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).T
+      stokesQ = (((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) - (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).T
+      stokesU = (((spectraChunkComplexPol0 * spectraChunkComplexPol1.conjugate()) + (spectraChunkComplexPol0.conjugate() * spectraChunkComplexPol1)).real).T
+      stokesV = (((spectraChunkComplexPol0 * spectraChunkComplexPol1.conjugate()) - (spectraChunkComplexPol0.conjugate() * spectraChunkComplexPol1)).imag).T
+      stokesIQUV = np.concatenate((stokesI, stokesQ, stokesU, stokesV), axis = 1)
+      stokesIQUV = stokesIQUV.reshape(chunkLength * 4, channelNumber)
+    stokesIQUV = stokesIQUV.reshape(-1, 4, channelNumber)
+    if (fscrunch > 1):
+      stokesIQUV = stokesIQUV.reshape(-1, 4, channelNumber / fscrunch, fscrunch).mean(axis = 3)
+    out[:] = stokesIQUV
+  else:
+    if (decimationFactor > 1):
+      stokesI = ((((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) + (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).reshape(-1, (chunkLength / decimationFactor), decimationFactor).mean(axis = 2)).T
+    else:
+      stokesI = (((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) + (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).T
+    if (fscrunch > 1):
+      stokesI = stokesI.reshape(-1, channelNumber / fscrunch, fscrunch).mean(axis = 2)
+    out[:, 0, :] = stokesI
+  return out
 
-def _write_char(key, value):
-  return "".join([struct.pack("I",len(key)), key, struct.pack("b", value)])
+def windowScaling(datasetPol0, datasetPol1, spectra, windowStart, windowEnd, chunkSize, decimationFactor, fullStokes, fillMode, nbits, channels, fscrunch, skSigma):
+  """
+  Scale and offset for the requantisation interval starting at spectrum
+  windowStart, from the statistics of spectra windowStart..windowEnd.
+  """
+  numberIFs = 4 if fullStokes else 1
+  channelNumber = channels[1] - channels[0]
+  statistics = requantise.RunningStatistics(numberIFs, channelNumber / fscrunch)
+  spectraChunkPol0 = np.empty((channelNumber, chunkSize, 2), datasetPol0.dtype)
+  spectraChunkPol1 = np.empty((channelNumber, chunkSize, 2), datasetPol1.dtype)
+  values = np.empty((chunkSize / decimationFactor, numberIFs, channelNumber / fscrunch), np.float32)
+  for t0 in range(windowStart, windowEnd, chunkSize):
+    t1 = min(windowEnd, t0 + chunkSize)
+    beamformerH5.readSpectra(datasetPol0, spectra, 0, t0, t1, spectraChunkPol0, channels)
+    beamformerH5.readSpectra(datasetPol1, spectra, 1, t0, t1, spectraChunkPol1, channels)
+    chunkValues = detectSpectra(spectraChunkPol0, spectraChunkPol1, t1 - t0, decimationFactor, fullStokes, values[:(t1 - t0) / decimationFactor], fscrunch)
+    valid = spectra.valid(t0, t1)
+    if skSigma:
+      powerSums = beamformerH5.powerSums(spectraChunkPol0[:, :t1 - t0], spectraChunkPol1[:, :t1 - t0])
+      beamformerH5.exciseRFI(chunkValues, powerSums, t1 - t0 if valid is None else valid.sum(), skSigma, fscrunch)
+    if fillMode:
+      beamformerH5.fillGaps(chunkValues, valid, decimationFactor, fillMode)
+    statistics.add(chunkValues)
+  return statistics.scaling(nbits)
 
 # Main body of the script
 if __name__=="__main__":
@@ -46,31 +101,69 @@ if __name__=="__main__":
   cmdline.formatter.max_help_position = 100 # increase space reserved for option flags (default 24), trick to make the help more readable
   cmdline.formatter.width = 250 # increase help width from 120 to 200
   cmdline.add_option("--freq", type = "float", dest = "freqCent", metavar = "<freqCent>", default = "1391.0" , help = "Give centre frequency.")
-  cmdline.add_option("--chunk", type = "int", dest = "chunkSize", metavar = "<chunkSize>", default = "256" , help = "Give number of samples for script to proccess.")
+  cmdline.add_option("--chunk", type = "int", dest = "chunkSize", metavar = "<chunkSize>", help = "Give number of samples for script to proccess (default: multiple of the HDF5 storage chunk, about 256).")
   cmdline.add_option("--ndec", type = "int", dest = "decimationFactor", metavar = "<decimationFactor>", default = "1" , help = "Give decimation factor.")
   cmdline.add_option("--source", type = "string", dest = "sourceName", metavar = "<sourceName>", default = "J0835-4510", help = "Give source name.")
   cmdline.add_option("--ra", type = "string", dest = "rightAscension", metavar = "<rightAscension>", default = "08:35:20.61149", help = "Give right ascension of the source.")
   cmdline.add_option("--dec", type = "string", dest = "declination", metavar = "<declination>", default = "-45:10:34.8751", help = "Give declination of the source.")
-  cmdline.add_option("--raw0", type = "string", dest = "h5FilePol0", metavar = "<h5FilePol0>", help = "Give input pol0 filename.")
-  cmdline.add_option("--raw1", type = "string", dest = "h5FilePol1", metavar = "<h5FilePol1>", help = "Give input pol1 filename.")
+  cmdline.add_option("--raw0", type = "string", dest = "h5FilePol0", metavar = "<h5FilePol0>", help = "Give input pol0 filename, or a comma-separated list of files and glob patterns of a capture split across files.")
+  cmdline.add_option("--raw1", type = "string", dest = "h5FilePol1", metavar = "<h5FilePol1>", help = "Give input pol1 filename, or a comma-separated list of files and glob patterns of a capture split across files.")
   cmdline.add_option("--out", type = "string", dest = "outFileName", metavar = "<outFileName>", default = "out.fil", help = "Give output filename.")
   cmdline.add_option("--pol", dest="fullStokes", action="store_true", help="Convert to full Stokes.")
+  cmdline.add_option("--nbits", type = "int", dest = "nbits", metavar = "<nbits>", default = "32" , help = "Give number of bits per output value, 8, 16 or 32 (default: 32).")
+  cmdline.add_option("--rescale", type = "float", dest = "rescaleTime", metavar = "<rescaleTime>", default = "10.0" , help = "Give interval in seconds between updates of the 8/16-bit scaling (default: 10).")
+  cmdline.add_option("--chan-range", type = "int", nargs = 2, dest = "channelRange", metavar = "<firstChannel> <endChannel>", help = "Give range of channels to convert, end channel excluded (default: all).")
+  cmdline.add_option("--freq-range", type = "float", nargs = 2, dest = "frequencyRange", metavar = "<lowFreq> <highFreq>", help = "Give range of frequencies in MHz to convert (default: all).")
+  cmdline.add_option("--fscrunch", type = "int", dest = "fscrunch", metavar = "<fscrunch>", default = "1" , help = "Give number of channels added into one output channel.")
+  cmdline.add_option("--sk", type = "float", dest = "skSigma", metavar = "<skSigma>", help = "Flag and replace channels whose spectral kurtosis over a read chunk is more than skSigma standard deviations from 1 (e.g. 3), writing the flags to <outFileName>.rfi.")
+  cmdline.add_option("--dm-range", type = "float", nargs = 2, dest = "dmRange", metavar = "<dmStart> <dmEnd>", help = "Give range of trial DMs to dedisperse the output at, writing one .tim file per DM.")
+  cmdline.add_option("--dm-step", type = "float", dest = "dmStep", metavar = "<dmStep>", help = "Give step between trial DMs (default: one sample of delay across the band).")
+  cmdline.add_option("--subbands", type = "int", dest = "numberSubbands", metavar = "<numberSubbands>", default = "32", help = "Give number of subbands used for dedispersion (default: 32).")
+  cmdline.add_option("--fill", type = "choice", dest = "fillMode", metavar = "<fillMode>", choices = ["zero", "mean", "previous"], help = "Place spectra by timestamp and fill missing ones with zero, mean or previous.")
+  perfMetrics.addOptions(cmdline)
   (opts, args) = cmdline.parse_args() # reading cmd options
+  metrics = perfMetrics.Metrics()
+  metricsExporter = perfMetrics.exporterFromOptions(opts, metrics, "prepareH5", opts.outFileName)
   if not opts.h5FilePol0 or not opts.h5FilePol1:
     cmdline.print_usage()
     sys.exit(0)
+  if opts.nbits not in filterbank.nbitsTypes:
+    print ("Writing %d-bit data not supported.") % opts.nbits
+    sys.exit(0)
+  if opts.fscrunch < 1:
+    print ("fscrunch has to be at least 1.")
+    sys.exit(0)
 
   # Getting boolean options.
   fullStokes = opts.fullStokes
   print ("fullStokes: %s") % (fullStokes)
 
-  # Loading the files.
-  h5FilePol0 = opts.h5FilePol0
-  h5FilePol1 = opts.h5FilePol1
+  # Loading the files, a capture split across files is read through one concatenated view.
+  try:
+    h5FilePol0 = beamformerH5.concatenateCapture(beamformerH5.captureFiles(opts.h5FilePol0), opts.outFileName + ".pol0.vds.h5")
+    h5FilePol1 = beamformerH5.concatenateCapture(beamformerH5.captureFiles(opts.h5FilePol1), opts.outFileName + ".pol1.vds.h5")
+  except (IOError, ValueError) as error:
+    print error
+    sys.exit(0)
   print ("h5FilePol0: %s") % h5FilePol0
   print ("h5FilePol1: %s") % h5FilePol1
-  dataH5FilePol0 = h5py.File(h5FilePol0, "r")
-  dataH5FilePol1 = h5py.File(h5FilePol1, "r")
+
+  # Choosing the read span and chunk cache from the storage layout of the data.
+  layoutPol0 = beamformerH5.datasetLayout(h5FilePol0)
+  layoutPol1 = beamformerH5.datasetLayout(h5FilePol1)
+  print ("storage chunks: %s, compression: %s") % (layoutPol0["chunks"], layoutPol0["compression"])
+  chunkSize = beamformerH5.spectraPerRead(layoutPol0, opts.decimationFactor, opts.chunkSize)
+  print ("chunkSize: %d") % chunkSize
+  # Selecting the band, only this hyperslab of the channel axis is read.
+  fscrunch = opts.fscrunch
+  channels = beamformerH5.channelSelection(layoutPol0["shape"][0], opts.channelRange, opts.frequencyRange, opts.freqCent - (layoutPol0["shape"][0] / 2) * channelBW, channelBW, fscrunch)
+  outputChannels = (channels[1] - channels[0]) / fscrunch
+  print ("channels: %d-%d, fscrunch: %d, output channels: %d") % (channels[0], channels[1], fscrunch, outputChannels)
+  cacheBytesPol0, cacheSlotsPol0 = beamformerH5.chunkCacheSettings(layoutPol0, chunkSize, channels)
+  cacheBytesPol1, cacheSlotsPol1 = beamformerH5.chunkCacheSettings(layoutPol1, chunkSize, channels)
+  print ("chunk cache: %d bytes") % cacheBytesPol0
+  dataH5FilePol0 = beamformerH5.openBeamformerFile(h5FilePol0, cacheBytesPol0, cacheSlotsPol0)
+  dataH5FilePol1 = beamformerH5.openBeamformerFile(h5FilePol1, cacheBytesPol1, cacheSlotsPol1)
 
   # Getting number of channels from each file.
   channelNumberPol0 = dataH5FilePol0["Data/bf_raw"].shape[0]
@@ -90,78 +183,47 @@ if __name__=="__main__":
   print ("spectraNumberPol0: %d") % spectraNumberPol0
   print ("spectraNumberPol1: %d") % spectraNumberPol1
 
-  # Getting ADC counts from each file.
-  countADCPol0 = dataH5FilePol0["Data/timestamps"][:]
-  countADCPol1 = dataH5FilePol1["Data/timestamps"][:]
-  print ("countADCPol0[0]: %d") % countADCPol0[0]
-  print ("countADCPol1[0]: %d") % countADCPol1[0]
-
-  # Calculating where both files start overlaping.
-  if (countADCPol0[0] > countADCPol1[0]):
-    startSyncADC = countADCPol0[0]
-    startIndexPol1 = np.where(countADCPol1 == startSyncADC)[0][0]
-    startIndexPol0 = 0
-    print ("startIndexPol0: %d") % startIndexPol0
-    print ("startIndexPol1: %d") % startIndexPol1
-  elif (countADCPol0[0] < countADCPol1[0]):
-    startSyncADC = countADCPol1[0]
-    startIndexPol0 = np.where(countADCPol0 == startSyncADC)[0][0]
-    startIndexPol1 = 0
-    print ("startIndexPol0: %d") % startIndexPol0
-    print ("startIndexPol1: %d") % startIndexPol1
-  else:
-    startSyncADC = countADCPol0[0]
-    startIndexPol0 = 0
-    startIndexPol1 = 0
-    print ("startIndexPol0: %d") % startIndexPol0
-    print ("startIndexPol1: %d") % startIndexPol1
-  print ("countADCPol0[%d]: %d") % (startIndexPol0, countADCPol0[startIndexPol0])
-  print ("countADCPol1[%d]: %d") % (startIndexPol1, countADCPol1[startIndexPol1])
+  # Aligning both files on their ADC timestamps, reading only a few of them.
+  timestampIndexPol0 = beamformerH5.TimestampIndex(dataH5FilePol0["Data/timestamps"])
+  timestampIndexPol1 = beamformerH5.TimestampIndex(dataH5FilePol1["Data/timestamps"])
+  print ("countADCPol0[0]: %d") % timestampIndexPol0.first
+  print ("countADCPol1[0]: %d") % timestampIndexPol1.first
+  try:
+    overlap = beamformerH5.alignTimestamps(timestampIndexPol0, timestampIndexPol1)
+  except ValueError as error:
+    print error
+    sys.exit(0)
+  startSyncADC = overlap["startADC"]
+  endSyncADC = overlap["endADC"]
+  startIndexPol0 = overlap["startIndexPol0"]
+  startIndexPol1 = overlap["startIndexPol1"]
+  endIndexPol0 = overlap["endIndexPol0"]
+  endIndexPol1 = overlap["endIndexPol1"]
+  endIndex = min(endIndexPol0 - startIndexPol0, endIndexPol1 - startIndexPol1)
+  print ("startIndexPol0: %d") % startIndexPol0
+  print ("startIndexPol1: %d") % startIndexPol1
   print ("startSyncADC: %d") % startSyncADC
-
-  # Calculating where both files end overlaping.
-  if (countADCPol0[-1] > countADCPol1[-1]):
-    endSyncADC = countADCPol1[-1]
-    endIndexPol0 = np.where(countADCPol0 == endSyncADC)[0][0]
-    endIndexPol1 = countADCPol1.size - 1
-    endIndex = endIndexPol0
-    print ("endIndexPol0: %d") % endIndexPol0
-    print ("endIndexPol1: %d") % endIndexPol1
-    print ("endIndex: %d") % endIndex
-  elif (countADCPol0[-1] < countADCPol1[-1]):
-    endSyncADC = countADCPol0[-1]
-    endIndexPol1 = np.where(countADCPol1 == endSyncADC)[0][0]
-    endIndexPol0 = countADCPol0.size - 1
-    endIndex = endIndexPol1
-    print ("endIndexPol0: %d") % endIndexPol0
-    print ("endIndexPol1: %d") % endIndexPol1
-    print ("endIndex: %d") % endIndex
-  else:
-    endSyncADC = countADCPol0[-1]
-    endIndexPol0 = endIndexPol1 = countADCPol0.size
-  print ("countADCPol0[%d]: %d") % (endIndexPol0, countADCPol0[endIndexPol0])
-  print ("countADCPol1[%d]: %d") % (endIndexPol1, countADCPol1[endIndexPol1])
+  print ("endIndexPol0: %d") % endIndexPol0
+  print ("endIndexPol1: %d") % endIndexPol1
+  print ("endIndex: %d") % endIndex
   print ("endSyncADC: %d") % endSyncADC
 
-  # Getting difference between countADC to check for missing packets.
-  differencePol0 = np.diff(countADCPol0[startIndexPol0:])
-  differencePol1 = np.diff(countADCPol1[startIndexPol1:])
-  breaksPol0 = np.where(differencePol0 != 8192)[0]
-  breaksPol1 = np.where(differencePol1 != 8192)[0]
+  # Reporting discontinuities as (index, number of missing spectra).
+  breaksPol0 = timestampIndexPol0.discontinuities
+  breaksPol1 = timestampIndexPol1.discontinuities
+  metrics.count("droppedSpectra", sum(missing for (index, missing) in breaksPol0 + breaksPol1))
   print "breaksPol0: ", breaksPol0
   print "breaksPol1: ", breaksPol1
-  if (breaksPol0.size != 0):
+  if (len(breaksPol0) != 0):
     print ("Missing spectra in: %s") % (h5FilePol0)
     print "Missing spectra located at: ", breaksPol0
-  if (breaksPol1.size != 0):
+  if (len(breaksPol1) != 0):
     print ("Missing spectra in: %s") % (h5FilePol1)
     print "Missing spectra located at: ", breaksPol1
 
   # Calculating sampling times, start MJD times, frequencies etc.
   outFileName = opts.outFileName
   print ("outFileName: %s") % outFileName
-  chunkSize = opts.chunkSize
-  print ("chunkSize: %d") % chunkSize
   samplingTime = complexChannels / samplingClock
   print ("Nyquist samplingTime: %.20f s") % samplingTime
   #samplingTime = 4.78504672897196
@@ -177,11 +239,6 @@ if __name__=="__main__":
     print "Input error! decimationFactor not a power of two!"
     sys.exit(0)
 
-  # Check if decimationFactor is greater than chunkSize.
-  if (decimationFactor > chunkSize):
-    chunkSize = 2 * decimationFactor
-    print ("decimationFactor: %d") % decimationFactor
-    print ("new chunkSize: %d") % chunkSize
 
   # Find sync time in the data files.
   try:
@@ -207,6 +264,7 @@ if __name__=="__main__":
   print ("freqTop: %f") % freqTop
   freqBottom = freqCent - (((channelNumberPol0 / 2)) * channelBW)
   print ("freqBottom: %f") % freqBottom
+  freqFirst = freqBottom + (channels[0] + (fscrunch - 1) / 2.0) * channelBW # centre of the first output channel
   sourceName = opts.sourceName
   print ("sourceName: %s") % sourceName
   rightAscension = opts.rightAscension
@@ -215,65 +273,131 @@ if __name__=="__main__":
   print ("declination: %s") % declination
 
   # Creating and populating file header.
-  fileOut = open(outFileName, "wab")
-  headerStart = "HEADER_START"
-  headerEnd = "HEADER_END"
-  header = "".join([struct.pack("I", len(headerStart)), headerStart])
-  header = "".join([header, _write_string("source_name", sourceName)])
-  header = "".join([header, _write_int("machine_id", 13)])
-  header = "".join([header, _write_int("telescope_id", 64)])
   src_raj = float(rightAscension.replace(":", ""))
-  header = "".join([header, _write_double("src_raj", src_raj)])
   src_dej = float(declination.replace(":", ""))
-  header = "".join([header, _write_double("src_dej", src_dej)])
-  header = "".join([header, _write_int("data_type", 1)])
-  header = "".join([header, _write_double("fch1", freqBottom)])
-  header = "".join([header, _write_double("foff", channelBW)])
-  #header = "".join([header, _write_double("fch1", freqTop)])
-  #header = "".join([header, _write_double("foff", -1.0 * channelBW)])
-  header = "".join([header, _write_int("nchans", channelNumberPol0)])
-  header = "".join([header, _write_int("nbits", 32)])
-  header = "".join([header, _write_double("tstart", startTimeMJD)])
-  header = "".join([header, _write_double("tsamp", samplingTime)])
   if fullStokes:
-    header = "".join([header, _write_int("nifs", 4)])
+    numberIFs = 4
   else:
-    header = "".join([header, _write_int("nifs", 1)])
-  header = "".join([header, struct.pack("I", len(headerEnd)), headerEnd])
-  fileOut.write(header)
+    numberIFs = 1
+  headerItems = [("source_name", sourceName),
+                 ("machine_id", 13),
+                 ("telescope_id", 64),
+                 ("src_raj", src_raj),
+                 ("src_dej", src_dej),
+                 ("data_type", 1),
+                 ("fch1", freqFirst),
+                 ("foff", channelBW * fscrunch),
+                 #("fch1", freqTop),
+                 #("foff", -1.0 * channelBW),
+                 ("nchans", outputChannels),
+                 ("nbits", opts.nbits),
+                 ("tstart", startTimeMJD),
+                 ("tsamp", samplingTime),
+                 ("nifs", numberIFs)]
+  header = filterbank.makeHeader(headerItems)
 
   # Extracting data from h5 files and writing to filterbank file.
   #endIndex = 208985 # Number of Nyquist-sampled spectra in 1 second, use to process only 1 second of data.
+  if opts.fillMode:
+    # Every timestamp gets its own output slot, missing spectra are filled.
+    spectra = beamformerH5.SpectrumSlots(timestampIndexPol0, timestampIndexPol1, overlap)
+    endIndex = spectra.numberSlots
+    print ("fillMode: %s, output slots: %d") % (opts.fillMode, endIndex)
+  else:
+    spectra = beamformerH5.ContiguousSpectra(startIndexPol0, startIndexPol1)
+  endIndex -= endIndex % decimationFactor
+  # Output is preallocated and every chunk stored at its place in the memory-mapped data.
+  sink = filterbank.FilterbankSink(outFileName, header, endIndex / decimationFactor, numberIFs, outputChannels, opts.nbits)
+  # Dedispersing the output as it is converted.
+  dedisperser = None
+  if opts.dmRange:
+    headerValues = dict(headerItems)
+    dms = dedisperse.dmTrials(opts.dmRange[0], opts.dmRange[1], opts.dmStep, headerValues["fch1"] + headerValues["foff"] * np.arange(outputChannels), samplingTime)
+    try:
+      dedisperser = dedisperse.Dedisperser(headerValues, dms, os.path.splitext(outFileName)[0], endIndex / decimationFactor, opts.numberSubbands)
+    except ValueError as error:
+      print error
+      sys.exit(0)
+    print ("Trial DMs: %d from %.3f to %.3f") % (dms.size, dms[0], dms[-1])
+  # Requantisation scaling comes from the first windowSpectra spectra of every interval.
+  if opts.nbits != 32:
+    intervalSpectra = chunkSize * max(1, int(round(opts.rescaleTime * decimationFactor / samplingTime / chunkSize)))
+    windowSpectra = min(intervalSpectra, chunkSize * ((1024 * decimationFactor + chunkSize - 1) / chunkSize))
+    print ("nbits: %d, rescale every %d spectra from the first %d") % (opts.nbits, intervalSpectra, windowSpectra)
+    values = np.empty((chunkSize / decimationFactor, numberIFs, outputChannels), np.float32)
+    interval = None
+    clipCounts = np.zeros(2, np.int64)
+  spectraChunkPol0 = np.empty((channels[1] - channels[0], chunkSize, 2), dataH5FilePol0["Data/bf_raw"].dtype)
+  spectraChunkPol1 = np.empty((channels[1] - channels[0], chunkSize, 2), dataH5FilePol1["Data/bf_raw"].dtype)
+  filledSamples = []
+  rfiBlocks = []
   for t0 in range(0, endIndex, chunkSize):
     t1 = min(endIndex, t0 + chunkSize)
-    spectraChunkPol0 = dataH5FilePol0["Data/bf_raw"][:, t0 + startIndexPol0:t1 + startIndexPol0, :]
-    spectraChunkPol1 = dataH5FilePol1["Data/bf_raw"][:, t0 + startIndexPol1:t1 + startIndexPol1, :]
-    spectraChunkComplexPol0 = spectraChunkPol0[...,0] + 1j * spectraChunkPol0[...,1]
-    spectraChunkComplexPol1 = spectraChunkPol1[...,0] + 1j * spectraChunkPol1[...,1]
-    if fullStokes:
-      if (decimationFactor > 1):
-        stokesI = ((((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) + (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).reshape(-1, (chunkSize / decimationFactor), decimationFactor).mean(axis = 2)).T
-        stokesQ = ((((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) - (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).reshape(-1, (chunkSize / decimationFactor), decimationFactor).mean(axis = 2)).T
-        stokesU = ((((spectraChunkComplexPol0 * spectraChunkComplexPol1.conjugate()) + (spectraChunkComplexPol0.conjugate() * spectraChunkComplexPol1)).real).reshape(-1, (chunkSize / decimationFactor), decimationFactor).mean(axis = 2)).T
-        stokesV = ((((spectraChunkComplexPol0 * spectraChunkComplexPol1.conjugate()) - (spectraChunkComplexPol0.conjugate() * spectraChunkComplexPol1)).imag).reshape(-1, (chunkSize / decimationFactor), decimationFactor).mean(axis = 2)).T
-        stokesIQUV = np.concatenate((stokesI, stokesQ, stokesU, stokesV), axis = 1)
-        stokesIQUV = stokesIQUV.reshape((chunkSize * 4) / decimationFactor, channelNumberPol0)
-      else:
-        stokesI = (((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) + (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).T
-        stokesQ = (((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) - (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).T
-        stokesU = (((spectraChunkComplexPol0 * spectraChunkComplexPol1.conjugate()) + (spectraChunkComplexPol0.conjugate() * spectraChunkComplexPol1)).real).T
-        stokesV = (((spectraChunkComplexPol0 * spectraChunkComplexPol1.conjugate()) - (spectraChunkComplexPol0.conjugate() * spectraChunkComplexPol1)).imag).T
-        stokesIQUV = np.concatenate((stokesI, stokesQ, stokesU, stokesV), axis = 1)
-        stokesIQUV = stokesIQUV.reshape(chunkSize * 4, channelNumberPol0)
-      stokesIQUVFloat32 = stokesIQUV.astype(dtype = np.float32)
-      bytesStokesIQUVFloat32 = stokesIQUVFloat32.tobytes(order = "C")
-      fileOut.write(bytesStokesIQUVFloat32)
+    chunkLength = t1 - t0
+    readStart = time.time()
+    beamformerH5.readSpectra(dataH5FilePol0["Data/bf_raw"], spectra, 0, t0, t1, spectraChunkPol0, channels)
+    beamformerH5.readSpectra(dataH5FilePol1["Data/bf_raw"], spectra, 1, t0, t1, spectraChunkPol1, channels)
+    computeStart = time.time()
+    metrics.add("read", busy = computeStart - readStart)
+    valid = spectra.valid(t0, t1)
+    output = sink.data[t0 / decimationFactor:t1 / decimationFactor]
+    quantiseTime = 0.0
+    if opts.nbits == 32:
+      detectSpectra(spectraChunkPol0, spectraChunkPol1, chunkLength, decimationFactor, fullStokes, output, fscrunch)
+      if opts.skSigma:
+        powerSums = beamformerH5.powerSums(spectraChunkPol0[:, :chunkLength], spectraChunkPol1[:, :chunkLength])
+        flagged = beamformerH5.exciseRFI(output, powerSums, chunkLength if valid is None else valid.sum(), opts.skSigma, fscrunch)
+        if flagged.size:
+          rfiBlocks.append((t0 / decimationFactor, output.shape[0], flagged))
+      if opts.fillMode:
+        filledSamples.append(t0 / decimationFactor + beamformerH5.fillGaps(output, valid, decimationFactor, opts.fillMode))
     else:
-      if (decimationFactor > 1):
-        stokesI = ((((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) + (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).reshape(-1, (chunkSize / decimationFactor), decimationFactor).mean(axis = 2)).T
-      else:
-        stokesI = (((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) + (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).T
-      stokesIFloat32 = stokesI.astype(dtype = np.float32)
-      bytesStokesIFloat32 = stokesIFloat32.tobytes(order = "C")
-      fileOut.write(bytesStokesIFloat32)
-  fileOut.close()
+      if t0 / intervalSpectra != interval:
+        interval = t0 / intervalSpectra
+        scale, offset = windowScaling(dataH5FilePol0["Data/bf_raw"], dataH5FilePol1["Data/bf_raw"], spectra, t0, min(endIndex, t0 + windowSpectra), chunkSize, decimationFactor, fullStokes, opts.fillMode, opts.nbits, channels, fscrunch, opts.skSigma)
+      chunkValues = detectSpectra(spectraChunkPol0, spectraChunkPol1, chunkLength, decimationFactor, fullStokes, values[:output.shape[0]], fscrunch)
+      if opts.skSigma:
+        powerSums = beamformerH5.powerSums(spectraChunkPol0[:, :chunkLength], spectraChunkPol1[:, :chunkLength])
+        flagged = beamformerH5.exciseRFI(chunkValues, powerSums, chunkLength if valid is None else valid.sum(), opts.skSigma, fscrunch)
+        if flagged.size:
+          rfiBlocks.append((t0 / decimationFactor, chunkValues.shape[0], flagged))
+      if opts.fillMode:
+        filledSamples.append(t0 / decimationFactor + beamformerH5.fillGaps(chunkValues, valid, decimationFactor, opts.fillMode))
+      quantiseStart = time.time()
+      requantise.quantise(chunkValues, scale, offset, opts.nbits, output, clipCounts)
+      quantiseTime = time.time() - quantiseStart
+      metrics.add("quantise", busy = quantiseTime)
+    if dedisperser is not None:
+      dedisperser.feed(output)
+    metrics.add("compute", busy = time.time() - computeStart - quantiseTime)
+    metrics.count("spectra", chunkLength)
+    metrics.count("bytesIn", chunkLength * (spectraChunkPol0.nbytes + spectraChunkPol1.nbytes) / chunkSize)
+    metrics.count("samples", output.shape[0])
+    metrics.count("bytesOut", output.shape[0] * sink.bytesPerSample)
+    metricsExporter.update()
+  writeStart = time.time()
+  sink.close()
+  metrics.add("write", busy = time.time() - writeStart) # pages of the memory map still to be written
+  if dedisperser is not None:
+    dedisperser.close()
+    dedisperser.report()
+  if opts.nbits != 32:
+    requantise.reportClipping(clipCounts, (endIndex / decimationFactor) * numberIFs * outputChannels)
+    metrics.count("clippedValues", clipCounts.sum())
+
+  # Listing the channel-blocks replaced as RFI.
+  if opts.skSigma:
+    numberBlocks = ((endIndex + chunkSize - 1) / chunkSize) * outputChannels
+    numberFlagged = sum(block[2].size for block in rfiBlocks)
+    metrics.count("flaggedBlocks", numberFlagged)
+    print ("Flagged channel-blocks: %d of %d (%.4f%%)") % (numberFlagged, numberBlocks, 100.0 * numberFlagged / max(numberBlocks, 1))
+    beamformerH5.writeRFIMask(outFileName + ".rfi", rfiBlocks)
+
+  # Listing the output samples made up from missing spectra.
+  if opts.fillMode:
+    filledSamples = np.concatenate(filledSamples + [np.zeros(0, np.intp)])
+    print ("Filled output samples: %d") % filledSamples.size
+    beamformerH5.writeMask(outFileName + ".mask", filledSamples)
+    metrics.count("filledSamples", filledSamples.size)
+  metrics.report()
+  metricsExporter.close()
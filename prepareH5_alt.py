@@ -10,24 +10,13 @@
 import numpy as np
 import h5py
 import os
-import struct
 import sys
 import ephem
 import katpoint
+import time
 import optparse as opt
-
-# Functions used in SIGPROC header creation
-def _write_string(key, value):
-    return "".join([struct.pack("I", len(key)), key, struct.pack("I", len(value)), value])
-
-def _write_int(key, value):
-    return "".join([struct.pack("I",len(key)), key, struct.pack("I", value)])
-
-def _write_double(key, value):
-    return "".join([struct.pack("I",len(key)), key, struct.pack("d", value)])
-
-def _write_char(key, value):
-    return "".join([struct.pack("I",len(key)), key, struct.pack("b", value)])
+import filterbank
+import perfMetrics
 
 # Main body of the script
 if __name__=="__main__":
@@ -57,8 +46,11 @@ if __name__=="__main__":
     cmdline.add_option("--raw1", type = "string", dest = "h5FilePol1", metavar = "<h5FilePol1>", help = "Give input pol1 filename.")
     cmdline.add_option("--out", type = "string", dest = "outFileName", metavar = "<outFileName>", default = "out.fil", help = "Give output filename.")
     cmdline.add_option("--pol", dest="fullStokes", action="store_true", help="Convert to full Stokes.")
+    perfMetrics.addOptions(cmdline)
 
     (opts, args) = cmdline.parse_args() # reading cmd options
+    metrics = perfMetrics.Metrics()
+    metricsExporter = perfMetrics.exporterFromOptions(opts, metrics, "prepareH5_alt", opts.outFileName)
     if not opts.h5FilePol0 or not opts.h5FilePol1:
         cmdline.print_usage()
         sys.exit(0)
@@ -141,7 +133,8 @@ if __name__=="__main__":
         print ("endIndex: %d") % endIndex
     else:
         endSyncADC = countADCPol0[-1]
-        endIndexPol0 = endIndexPol1 = countADCPol0.size
+        endIndexPol0 = endIndexPol1 = countADCPol0.size - 1
+        endIndex = endIndexPol0
     print ("countADCPol0[%d]: %d") % (endIndexPol0, countADCPol0[endIndexPol0])
     print ("countADCPol1[%d]: %d") % (endIndexPol1, countADCPol1[endIndexPol1])
     print ("endSyncADC: %d") % endSyncADC
@@ -211,66 +204,74 @@ if __name__=="__main__":
     declination = opts.declination
     print ("declination: %s") % declination
     # Creating and populating file header.
-    fileOut = open(outFileName, "wab")
-    headerStart = "HEADER_START"
-    headerEnd = "HEADER_END"
-    header = "".join([struct.pack("I", len(headerStart)), headerStart])
-    header = "".join([header, _write_string("source_name", sourceName)])
-    header = "".join([header, _write_int("machine_id", 13)])
-    header = "".join([header, _write_int("telescope_id", 64)])
     src_raj = float(rightAscension.replace(":", ""))
-    header = "".join([header, _write_double("src_raj", src_raj)])
     src_dej = float(declination.replace(":", ""))
-    header = "".join([header, _write_double("src_dej", src_dej)])
-    header = "".join([header, _write_int("data_type", 1)])
-    header = "".join([header, _write_double("fch1", freqBottom)])
-    header = "".join([header, _write_double("foff", channelBW)])
-    #header = "".join([header, _write_double("fch1", freqTop)])
-    #header = "".join([header, _write_double("foff", -1.0 * channelBW)])
-    header = "".join([header, _write_int("nchans", channelNumberPol0)])
-    header = "".join([header, _write_int("nbits", 32)])
-    header = "".join([header, _write_double("tstart", startTimeMJD)])
-    header = "".join([header, _write_double("tsamp", samplingTime)])
     if fullStokes:
-        header = "".join([header, _write_int("nifs", 4)])
+        numberIFs = 4
     else:
-        header = "".join([header, _write_int("nifs", 1)])
-    header = "".join([header, struct.pack("I", len(headerEnd)), headerEnd])
-    fileOut.write(header)
+        numberIFs = 1
+    header = filterbank.makeHeader([("source_name", sourceName),
+                                    ("machine_id", 13),
+                                    ("telescope_id", 64),
+                                    ("src_raj", src_raj),
+                                    ("src_dej", src_dej),
+                                    ("data_type", 1),
+                                    ("fch1", freqBottom),
+                                    ("foff", channelBW),
+                                    #("fch1", freqTop),
+                                    #("foff", -1.0 * channelBW),
+                                    ("nchans", channelNumberPol0),
+                                    ("nbits", 32),
+                                    ("tstart", startTimeMJD),
+                                    ("tsamp", samplingTime),
+                                    ("nifs", numberIFs)])
     #endIndex = 208985 # Number of Nyquist-sampled spectra in 1 second, use to process only 1 second of data.
+    # Output length has to be known up front, so only whole decimated samples present in both files are converted.
+    endIndex = min(endIndex, spectraNumberPol0 - startIndexPol0, spectraNumberPol1 - startIndexPol1)
+    endIndex -= endIndex % decimationFactor
+    sink = filterbank.FilterbankSink(outFileName, header, endIndex / decimationFactor, numberIFs, channelNumberPol0)
     # Extracting data from h5 files and writing to filterbank file.
     for t0 in range(0, endIndex, chunkSize):
         t1 = min(endIndex, t0 + chunkSize)
+        chunkLength = t1 - t0
+        output = sink.data[t0 / decimationFactor:t1 / decimationFactor]
         # TO DO: Replace missing packets in the data...
         #timestampsChunkPol0 = dataH5FilePol0["Data/timestamps"][t0 + startIndexPol0]
         #timestampsChunkPol1 = dataH5FilePol1["Data/timestamps"][t0 + startIndexPol1]
+        readStart = time.time()
         spectraChunkPol0 = dataH5FilePol0["Data/bf_raw"][:, t0 + startIndexPol0:t1 + startIndexPol0, :]
         spectraChunkPol1 = dataH5FilePol1["Data/bf_raw"][:, t0 + startIndexPol1:t1 + startIndexPol1, :]
+        computeStart = time.time()
+        metrics.add("read", busy = computeStart - readStart)
         spectraChunkComplexPol0 = spectraChunkPol0[...,0] + 1j * spectraChunkPol0[...,1]
         spectraChunkComplexPol1 = spectraChunkPol1[...,0] + 1j * spectraChunkPol1[...,1]
         if fullStokes:
             if (decimationFactor > 1):
-                stokesI = ((((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) + (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).reshape(-1, (chunkSize / decimationFactor), decimationFactor).mean(axis = 2)).T
-                stokesQ = ((((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) - (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).reshape(-1, (chunkSize / decimationFactor), decimationFactor).mean(axis = 2)).T
-                stokesU = ((((spectraChunkComplexPol0 * spectraChunkComplexPol1.conjugate()) + (spectraChunkComplexPol0.conjugate() * spectraChunkComplexPol1)).real).reshape(-1, (chunkSize / decimationFactor), decimationFactor).mean(axis = 2)).T
-                stokesV = ((((spectraChunkComplexPol0 * spectraChunkComplexPol1.conjugate()) - (spectraChunkComplexPol0.conjugate() * spectraChunkComplexPol1)).imag).reshape(-1, (chunkSize / decimationFactor), decimationFactor).mean(axis = 2)).T
+                stokesI = ((((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) + (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).reshape(-1, (chunkLength / decimationFactor), decimationFactor).mean(axis = 2)).T
+                stokesQ = ((((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) - (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).reshape(-1, (chunkLength / decimationFactor), decimationFactor).mean(axis = 2)).T
+                stokesU = ((((spectraChunkComplexPol0 * spectraChunkComplexPol1.conjugate()) + (spectraChunkComplexPol0.conjugate() * spectraChunkComplexPol1)).real).reshape(-1, (chunkLength / decimationFactor), decimationFactor).mean(axis = 2)).T
+                stokesV = ((((spectraChunkComplexPol0 * spectraChunkComplexPol1.conjugate()) - (spectraChunkComplexPol0.conjugate() * spectraChunkComplexPol1)).imag).reshape(-1, (chunkLength / decimationFactor), decimationFactor).mean(axis = 2)).T
             else:
                 stokesI = (((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) + (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).T
                 stokesQ = (((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) - (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).T
                 stokesU = (((spectraChunkComplexPol0 * spectraChunkComplexPol1.conjugate()) + (spectraChunkComplexPol0.conjugate() * spectraChunkComplexPol1)).real).T
                 stokesV = (((spectraChunkComplexPol0 * spectraChunkComplexPol1.conjugate()) - (spectraChunkComplexPol0.conjugate() * spectraChunkComplexPol1)).imag).T
             stokesIQUV = np.concatenate((stokesI, stokesQ, stokesU, stokesV), axis = 1)
-            stokesIQUV = stokesIQUV.reshape(chunkSize * 4, channelNumberPol0)
-            stokesIQUVFloat32 = stokesIQUV.astype(dtype = np.float32)
-            bytesStokesIQUVFloat32 = stokesIQUVFloat32.tobytes(order = "C")
-            fileOut.write(bytesStokesIQUVFloat32)
+            output[:] = stokesIQUV.reshape(-1, 4, channelNumberPol0)
         else:
             if (decimationFactor > 1):
-                stokesI = ((((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) + (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).reshape(-1, (chunkSize / decimationFactor), decimationFactor).mean(axis = 2)).T
+                stokesI = ((((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) + (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).reshape(-1, (chunkLength / decimationFactor), decimationFactor).mean(axis = 2)).T
             else:
                 stokesI = (((spectraChunkComplexPol0 * spectraChunkComplexPol0.conjugate()) + (spectraChunkComplexPol1 * spectraChunkComplexPol1.conjugate())).real).T
-            stokesIFloat32 = stokesI.astype(dtype = np.float32)
-            bytesStokesIFloat32 = stokesIFloat32.tobytes(order = "C")
-            fileOut.write(bytesStokesIFloat32)
-        fileOut.seek(0, 2)
-    fileOut.close()
+            output[:, 0, :] = stokesI
+        metrics.add("compute", busy = time.time() - computeStart)
+        metrics.count("spectra", chunkLength)
+        metrics.count("bytesIn", spectraChunkPol0.nbytes + spectraChunkPol1.nbytes)
+        metrics.count("samples", output.shape[0])
+        metrics.count("bytesOut", output.shape[0] * sink.bytesPerSample)
+        metricsExporter.update()
+    writeStart = time.time()
+    sink.close()
+    metrics.add("write", busy = time.time() - writeStart) # pages of the memory map still to be written
+    metrics.report()
+    metricsExporter.close()
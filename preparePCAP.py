@@ -10,23 +10,12 @@
 import numpy as np
 import os
 import sys
-import struct
 import ephem
 import datetime
+import time
 import optparse as opt
-
-# Functions used in SIGPROC header creation
-def _write_string(key, value):
-  return "".join([struct.pack("I", len(key)), key, struct.pack("I", len(value)), value])
-
-def _write_int(key, value):
-  return "".join([struct.pack("I",len(key)), key, struct.pack("I", value)])
-
-def _write_double(key, value):
-  return "".join([struct.pack("I",len(key)), key, struct.pack("d", value)])
-
-def _write_char(key, value):
-  return "".join([struct.pack("I",len(key)), key, struct.pack("b", value)])
+import filterbank
+import perfMetrics
 
 # Main body of the script
 if __name__=="__main__":
@@ -49,7 +38,10 @@ if __name__=="__main__":
   cmdline.add_option('--raw', type = 'string', dest = 'pcapFile', metavar = '<pcapFile>', help = 'Give input filename.')
   cmdline.add_option('--out', type = 'string', dest = 'outFileName', metavar = '<outFileName>', default = 'out.fil', help = 'Give output filename.')
   cmdline.add_option("--pad", dest = "zeroPad", action = "store_true", default = False, help = "Pad missing packets with zeros.")
+  perfMetrics.addOptions(cmdline)
   (opts, args) = cmdline.parse_args() # reading cmd options
+  metrics = perfMetrics.Metrics()
+  metricsExporter = perfMetrics.exporterFromOptions(opts, metrics, "preparePCAP", opts.outFileName)
   if not opts.pcapFile:
     cmdline.print_usage()
     sys.exit(0)
@@ -84,33 +76,30 @@ if __name__=="__main__":
   #print rightAscension
   declination = opts.declination
   #print declination
-  fileOut = open(outFileName, "ab+")
-  headerStart = "HEADER_START"
-  headerEnd = "HEADER_END"
-  header = "".join([struct.pack("I", len(headerStart)), headerStart])
-  header = "".join([header, _write_string("source_name", sourceName)])
-  header = "".join([header, _write_int("machine_id", 13)])
-  header = "".join([header, _write_int("telescope_id", 64)])
   src_raj = float(rightAscension.replace(":", ""))
-  header = "".join([header, _write_double("src_raj", src_raj)])
   src_dej = float(declination.replace(":", ""))
-  header = "".join([header, _write_double("src_dej", src_dej)])
-  header = "".join([header, _write_int("data_type", 1)])
-  header = "".join([header, _write_double("fch1", 2021.6093750)])
-  header = "".join([header, _write_double("foff", -0.390625)])
-  header = "".join([header, _write_int("nchans", numberChannels)])
-  header = "".join([header, _write_int("nbits", 32)])
-  header = "".join([header, _write_double("tstart", startTimeMJD)])
-  header = "".join([header, _write_double("tsamp", samplingTime)])
-  header = "".join([header, _write_int("nifs", 1)])
-  header = "".join([header, struct.pack("I", len(headerEnd)), headerEnd])
-  fileOut.write(header)
+  header = filterbank.makeHeader([("source_name", sourceName),
+                                  ("machine_id", 13),
+                                  ("telescope_id", 64),
+                                  ("src_raj", src_raj),
+                                  ("src_dej", src_dej),
+                                  ("data_type", 1),
+                                  ("fch1", 2021.6093750),
+                                  ("foff", -0.390625),
+                                  ("nchans", numberChannels),
+                                  ("nbits", 32),
+                                  ("tstart", startTimeMJD),
+                                  ("tsamp", samplingTime),
+                                  ("nifs", 1)])
+  # Number of spectra is only known at the end, output grows through the sink's aligned buffer.
+  sink = filterbank.FilterbankSink(outFileName, header, None, 1, numberChannels, sequential = True)
   counter = 0
   fileIn = open(pcapFile, "rb")
   fileIn.seek(pcapGlobalHeader)
   fileIn.seek(pcapHeader)
   while True:
     try:
+      readStart = time.time()
       if counter == 0:
         fileIn.seek(pcapGlobalHeader + pcapHeader)
       elif counter != 0:
@@ -126,24 +115,38 @@ if __name__=="__main__":
       if derivedAccumulationNumber != accumulationNumber:
         print "MISSING PACKET:", derivedUTCtimestamp, derivedAccumulationNumber, accumulationRate
         derivedAccumulationNumber = derivedAccumulationNumber + accumulationRate
+        metrics.count("droppedSpectra")
         if zeroPad:
-          stokesI = np.zeros(numberChannels)
-          bytesStokesI = stokesI.tobytes(order = "C")
-          fileOut.seek(0, 2)
-          fileOut.write(bytesStokesI)
+          stokesI = np.zeros(numberChannels, dtype = np.float32)
+          sink.append(stokesI)
+          metrics.count("filledSamples")
+          metrics.count("samples")
+          metrics.count("bytesOut", sink.bytesPerSample)
       else:
         dataArray = np.fromfile(fileIn, dtype = np.int16, count = numberOfItems)
+        computeStart = time.time()
+        metrics.add("read", busy = computeStart - readStart)
         xxArray = dataArray[::4] # get every 4th element of the array
         yyArray = dataArray[1::4] # get every 5th element of the array
         xxArrayFloat32 = xxArray.astype(dtype = np.float32)
         yyArrayFloat32 = yyArray.astype(dtype = np.float32)
         stokesI = xxArrayFloat32 + yyArrayFloat32
-        bytesStokesI = stokesI.tobytes(order = "C")
-        fileOut.seek(0, 2)
-        fileOut.write(bytesStokesI) 
+        writeStart = time.time()
+        metrics.add("compute", busy = writeStart - computeStart)
+        sink.append(stokesI)
+        metrics.add("write", busy = time.time() - writeStart)
+        metrics.count("spectra")
+        metrics.count("bytesIn", packetSize + pcapHeader)
+        metrics.count("samples")
+        metrics.count("bytesOut", sink.bytesPerSample)
+        metricsExporter.update()
       derivedAccumulationNumber = derivedAccumulationNumber + accumulationRate
       counter = counter + 1
     except IndexError:
       print "End of file reached!"
-      fileOut.close()
+      writeStart = time.time()
+      sink.close()
+      metrics.add("write", busy = time.time() - writeStart)
+      metrics.report()
+      metricsExporter.close()
       sys.exit(0)
@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017 by Maciej Serylak
+# Licensed under the Academic Free License version 3.0
+# This program comes with ABSOLUTELY NO WARRANTY.
+# You are free to modify and redistribute this code as long
+# as you do not remove the above attribution and reasonably
+# inform recipients that you have modified the original work.
+
+# PSRFITS search-mode output streamed one subint at a time, with the
+# MeerKAT primary header values that correctPSRFITS.py patches, and a
+# memory-mapped reader of search-mode files.
+
+import os
+import numpy as np
+import astropy.io.fits as pyfits
+from astropy.time import Time
+
+# FITS files are made of blocks of this many bytes.
+fitsBlock = 2880
+
+# MeerKAT values of the primary header, as set by correctPSRFITS.py.
+meerkatValues = [("TELESCOP", "MeerKAT"),
+                 ("FRONTEND", "L-band"),
+                 ("TRK_MODE", "TRACK"),
+                 ("OBS_MODE", "SEARCH"),
+                 ("TCYCLE", 0),
+                 ("ANT_X", 5109318.8410),
+                 ("ANT_Y", 2006836.3673),
+                 ("ANT_Z", -3238921.7749),
+                 ("NRCVR", 2),
+                 ("BACKEND", "KAT"),
+                 ("CAL_MODE", "OFF"),
+                 ("CAL_FREQ", 0.0),
+                 ("CAL_DCYC", 0.0),
+                 ("CAL_PHS", 0.0),
+                 ("CAL_NPHS", 0.0),
+                 ("CHAN_DM", 0.0)]
+
+# Numpy types and bytes per element of the binary table TFORM codes.
+tformTypes = {"L": ("i1", 1), "X": ("u1", 1), "B": ("u1", 1), "I": (">i2", 2), "J": (">i4", 4), "K": (">i8", 8), "A": ("S1", 1),
+              "E": (">f4", 4), "D": (">f8", 8), "C": (">c8", 8), "M": (">c16", 16), "P": (">i4", 8), "Q": (">i8", 16)}
+
+# Output values per standard deviation of a channel within a subint, the
+# 8-bit range covers -8..+8 sigma around the channel mean.
+levelsPerSigma = 16.0
+
+
+def pointingValues(rightAscension, declination, dateObs):
+  """
+  Return the primary header values giving the source position and start
+  date, as set by correctPSRFITS.py.
+    Inputs:
+      rightAscension: "HH:MM:SS.S".
+      declination: "DD:MM:SS.S".
+      dateObs: start time in ISOT format.
+  """
+  return [("RA", rightAscension),
+          ("DEC", declination),
+          ("STT_CRD1", rightAscension),
+          ("STT_CRD2", declination),
+          ("STP_CRD1", rightAscension),
+          ("STP_CRD2", declination),
+          ("DATE-OBS", dateObs),
+          ("DATE", dateObs)]
+
+
+def _sexagesimal(value):
+  """
+  Return "DD:MM:SS.S" (or "HH:MM:SS.S") as a float in units of its first field.
+  """
+  fields = value.strip().split(":")
+  sign = -1.0 if fields[0].startswith("-") else 1.0
+  result = 0.0
+  for i, field in enumerate(fields):
+    result += abs(float(field)) / 60.0**i
+  return sign * result
+
+
+def primaryHeader(sourceName, rightAscension, declination, unixTime, centreFrequency, bandwidth, numberChannels):
+  """
+  Return the primary header of a MeerKAT search-mode file.
+    Inputs:
+      unixTime: UTC start of the first sample in seconds since 1970.
+      centreFrequency, bandwidth: in MHz, bandwidth negative for channels
+                                  in decreasing frequency.
+  """
+  startDay = int(unixTime // 86400)
+  startSeconds = unixTime - startDay * 86400
+  dateObs = Time(unixTime, format = "unix", precision = 9).isot
+  header = pyfits.PrimaryHDU().header
+  header["HDRVER"] = "5.4"
+  header["FITSTYPE"] = "PSRFITS"
+  header["OBSERVER"] = "MeerKAT"
+  header["PROJID"] = "unknown"
+  for key, value in meerkatValues + pointingValues(rightAscension, declination, dateObs):
+    header[key] = value
+  header["SRC_NAME"] = sourceName
+  header["COORD_MD"] = "J2000"
+  header["EQUINOX"] = 2000.0
+  header["OBSFREQ"] = centreFrequency
+  header["OBSBW"] = bandwidth
+  header["OBSNCHAN"] = numberChannels
+  header["FD_POLN"] = "LIN"
+  header["FD_HAND"] = 1
+  header["FD_SANG"] = 0.0
+  header["FD_XYPH"] = 0.0
+  header["BE_PHASE"] = 0
+  header["BE_DCC"] = 0
+  header["BE_DELAY"] = 0.0
+  header["STT_IMJD"] = startDay + 40587 # MJD of the Unix epoch
+  header["STT_SMJD"] = int(startSeconds)
+  header["STT_OFFS"] = startSeconds - int(startSeconds)
+  header["STT_LST"] = 0.0
+  return header
+
+
+def subintColumns(numberChannels, numberPolarisations, samplesPerSubint):
+  """
+  Return the SUBINT table columns of an 8-bit search-mode file.
+  """
+  valuesPerRow = numberChannels * numberPolarisations
+  return [pyfits.Column(name = "TSUBINT", format = "1D", unit = "s"),
+          pyfits.Column(name = "OFFS_SUB", format = "1D", unit = "s"),
+          pyfits.Column(name = "LST_SUB", format = "1D", unit = "s"),
+          pyfits.Column(name = "RA_SUB", format = "1D", unit = "deg"),
+          pyfits.Column(name = "DEC_SUB", format = "1D", unit = "deg"),
+          pyfits.Column(name = "GLON_SUB", format = "1D", unit = "deg"),
+          pyfits.Column(name = "GLAT_SUB", format = "1D", unit = "deg"),
+          pyfits.Column(name = "FD_ANG", format = "1E", unit = "deg"),
+          pyfits.Column(name = "POS_ANG", format = "1E", unit = "deg"),
+          pyfits.Column(name = "PAR_ANG", format = "1E", unit = "deg"),
+          pyfits.Column(name = "TEL_AZ", format = "1E", unit = "deg"),
+          pyfits.Column(name = "TEL_ZEN", format = "1E", unit = "deg"),
+          pyfits.Column(name = "DAT_FREQ", format = "%dD" % numberChannels, unit = "MHz"),
+          pyfits.Column(name = "DAT_WTS", format = "%dE" % numberChannels),
+          pyfits.Column(name = "DAT_OFFS", format = "%dE" % valuesPerRow),
+          pyfits.Column(name = "DAT_SCL", format = "%dE" % valuesPerRow),
+          pyfits.Column(name = "DATA", format = "%dB" % (valuesPerRow * samplesPerSubint), dim = "(%d,%d,%d)" % (numberChannels, numberPolarisations, samplesPerSubint), unit = "Jy")]
+
+
+def rowType(numberChannels, numberPolarisations, samplesPerSubint):
+  """
+  Return the numpy type of one SUBINT row, big-endian as stored on disk.
+  """
+  valuesPerRow = numberChannels * numberPolarisations
+  return np.dtype([("TSUBINT", ">f8"), ("OFFS_SUB", ">f8"), ("LST_SUB", ">f8"), ("RA_SUB", ">f8"), ("DEC_SUB", ">f8"), ("GLON_SUB", ">f8"), ("GLAT_SUB", ">f8"),
+                   ("FD_ANG", ">f4"), ("POS_ANG", ">f4"), ("PAR_ANG", ">f4"), ("TEL_AZ", ">f4"), ("TEL_ZEN", ">f4"),
+                   ("DAT_FREQ", ">f8", (numberChannels,)), ("DAT_WTS", ">f4", (numberChannels,)),
+                   ("DAT_OFFS", ">f4", (valuesPerRow,)), ("DAT_SCL", ">f4", (valuesPerRow,)),
+                   ("DATA", "u1", (samplesPerSubint, numberPolarisations, numberChannels))])
+
+
+def quantiseSubint(values, row):
+  """
+  Pack a subint (samples, polarisations, channels) of float values into
+  the 8-bit DATA of row, with DAT_SCL and DAT_OFFS from the mean and
+  standard deviation of every channel and polarisation, so that
+  value = DATA * DAT_SCL + DAT_OFFS (ZERO_OFF is 0).
+  """
+  mean = values.mean(axis = 0, dtype = np.float64)
+  sigma = values.std(axis = 0, dtype = np.float64)
+  scale = np.where(sigma > 0, sigma / levelsPerSigma, 1.0).astype(np.float32)
+  offset = (mean - 128.0 * scale).astype(np.float32) # quantised with the values stored in the file
+  row["DAT_SCL"] = scale.reshape(-1)
+  row["DAT_OFFS"] = offset.reshape(-1)
+  row["DATA"] = np.clip(np.round((values - offset) / scale), 0, 255).astype(np.uint8)
+
+
+class SearchModeSink(object):
+  """
+  8-bit PSRFITS search-mode file written one subint (row) at a time, so
+  memory holds a single subint whatever the length of the observation.
+  Like filterbank.FilterbankSink it takes float samples (samples, IFs,
+  channels) at any output sample offset; the samples of a subint have to
+  arrive in order, and each process writing to the file has to own whole
+  subints. A subint still incomplete at close() is padded with the
+  channel means.
+    Inputs:
+      fileName: output file name.
+      header: primary header from primaryHeader().
+      numberSamples: number of output samples, None to grow the file as
+                     subints are appended.
+      numberIFs, numberChannels: shape of one output sample.
+      frequencies: centre frequency of every channel in MHz, in the order
+                   of the samples given to write().
+      samplingTime: seconds per sample.
+      samplesPerSubint: NSBLK (default: 1024).
+      create: write the headers and preallocate the file. Set to False to
+              attach to a file already created by another process
+              (default: True).
+  """
+  # Samples are handed over from the buffers of a BackgroundWriter.
+  sequential = True
+  dtype = np.dtype(np.float32)
+
+  def __init__(self, fileName, header, numberSamples, numberIFs, numberChannels, frequencies, samplingTime, samplesPerSubint = 1024, create = True):
+    if numberIFs not in (1, 4):
+      raise ValueError("PSRFITS output needs 1 or 4 IFs, not %d." % numberIFs)
+    self.fileName = fileName
+    self.numberSamples = numberSamples
+    self.numberIFs = numberIFs
+    self.numberChannels = numberChannels
+    self.samplesPerSubint = samplesPerSubint
+    self.samplingTime = samplingTime
+    self.bytesPerSample = numberIFs * numberChannels # 8-bit values
+    self.rowType = rowType(numberChannels, numberIFs, samplesPerSubint)
+    self.numberRows = None if numberSamples is None else (numberSamples + samplesPerSubint - 1) // samplesPerSubint
+    # Subint headers list the frequencies in decreasing order, as PSRFITS2fil.py expects.
+    frequencies = np.asarray(frequencies, np.float64)
+    self.reverse = frequencies.size > 1 and frequencies[1] > frequencies[0]
+    channelBW = (frequencies[-1] - frequencies[0]) / max(1, frequencies.size - 1)
+    subintHeader = pyfits.BinTableHDU.from_columns(subintColumns(numberChannels, numberIFs, samplesPerSubint), nrows = 0, name = "SUBINT").header
+    subintHeader["NAXIS2"] = self.numberRows or 0
+    subintHeader["INT_TYPE"] = "TIME"
+    subintHeader["INT_UNIT"] = "SEC"
+    subintHeader["SCALE"] = "FluxDen"
+    subintHeader["POL_TYPE"] = "AA+BB" if numberIFs == 1 else "IQUV"
+    subintHeader["NPOL"] = numberIFs
+    subintHeader["TBIN"] = samplingTime
+    subintHeader["NBIN"] = 1
+    subintHeader["NBIN_PRD"] = 0
+    subintHeader["PHS_OFFS"] = 0.0
+    subintHeader["NBITS"] = 8
+    subintHeader["ZERO_OFF"] = 0.0
+    subintHeader["SIGNINT"] = 0
+    subintHeader["NSUBOFFS"] = 0
+    subintHeader["NCHAN"] = numberChannels
+    subintHeader["CHAN_BW"] = -abs(channelBW)
+    subintHeader["DM"] = 0.0
+    subintHeader["RM"] = 0.0
+    subintHeader["NCHNOFFS"] = 0
+    subintHeader["NSBLK"] = samplesPerSubint
+    subintHeader["NSTOT"] = numberSamples or 0
+    self.primaryBytes = header.tostring()
+    self.subintBytes = subintHeader.tostring()
+    self.headerBytes = self.primaryBytes + self.subintBytes
+    self.headerSize = len(self.headerBytes)
+    self.row = np.zeros(1, self.rowType)[0]
+    self.row["TSUBINT"] = samplesPerSubint * samplingTime
+    self.row["RA_SUB"] = 15.0 * _sexagesimal(header["RA"])
+    self.row["DEC_SUB"] = _sexagesimal(header["DEC"])
+    self.row["DAT_FREQ"] = np.sort(frequencies)[::-1]
+    self.row["DAT_WTS"] = 1.0
+    if self.numberRows is None:
+      self.fileSize = None
+    else:
+      dataBytes = self.numberRows * self.rowType.itemsize
+      self.fileSize = self.headerSize + dataBytes + (-dataBytes) % fitsBlock
+    if create:
+      fileOut = open(fileName, "wb")
+      fileOut.write(self.headerBytes)
+      if self.fileSize is not None:
+        fileOut.truncate(self.fileSize)
+      fileOut.close()
+    self.fileOut = open(fileName, "r+b")
+    self.rowsWritten = 0 if numberSamples is None else None
+    self.subint = np.empty((samplesPerSubint, numberIFs, numberChannels), np.float32)
+    self.subintIndex = None
+    self.subintFill = 0
+
+  def _writeRow(self):
+    """
+    Quantise and write the buffered subint, padding a partial one.
+    """
+    if self.subintFill < self.samplesPerSubint:
+      self.subint[self.subintFill:] = self.subint[:self.subintFill].mean(axis = 0)
+    quantiseSubint(self.subint, self.row)
+    self.row["OFFS_SUB"] = (self.subintIndex + 0.5) * self.samplesPerSubint * self.samplingTime
+    self.fileOut.seek(self.headerSize + self.subintIndex * self.rowType.itemsize)
+    self.fileOut.write(self.row.tostring())
+    if self.rowsWritten is not None:
+      self.rowsWritten = max(self.rowsWritten, self.subintIndex + 1)
+    self.subintIndex = None
+    self.subintFill = 0
+
+  def write(self, sample, values):
+    """
+    Store values (samples, IFs, channels) starting at output sample sample.
+    """
+    values = np.asarray(values, np.float32).reshape((-1, self.numberIFs, self.numberChannels))
+    if self.reverse:
+      values = values[:, :, ::-1]
+    while values.shape[0]:
+      index, first = divmod(sample, self.samplesPerSubint)
+      if self.subintIndex is not None and (index != self.subintIndex or first != self.subintFill):
+        self._writeRow() # not continuing the buffered subint
+      if self.subintIndex is None:
+        if first != 0:
+          raise ValueError("Samples of subint %d have to start at its first sample." % index)
+        self.subintIndex = index
+      count = min(values.shape[0], self.samplesPerSubint - first)
+      self.subint[first:first + count] = values[:count]
+      self.subintFill += count
+      values = values[count:]
+      sample += count
+      if self.subintFill == self.samplesPerSubint:
+        self._writeRow()
+
+  def append(self, values):
+    """
+    Store values after the last sample written.
+    """
+    if self.subintIndex is not None:
+      sample = self.subintIndex * self.samplesPerSubint + self.subintFill
+    else:
+      sample = (self.rowsWritten or 0) * self.samplesPerSubint
+    self.write(sample, values)
+
+  def flush(self):
+    """
+    Make sure every complete subint written so far is on disk.
+    """
+    self.fileOut.flush()
+    os.fsync(self.fileOut.fileno())
+
+  def close(self):
+    if self.subintIndex is not None:
+      self._writeRow()
+    if self.rowsWritten is not None:
+      # Growing file: record the number of rows and close the last FITS block.
+      subintHeader = pyfits.Header.fromstring(self.subintBytes)
+      subintHeader["NAXIS2"] = self.rowsWritten
+      subintHeader["NSTOT"] = self.rowsWritten * self.samplesPerSubint
+      self.fileOut.seek(len(self.primaryBytes))
+      self.fileOut.write(subintHeader.tostring())
+      dataBytes = self.rowsWritten * self.rowType.itemsize
+      self.fileOut.truncate(self.headerSize + dataBytes + (-dataBytes) % fitsBlock)
+    self.fileOut.close()
+
+
+def _readHDUHeader(fileIn, offset):
+  """
+  Read the FITS header starting at byte offset.
+    Output:
+      header: pyfits.Header.
+      dataOffset: byte offset of the data of the HDU.
+      dataSize: bytes of data, padded to whole FITS blocks.
+  """
+  fileIn.seek(offset)
+  blocks = []
+  while True:
+    block = fileIn.read(fitsBlock)
+    if len(block) < fitsBlock:
+      raise ValueError("%s ends within a FITS header." % fileIn.name)
+    blocks.append(block)
+    if any(block[i:i + 8] == "END     " for i in range(0, fitsBlock, 80)):
+      break
+  header = pyfits.Header.fromstring("".join(blocks))
+  dataSize = 0
+  if header.get("NAXIS", 0) > 0:
+    dataSize = 1
+    for axis in range(1, header["NAXIS"] + 1):
+      dataSize *= header["NAXIS%d" % axis]
+    dataSize = abs(header["BITPIX"]) // 8 * header.get("GCOUNT", 1) * (header.get("PCOUNT", 0) + dataSize)
+  return header, offset + len(blocks) * fitsBlock, dataSize + (-dataSize) % fitsBlock
+
+
+def _tableType(header):
+  """
+  Return the numpy type of a row of the binary table with this header,
+  columns with TDIMn shaped as (slowest, ..., fastest) axis.
+  """
+  names = []
+  formats = []
+  offsets = []
+  offset = 0
+  for column in range(1, header["TFIELDS"] + 1):
+    tform = header["TFORM%d" % column].strip()
+    code = tform.lstrip("0123456789")[0]
+    repeat = int(tform[:len(tform) - len(tform.lstrip("0123456789"))] or 1)
+    typeName, size = tformTypes[code]
+    if code == "X":
+      repeat = (repeat + 7) // 8
+    if code == "A":
+      elementType = "S%d" % repeat
+      width = repeat
+    elif code in "PQ":
+      elementType = (typeName, (2,))
+      width = size
+    else:
+      dimensions = header.get("TDIM%d" % column)
+      shape = (repeat,)
+      if dimensions:
+        shape = tuple(int(dimension) for dimension in dimensions.strip("() ").split(","))[::-1]
+        if np.prod(shape) != repeat: # packed 1, 2 and 4-bit DATA, TDIM counts values
+          shape = (repeat,)
+      elementType = typeName if shape == (1,) else (typeName, shape)
+      width = repeat * size
+    if width:
+      names.append(header.get("TTYPE%d" % column, "COL%d" % column).strip())
+      formats.append(elementType)
+      offsets.append(offset)
+    offset += width
+  return np.dtype({"names": names, "formats": formats, "offsets": offsets, "itemsize": header["NAXIS1"]})
+
+
+class SearchModeReader(object):
+  """
+  PSRFITS search-mode file with the SUBINT table memory-mapped. The
+  headers are parsed once, and the columns are strided views of the file,
+  so reading any range of subints costs only the page faults of the bytes
+  used, without building table rows or copying the data.
+    Inputs:
+      fileName: input file name.
+      mode: "r" to read, "r+" to change column values in place
+            (default: "r").
+  """
+  def __init__(self, fileName, mode = "r"):
+    self.fileName = fileName
+    fileIn = open(fileName, "rb")
+    self.primaryHeader, offset, size = _readHDUHeader(fileIn, 0)
+    offset += size
+    fileSize = os.path.getsize(fileName)
+    self.subintHeader = None
+    while offset < fileSize:
+      header, dataOffset, size = _readHDUHeader(fileIn, offset)
+      if header.get("EXTNAME", "").strip() == "SUBINT":
+        self.subintHeader = header
+        break
+      offset = dataOffset + size
+    fileIn.close()
+    if self.subintHeader is None:
+      raise ValueError("%s has no SUBINT table." % fileName)
+    self.numberSubints = self.subintHeader["NAXIS2"]
+    self.samplesPerSubint = self.subintHeader["NSBLK"]
+    self.numberChannels = self.subintHeader["NCHAN"]
+    self.numberPolarisations = self.subintHeader["NPOL"]
+    self.nbits = self.subintHeader["NBITS"]
+    if self.numberSubints > 0:
+      self.table = np.memmap(fileName, _tableType(self.subintHeader), mode, dataOffset, (self.numberSubints,))
+    else:
+      self.table = np.zeros(0, _tableType(self.subintHeader))
+
+  def data(self, first, end):
+    """
+    Return DATA of subints first..end, 8-bit data as (subints, samples,
+    polarisations, channels), other bit depths as packed bytes.
+    """
+    data = self.table["DATA"][first:end]
+    if self.nbits != 8:
+      return data.reshape((end - first, -1))
+    return data.reshape((end - first, self.samplesPerSubint, self.numberPolarisations, self.numberChannels))
+
+  def scales(self, first, end):
+    """
+    Return DAT_SCL of subints first..end as (subints, polarisations, channels).
+    """
+    return self.table["DAT_SCL"][first:end].reshape((end - first, -1, self.numberChannels))
+
+  def offsets(self, first, end):
+    """
+    Return DAT_OFFS of subints first..end as (subints, polarisations, channels).
+    """
+    return self.table["DAT_OFFS"][first:end].reshape((end - first, -1, self.numberChannels))
+
+  def weights(self, first, end):
+    """
+    Return DAT_WTS of subints first..end as (subints, channels).
+    """
+    return self.table["DAT_WTS"][first:end].reshape((end - first, self.numberChannels))
+
+  def flush(self):
+    if isinstance(self.table, np.memmap):
+      self.table.flush()
+
+  def close(self):
+    self.table = None
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 by Maciej Serylak
+# Licensed under the Academic Free License version 3.0
+# This program comes with ABSOLUTELY NO WARRANTY.
+# You are free to modify and redistribute this code as long
+# as you do not remove the above attribution and reasonably
+# inform recipients that you have modified the original work.
+
+# Requantisation of detected filterbank data to 8 or 16 bits.
+
+import numpy as np
+from numba import jit
+
+
+def levelScaling(centre, sigma, nbits, numberSigma = 6.0):
+  """
+  Return float32 (scale, offset) with centre mapped to the middle of the
+  nbits range and numberSigma times sigma to either end of it.
+  """
+  sigma = np.array(sigma, np.float64)
+  sigma[sigma == 0] = 1.0 # flat or empty channels
+  levels = float(2**nbits)
+  scale = levels / (2.0 * numberSigma * sigma)
+  offset = levels / 2.0 - centre * scale
+  return scale.astype(np.float32), offset.astype(np.float32)
+
+
+class RunningStatistics(object):
+  """
+  Per-channel mean and standard deviation accumulated over blocks of
+  samples (time, IFs, channels), turned into the scale and offset mapping
+  the data onto nbits unsigned integers.
+    Inputs:
+      numberIFs, numberChannels: shape of one sample.
+  """
+  def __init__(self, numberIFs, numberChannels):
+    self.count = 0
+    self.sum = np.zeros((numberIFs, numberChannels), np.float64)
+    self.sumSquares = np.zeros((numberIFs, numberChannels), np.float64)
+
+  def add(self, samples):
+    samples = np.asarray(samples, np.float64)
+    self.count += samples.shape[0]
+    self.sum += samples.sum(axis = 0)
+    self.sumSquares += (samples * samples).sum(axis = 0)
+
+  def scaling(self, nbits, numberSigma = 6.0):
+    """
+    Return float32 (scale, offset) with the mean of every channel mapped to
+    the middle of the nbits range and numberSigma standard deviations to
+    either end of it.
+    """
+    count = max(self.count, 1)
+    mean = self.sum / count
+    sigma = np.sqrt(np.maximum(self.sumSquares / count - mean * mean, 0.0))
+    return levelScaling(mean, sigma, nbits, numberSigma)
+
+
+@jit(nopython=True, nogil=True)
+def _slidingMedian(values, windowLength, first, out):
+  # Median of every column of values over the windowLength rows ending
+  # with each row from first on (fewer at the start), kept as a sorted
+  # window that one value leaves and one enters per row. NaN and infinite
+  # values never enter the window, so the median is that of the finite
+  # values in it, zero when there are none.
+  window = np.empty(windowLength, values.dtype)
+  for j in range(values.shape[1]):
+    size = 0
+    for i in range(values.shape[0]):
+      if i >= windowLength and np.isfinite(values[i - windowLength, j]):
+        old = values[i - windowLength, j]
+        k = 0
+        while k < size - 1 and window[k] != old:
+          k += 1
+        for m in range(k, size - 1):
+          window[m] = window[m + 1]
+        size -= 1
+      if np.isfinite(values[i, j]):
+        k = size
+        while k > 0 and window[k - 1] > values[i, j]:
+          window[k] = window[k - 1]
+          k -= 1
+        window[k] = values[i, j]
+        size += 1
+      if i >= first:
+        h = size // 2
+        if size == 0:
+          out[i - first, j] = 0.0
+        else:
+          out[i - first, j] = window[h] if size % 2 else (window[h - 1] + window[h]) / 2
+
+
+class SlidingStatistics(object):
+  """
+  Per-channel mean and standard deviation of blocks of samples, e.g.
+  PSRFITS subints, combined as their median over a sliding window of the
+  last windowLength blocks and turned into the scale and offset mapping
+  each block onto nbits unsigned integers. The median keeps a few blocks
+  hit by RFI from moving the levels, and non-finite statistics, e.g. of
+  blocks with NaN samples, are left out of it. The statistics of a block
+  depend only on its own samples, so the scaling of a block does not
+  depend on where the conversion started as long as the window before it
+  was added.
+    Inputs:
+      windowLength: number of blocks in the window.
+  """
+  def __init__(self, windowLength):
+    self.windowLength = windowLength
+    self.means = None
+    self.sigmas = None
+
+  def scaling(self, blocks, nbits, numberSigma = 6.0):
+    """
+    Add blocks (blocks, time, IFs, channels) to the window and return
+    float32 (scale, offset) of shape (blocks, IFs, channels), each with the
+    median mean of every channel over the window ending with the block
+    mapped to the middle of the nbits range and numberSigma median standard
+    deviations to either end of it.
+    """
+    means = blocks.mean(axis = 1, dtype = np.float64)
+    sigmas = np.sqrt(np.maximum(np.square(blocks).mean(axis = 1, dtype = np.float64) - means * means, 0.0))
+    if self.means is not None:
+      means = np.concatenate((self.means, means))
+      sigmas = np.concatenate((self.sigmas, sigmas))
+    numberPrevious = means.shape[0] - blocks.shape[0]
+    centre = np.empty((blocks.shape[0],) + means.shape[1:], np.float64)
+    sigma = np.empty(centre.shape, np.float64)
+    _slidingMedian(means.reshape((means.shape[0], -1)), self.windowLength, numberPrevious, centre.reshape((centre.shape[0], -1)))
+    _slidingMedian(sigmas.reshape((sigmas.shape[0], -1)), self.windowLength, numberPrevious, sigma.reshape((sigma.shape[0], -1)))
+    keep = means.shape[0] - min(means.shape[0], self.windowLength - 1)
+    self.means = means[keep:]
+    self.sigmas = sigmas[keep:]
+    return levelScaling(centre, sigma, nbits, numberSigma)
+
+
+def quantise(values, scale, offset, nbits, out, clipCounts):
+  """
+  Quantise float32 values (time, IFs, channels) to out as
+  floor(values * scale + offset + 0.5), clipped to 0..2**nbits-1.
+  Clipped values are counted in clipCounts[0] (low) and clipCounts[1] (high).
+  """
+  levels = (values * scale + offset + np.float32(0.5)).astype(np.float32)
+  np.floor(levels, out = levels)
+  clipCounts[0] += np.count_nonzero(levels < 0)
+  clipCounts[1] += np.count_nonzero(levels > 2**nbits - 1)
+  np.clip(levels, 0, 2**nbits - 1, out = levels)
+  out[:] = levels
+  return out
+
+
+def reportClipping(clipCounts, numberValues):
+  """
+  Print the number and fraction of values clipped at either end of the range.
+  """
+  numberValues = max(numberValues, 1)
+  print ("Clipped values: low %d (%.4f%%), high %d (%.4f%%)") % (clipCounts[0], 100.0 * clipCounts[0] / numberValues, clipCounts[1], 100.0 * clipCounts[1] / numberValues)
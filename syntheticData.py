@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 by Maciej Serylak
+# Licensed under the Academic Free License version 3.0
+# This program comes with ABSOLUTELY NO WARRANTY.
+# You are free to modify and redistribute this code as long
+# as you do not remove the above attribution and reasonably
+# inform recipients that you have modified the original work.
+
+# Generators of synthetic input files for every converter: MeerKAT
+# beamformer HDF5, PSRFITS search mode, pcap, F-engine and DADA dumps.
+# The data are seeded noise, so the same arguments give the same files.
+
+import sys
+import struct
+import optparse as opt
+import numpy as np
+
+# Number of spectra generated at once.
+blockSpectra = 4096
+
+
+def beamformerH5(fileName, numberChannels = 1024, numberSpectra = 16384, firstTimestamp = 0, seed = 0, missing = (), chunks = (256, 256, 2), syncTime = 1462436476):
+  """
+  Write a beamformer HDF5 file: Data/bf_raw (channels, time, 2) int8
+  Gaussian voltages, Data/timestamps in steps of 8192 ADC samples and the
+  sync_time attribute of TelescopeModel/cbf.
+    Inputs:
+      missing: indices of spectra left out of the file.
+      chunks: HDF5 storage chunks, None for a contiguous dataset.
+  """
+  import h5py
+  rng = np.random.RandomState(seed)
+  keep = np.ones(numberSpectra, bool)
+  keep[list(missing)] = False
+  numberKept = int(keep.sum())
+  if chunks is not None:
+    chunks = (min(chunks[0], numberChannels), min(chunks[1], numberKept), 2)
+  dataFile = h5py.File(fileName, "w")
+  dataset = dataFile.create_dataset("Data/bf_raw", (numberChannels, numberKept, 2), np.int8, chunks = chunks)
+  written = 0
+  for s0 in range(0, numberSpectra, blockSpectra):
+    s1 = min(numberSpectra, s0 + blockSpectra)
+    block = np.clip(np.round(rng.normal(0.0, 12.0, (numberChannels, s1 - s0, 2))), -127, 127).astype(np.int8)
+    block = block[:, keep[s0:s1], :]
+    dataset[:, written:written + block.shape[1], :] = block
+    written += block.shape[1]
+  dataFile.create_dataset("Data/timestamps", data = (firstTimestamp + 8192 * np.arange(numberSpectra, dtype = np.uint64))[keep])
+  dataFile.create_group("TelescopeModel/cbf").attrs["sync_time"] = syncTime
+  dataFile.close()
+  return numberChannels * numberKept * 2
+
+
+def psrfitsSearch(fileName, numberSubints = 32, samplesPerSubint = 1024, numberChannels = 1024, numberPolarisations = 1, channelBW = -0.5, seed = 0, nanSubints = (), nanChannels = (), nbits = 8):
+  """
+  Write a PSRFITS search-mode file with random data, weights, scales and
+  offsets.
+    Inputs:
+      nanSubints, nanChannels: subints and channels whose scales are NaN.
+      nbits: bits per value (1, 2, 4 or 8), 1, 2 and 4-bit values packed
+             into bytes.
+  """
+  import astropy.io.fits as pyfits
+  rng = np.random.RandomState(seed)
+  primary = pyfits.PrimaryHDU()
+  header = primary.header
+  header["TELESCOP"] = "MeerKAT"
+  header["BACKEND"] = "KAT"
+  header["SRC_NAME"] = "J0835-4510"
+  header["RA"] = "08:35:20.61"
+  header["DEC"] = "-45:10:34.8"
+  header["STT_IMJD"] = 58000
+  header["STT_SMJD"] = 3600
+  header["STT_OFFS"] = 0.25
+  header["OBSFREQ"] = 1284.0
+  header["OBSBW"] = numberChannels * abs(channelBW)
+  header["OBS_MODE"] = "SEARCH"
+  numberBytes = samplesPerSubint * numberPolarisations * numberChannels * nbits // 8
+  dimensions = "(%d,%d,%d)" % (numberChannels, numberPolarisations, samplesPerSubint)
+  weights = rng.uniform(0.5, 1, (numberSubints, numberChannels)).astype(np.float32)
+  offsets = rng.uniform(-3, 3, (numberSubints, numberChannels * numberPolarisations)).astype(np.float32)
+  scales = rng.uniform(0.5, 2, (numberSubints, numberPolarisations, numberChannels)).astype(np.float32)
+  scales[np.ix_(list(nanSubints), range(numberPolarisations), list(nanChannels))] = np.nan
+  columns = [pyfits.Column(name = "TSUBINT", format = "1D", array = np.ones(numberSubints) * samplesPerSubint * 1e-4),
+             pyfits.Column(name = "DAT_WTS", format = "%dE" % numberChannels, array = weights),
+             pyfits.Column(name = "DAT_OFFS", format = "%dE" % (numberChannels * numberPolarisations), array = offsets),
+             pyfits.Column(name = "DAT_SCL", format = "%dE" % (numberChannels * numberPolarisations), array = scales.reshape((numberSubints, -1))),
+             pyfits.Column(name = "DATA", format = "%dB" % numberBytes, dim = dimensions if nbits == 8 else None, array = rng.randint(0, 256, (numberSubints, numberBytes)).astype(np.uint8))]
+  subint = pyfits.BinTableHDU.from_columns(columns, name = "SUBINT")
+  header = subint.header
+  header["TDIM%d" % len(columns)] = dimensions # counts values, not the packed bytes
+  header["TBIN"] = 1e-4
+  header["NCHAN"] = numberChannels
+  header["NPOL"] = numberPolarisations
+  header["NSBLK"] = samplesPerSubint
+  header["NBITS"] = nbits
+  header["CHAN_BW"] = channelBW
+  header["POL_TYPE"] = "AA+BB" if numberPolarisations == 1 else "AABBCRCI"
+  header["NBIN"] = 1
+  pyfits.HDUList([primary, subint]).writeto(fileName, overwrite = True)
+  return numberSubints * numberBytes
+
+
+def pcap(fileName, numberPackets = 8192, accumulationRate = 1, firstTimestamp = 1459453729, seed = 0, missing = ()):
+  """
+  Write a pcap capture of pseudo-Stokes packets as read by preparePCAP.py:
+  a 24-byte global header, then per packet a 58-byte record and network
+  header and an 8208-byte payload (uint64 UTC second, uint32 accumulation
+  number, uint32 accumulation rate, 1024 x 4 int16 pseudo-Stokes).
+    Inputs:
+      missing: indices of packets whose accumulation number is skipped.
+  """
+  rng = np.random.RandomState(seed)
+  spectraPerSecond = 390625
+  fileOut = open(fileName, "wb")
+  fileOut.write(struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+  networkHeader = "\0" * 42
+  missing = set(missing)
+  accumulation = 0
+  for packet in range(numberPackets):
+    if packet in missing:
+      accumulation += accumulationRate
+    second = firstTimestamp + accumulation // spectraPerSecond
+    payload = struct.pack("<QII", second, accumulation % spectraPerSecond, accumulationRate)
+    payload += rng.randint(0, 2000, 4 * 1024).astype(np.int16).tostring()
+    fileOut.write(struct.pack("<IIII", second, 0, len(payload) + 42, len(payload) + 42) + networkHeader + payload)
+    accumulation += accumulationRate
+  fileOut.close()
+  return 24 + numberPackets * (58 + 8208)
+
+
+def fengine(fileName, numberSpectra = 32768, seed = 0):
+  """
+  Write an F-engine dump as read by prepareFeng.py: per spectrum 1024
+  channels x 2 polarisations of bytes holding 4-bit real and imaginary parts.
+  """
+  rng = np.random.RandomState(seed)
+  fileOut = open(fileName, "wb")
+  for s0 in range(0, numberSpectra, blockSpectra):
+    s1 = min(numberSpectra, s0 + blockSpectra)
+    rng.randint(0, 256, (s1 - s0) * 1024 * 2).astype(np.uint8).tofile(fileOut)
+  fileOut.close()
+  return numberSpectra * 1024 * 2
+
+
+def dada(fileName, numberSpectra = 8192, seed = 0):
+  """
+  Write an i-CBF DADA dump as read by prepareICBF.py: per spectrum 1024
+  channels x 4 int16 pseudo-Stokes.
+  """
+  rng = np.random.RandomState(seed)
+  fileOut = open(fileName, "wb")
+  for s0 in range(0, numberSpectra, blockSpectra):
+    s1 = min(numberSpectra, s0 + blockSpectra)
+    rng.randint(0, 2000, (s1 - s0) * 1024 * 4).astype(np.int16).tofile(fileOut)
+  fileOut.close()
+  return numberSpectra * 1024 * 4 * 2
+
+
+# Main body of the script
+if __name__=="__main__":
+  # Parsing the command line options
+  usage = "Usage: %prog --format=h5 --out=\"pol0.h5\" [--spectra=16384]"
+  cmdline = opt.OptionParser(usage)
+  cmdline.formatter.max_help_position = 100 # increase space reserved for option flags (default 24), trick to make the help more readable
+  cmdline.formatter.width = 250 # increase help width from 120 to 200
+  cmdline.add_option("--format", type = "choice", dest = "format", metavar = "<format>", choices = ["h5", "psrfits", "pcap", "feng", "dada"], help = "Give format to generate: h5, psrfits, pcap, feng or dada.")
+  cmdline.add_option("--out", type = "string", dest = "outFileName", metavar = "<outFileName>", help = "Give output filename.")
+  cmdline.add_option("--spectra", type = "int", dest = "numberSpectra", metavar = "<numberSpectra>", help = "Give number of spectra (packets for pcap, subints for psrfits).")
+  cmdline.add_option("--nchan", type = "int", dest = "numberChannels", metavar = "<numberChannels>", default = "1024", help = "Give number of channels (h5 and psrfits, default: 1024).")
+  cmdline.add_option("--nbits", type = "int", dest = "nbits", metavar = "<nbits>", default = "8", help = "Give bits per value of psrfits data, 1, 2, 4 or 8 (default: 8).")
+  cmdline.add_option("--seed", type = "int", dest = "seed", metavar = "<seed>", default = "0", help = "Give seed of the random data.")
+  (opts, args) = cmdline.parse_args() # reading cmd options
+  if not opts.format or not opts.outFileName:
+    cmdline.print_usage()
+    sys.exit(0)
+  sizes = {"h5": 16384, "psrfits": 32, "pcap": 8192, "feng": 32768, "dada": 8192}
+  numberSpectra = opts.numberSpectra or sizes[opts.format]
+  if opts.format == "h5":
+    numberBytes = beamformerH5(opts.outFileName, opts.numberChannels, numberSpectra, seed = opts.seed)
+  elif opts.format == "psrfits":
+    numberBytes = psrfitsSearch(opts.outFileName, numberSpectra, numberChannels = opts.numberChannels, seed = opts.seed, nbits = opts.nbits)
+  elif opts.format == "pcap":
+    numberBytes = pcap(opts.outFileName, numberSpectra, seed = opts.seed)
+  elif opts.format == "feng":
+    numberBytes = fengine(opts.outFileName, numberSpectra, seed = opts.seed)
+  else:
+    numberBytes = dada(opts.outFileName, numberSpectra, seed = opts.seed)
+  print ("Wrote %d bytes of %s data to %s") % (numberBytes, opts.format, opts.outFileName)